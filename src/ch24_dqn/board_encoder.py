@@ -0,0 +1,57 @@
+import numpy as np
+import tensorflow as tf
+
+
+def board_exponents(boards, layer_count=12):
+    """
+    Convert boards of tile values to uint8 exponents. 0 for empty, log2(tile) otherwise, clipped to layer_count - 1.
+
+    :param boards: shape == (..., 4, 4)
+    :return: shape == (..., 4, 4), uint8
+    """
+    boards = np.asarray(boards)
+    exponents = np.log2(np.maximum(boards, 1)).astype(np.uint8)
+
+    return np.minimum(exponents, layer_count - 1)
+
+
+def one_hot_exponents(exponents, layer_count=12):
+    """
+    :param exponents: shape == (..., 4, 4), see board_exponents()
+    :return: shape == (..., 4, 4, layer_count), float32
+    """
+    return np.eye(layer_count, dtype=np.float32)[exponents]
+
+
+def encode_boards(boards, layer_count=12, compact=False):
+    """
+    Vectorized version of preprocess(). Encodes any number of boards at once.
+
+    :param boards: shape == (N, 4, 4) or (4, 4), tile values
+    :param layer_count: Number of one-hot layers, 2^1 to 2^(layer_count - 1) and empty
+    :param compact: If True, return uint8 exponent boards instead of one-hot
+    :return: shape == (N, 4, 4, layer_count) one-hot float32, or (N, 4, 4) uint8 if compact
+    """
+    exponents = board_exponents(boards, layer_count)
+
+    if compact:
+        return exponents
+
+    return one_hot_exponents(exponents, layer_count)
+
+
+def encode_boards_tf(boards, layer_count=12):
+    """
+    TensorFlow version of encode_boards(), can be used inside a tf.function.
+
+    :param boards: shape == (..., 4, 4), tile values or uint8 exponents if already compact
+    :return: shape == (..., 4, 4, layer_count), float32
+    """
+    if boards.dtype == tf.uint8:
+        exponents = tf.cast(boards, tf.int32)
+    else:
+        boards = tf.cast(boards, tf.float32)
+        exponents = tf.cast(tf.round(tf.math.log(tf.maximum(boards, 1.0)) / tf.math.log(2.0)), tf.int32)
+        exponents = tf.minimum(exponents, layer_count - 1)
+
+    return tf.one_hot(exponents, layer_count, dtype=tf.float32)
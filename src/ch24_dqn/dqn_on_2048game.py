@@ -1,30 +1,20 @@
-import gym_2048
-import gym
 import numpy as np
 import tensorflow as tf
-import math
-import random
 import matplotlib.pyplot as plt
+from ch24_dqn.replay_memory import *
+from ch24_dqn.board_encoder import *
+from ch24_dqn.game_2048 import *
+from ch24_dqn.dqn_trainer import *
+from ch24_dqn.vector_env import *
 
-env = gym.make('2048-v0')
+env = Game2048Env()  # Single environment for the test games
 
 layer_count = 12  # 2^1 to 2^11, 0
-table: dict = {2 ** i: i for i in range(layer_count)}
 
 
 # Preprocess game state as one-hot
 def preprocess(obs):
-    x = np.zeros((4, 4, layer_count))
-
-    for i in range(4):
-        for j in range(4):
-            if obs[i, j] > 0:
-                v = min(obs[i, j], 2 ** (layer_count - 1))
-                x[i, j, table[v]] = 1
-            else:
-                x[i, j, 0] = 1
-
-    return x
+    return encode_boards(obs, layer_count)
 
 
 # Define model. CNN.
@@ -56,56 +46,35 @@ def build_model():
 model = build_model()
 target_model = build_model()
 
+
+# Compiled forward pass, used instead of model.predict to select actions of every environment at once
+@tf.function(input_signature=[tf.TensorSpec(shape=(None, 4, 4, layer_count), dtype=tf.float32)])
+def predict_q(states):
+    return model(states, training=False)
+
+
 gamma = 0.9
 batch_size = 512
 max_memory = batch_size * 8  # batches per epoch would be 8
-replay_memory = []
+replay_memory = ReplayMemory(max_memory, layer_count)
+
+
+# Soft target update (Polyak averaging) after every train step instead of copying Q to Q' every 4 trainings
+USE_SOFT_UPDATE = False
+tau = 0.01
+
+trainer = DQNTrainer(model, target_model, gamma, layer_count, tau=tau if USE_SOFT_UPDATE else None)
 
 
 # Append transition : (state, action, reward, next_state, done)
 def append_sample(s0, a, r, s1, d):
-    replay_memory.append([s0, a, r, s1, d])
+    replay_memory.append(s0, a, r, s1, d)
 
 
 def train_model():
-    np.random.shuffle(replay_memory)
-
-    # Number of batches per epoch
-    len = max_memory // batch_size
-
-    for k in range(len):
-        # batch_size * (s0, a, r, s1, d)
-        mini_batch = replay_memory[k * batch_size:(k + 1) * batch_size]
-
-        states = np.zeros((batch_size, 4, 4, layer_count))
-        actions = []
-        rewards = []
-        next_states = np.zeros((batch_size, 4, 4, layer_count))
-        dones = []
-
-        # Accumulate all data from mini-batch to train
-        for i in range(batch_size):
-            states[i] = mini_batch[i][0]
-            actions.append(mini_batch[i][1])
-            rewards.append(mini_batch[i][2])
-            next_states[i] = mini_batch[i][3]
-            dones.append(mini_batch[i][4])
-
-        # DQN Returns predicted Q value
-        # batch_size * (q_left, q_up, q_right, q_down)
-        answer = model.predict(states)
-        target = target_model.predict(next_states)
-
-        # Generate y-labels to train
-        # Gradient descent step on loss of (y - Q(s, a|θ))^2
-        for i in range(batch_size):
-            # Reusing variable 'answer' as y-label
-            if dones[i]:
-                answer[i][actions[i]] = rewards[i]
-            else:
-                answer[i][actions[i]] = rewards[i] + gamma * np.amax(target[i])
-
-        model.fit(states, answer, batch_size=batch_size, epochs=1, verbose=0)
+    # batch_size * (s0, a, r, s1, d), uint8 exponent boards
+    for states, actions, rewards, next_states, dones in replay_memory.batches(batch_size, compact=True):
+        trainer.train_step(states, actions, rewards, next_states, dones)
 
 
 def softmax(logits):
@@ -118,85 +87,86 @@ max_episodes = 10001
 epsilon = 0.9
 epsilon_min = 0.01
 
+num_envs = 32
+envs = Game2048Batch(num_envs)
+
 scores = []
 steps = []
 iteration = 0
 
 train_count = 0
 
-for i in range(max_episodes):
-    if i % 100 == 0 and i != 0:
-        print('score mean:', np.mean(scores[-100:]),
-              'step mean:', np.mean(steps[-100:]),
-              'iteration:', iteration,
-              'epsilon:', epsilon)
+prev_obs = envs.reset()  # (num_envs, 4, 4)
+score = np.zeros(num_envs)
+step = np.zeros(num_envs, dtype=np.int64)
+moving_dir = np.ones((num_envs, 4))
+prev_max = np.max(prev_obs, axis=(1, 2))
 
-    prev_obs = env.reset()
+while len(scores) < max_episodes:
+    iteration += num_envs
 
-    score = 0
-    step = 0
-    moving_dir = np.array([1, 1, 1, 1])
-    prev_max = np.max(prev_obs)
+    # Select action with ε-greedy policy
+    q_logits = predict_q(preprocess(prev_obs)).numpy()
+    actions = select_actions(q_logits, moving_dir, epsilon)
 
-    while True:
-        iteration += 1
+    obs, rewards, dones = envs.step(actions)
 
-        # Select action with ε-greedy policy
-        if random.random() < epsilon:
-            action = env.action_space.sample()
-        else:
-            x = preprocess(prev_obs)
-            q_logits = model.predict(np.expand_dims(x, axis=0))[0]
-            prob = softmax(q_logits)
-            prob = prob * moving_dir
-            action = np.argmax(prob)
+    score += rewards
+    step += 1
 
-        obs, reward, done, info = env.step(action)
+    # Not moved
+    not_moved = np.logical_and(rewards == 0, np.all(obs == prev_obs, axis=(1, 2)))
+    moved = np.logical_not(not_moved)
 
-        score += reward
-        step += 1
+    moving_dir[not_moved, actions[not_moved]] = 0
+    moving_dir[moved] = 1
 
-        # Not moved
-        if reward == 0 and np.array_equal(obs, prev_obs):
-            moving_dir[action] = 0
-            continue
-        else:
-            moving_dir = np.array([1, 1, 1, 1])
+    # Customize reward to boost learning
+    now_max = np.max(obs, axis=(1, 2))
+    new_max = np.logical_and(moved, prev_max < now_max)
+    prev_max = np.where(new_max, now_max, prev_max)
 
-        # Customize reward to boost learning
-        now_max = np.max(obs)
-        if prev_max < now_max:
-            prev_max = now_max
-            reward = math.log(now_max, 2) * 0.1
-        else:
-            reward = 0
-        reward += np.count_nonzero(prev_obs) - np.count_nonzero(obs) + 1
+    custom_rewards = np.where(new_max, np.log2(np.maximum(now_max, 1)) * 0.1, 0)
+    custom_rewards += np.count_nonzero(prev_obs, axis=(1, 2)) - np.count_nonzero(obs, axis=(1, 2)) + 1
 
+    for e in np.flatnonzero(moved):
         # Store transition to replay memory
-        append_sample(preprocess(prev_obs), action, reward, preprocess(obs), done)
+        append_sample(prev_obs[e], actions[e], custom_rewards[e], obs[e], dones[e])
 
         # Start train when train data fully filled
         if len(replay_memory) >= max_memory:
             train_model()
-            replay_memory = []
+            replay_memory.clear()
 
             train_count += 1
-            # Every 4 steps, Reset Q'=Q
-            if train_count % 4 == 0:
-                target_model.set_weights(model.get_weights())
+            # Every 4 steps, Reset Q'=Q, unless Q' is already updated softly
+            if not USE_SOFT_UPDATE and train_count % 4 == 0:
+                trainer.update_target()
 
-        prev_obs = obs
+    prev_obs[moved] = obs[moved]
 
-        if epsilon > epsilon_min and iteration % 2500 == 0:
-            epsilon = epsilon * 0.995
+    if epsilon > epsilon_min and iteration // 2500 > (iteration - num_envs) // 2500:
+        epsilon = epsilon * 0.995
 
-        if done:
-            break
+    for e in np.flatnonzero(np.logical_and(moved, dones)):
+        i = len(scores)
+        scores.append(score[e])
+        steps.append(step[e])
 
-    scores.append(score)
-    steps.append(step)
+        print(i, 'score:', score[e], 'step:', step[e], 'max', np.max(obs[e]), 'memory len:', len(replay_memory))
 
-    print(i, 'score:', score, 'step:', step, 'max', np.max(obs), 'memory len:', len(replay_memory))
+        if i % 100 == 0 and i != 0:
+            print('score mean:', np.mean(scores[-100:]),
+                  'step mean:', np.mean(steps[-100:]),
+                  'iteration:', iteration,
+                  'epsilon:', epsilon)
+
+        # Start a new game in this environment
+        prev_obs[e] = envs.reset_at(e)
+        score[e] = 0
+        step[e] = 0
+        moving_dir[e] = 1
+        prev_max[e] = np.max(prev_obs[e])
 
 N = 100
 rolling_mean = [np.mean(scores[i:i + N]) for i in range(len(scores) - N + 1)]
@@ -230,7 +200,7 @@ for i in range(1000):
         iteration += 1
 
         x = preprocess(prev_obs)
-        q_logits = model.predict(np.expand_dims(x, axis=0))[0]
+        q_logits = predict_q(np.expand_dims(x, axis=0)).numpy()[0]
         prob = softmax(q_logits)
         prob = prob * moving_dir
         action = np.argmax(prob)
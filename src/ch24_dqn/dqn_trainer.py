@@ -0,0 +1,75 @@
+import tensorflow as tf
+from ch24_dqn.board_encoder import *
+
+
+class DQNTrainer:
+    def __init__(self, model, target_model, gamma, layer_count=12, tau=None):
+        """
+        Double network DQN training step compiled into a single tf.function.
+        Q(s), Q'(s'), the Bellman targets and the gradient update run in one graph call,
+        instead of model.predict, target_model.predict and model.fit.
+
+        :param model: Compiled Q network, its optimizer is used
+        :param target_model: Target network Q'
+        :param gamma: Discount factor
+        :param layer_count: Number of one-hot layers of the board
+        :param tau: If given, Q' is updated by Polyak averaging after every train step, Q' = tau * Q + (1 - tau) * Q'
+        """
+        self.model = model
+        self.target_model = target_model
+        self.optimizer = model.optimizer
+        self.gamma = gamma
+        self.layer_count = layer_count
+        self.tau = tau
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=(None, 4, 4), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int64),
+        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        tf.TensorSpec(shape=(None, 4, 4), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.bool),
+    ])
+    def train_step(self, states, actions, rewards, next_states, dones):
+        """
+        :param states: shape == (batch_size, 4, 4), uint8 exponent boards
+        :param actions: shape == (batch_size,)
+        :param rewards: shape == (batch_size,)
+        :param next_states: shape == (batch_size, 4, 4), uint8 exponent boards
+        :param dones: shape == (batch_size,)
+        :return: loss
+        """
+        states = encode_boards_tf(states, self.layer_count)
+        next_states = encode_boards_tf(next_states, self.layer_count)
+
+        # y = r + γ * max Q'(s', a'), only r for the last transition of a game
+        target = self.target_model(next_states, training=False)
+        targets = rewards + self.gamma * tf.reduce_max(target, axis=1) * tf.cast(tf.logical_not(dones), tf.float32)
+
+        action_mask = tf.one_hot(actions, 4, on_value=True, off_value=False)
+
+        with tf.GradientTape() as tape:
+            answer = self.model(states, training=True)
+
+            # Same y-labels as before, the other actions keep their predicted Q value and give no gradient
+            labels = tf.where(action_mask, targets[:, tf.newaxis], tf.stop_gradient(answer))
+
+            # Gradient descent step on loss of (y - Q(s, a|θ))^2
+            loss = tf.reduce_mean(tf.square(labels - answer))
+
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+        if self.tau is not None:
+            self.soft_update()
+
+        return loss
+
+    def soft_update(self):
+        for target_weight, weight in zip(self.target_model.weights, self.model.weights):
+            target_weight.assign(self.tau * weight + (1.0 - self.tau) * target_weight)
+
+    def update_target(self):
+        """
+        Hard update, Q'=Q
+        """
+        self.target_model.set_weights(self.model.get_weights())
@@ -0,0 +1,189 @@
+import numpy as np
+
+# Actions, same as gym_2048. The board is rotated 'action' times counterclockwise and then slid to the left.
+LEFT = 0
+UP = 1
+RIGHT = 2
+DOWN = 3
+
+ROW_SHIFTS = np.array([0, 4, 8, 12], dtype=np.uint32)
+
+
+def build_row_tables():
+    """
+    Precompute sliding to the left for every row, packed as 4 exponents of 4 bits (first cell in the lowest bits).
+
+    :return: row_left, shape == (65536,) packed row after the move, row_reward, shape == (65536,) sum of merged tiles
+    """
+    row_left = np.zeros(1 << 16, dtype=np.uint16)
+    row_reward = np.zeros(1 << 16, dtype=np.int64)
+
+    cells = (np.arange(1 << 16, dtype=np.uint32)[:, np.newaxis] >> ROW_SHIFTS) & 0xF
+
+    for packed, row in enumerate(cells.tolist()):
+        row = [e for e in row if e > 0]
+
+        # Same merge order as gym_2048, each tile merges at most once
+        result = []
+        reward = 0
+        i = 1
+        while i < len(row):
+            if row[i] == row[i - 1]:
+                merged = min(row[i] + 1, 15)
+                reward += 2 ** (row[i] + 1)
+                result.append(merged)
+                i += 2
+            else:
+                result.append(row[i - 1])
+                i += 1
+        if i == len(row):
+            result.append(row[i - 1])
+
+        result += [0] * (4 - len(result))
+
+        row_left[packed] = result[0] | (result[1] << 4) | (result[2] << 8) | (result[3] << 12)
+        row_reward[packed] = reward
+
+    return row_left, row_reward
+
+
+ROW_LEFT, ROW_REWARD = build_row_tables()
+
+
+def pack_rows(exponents):
+    """
+    :param exponents: shape == (N, 4, 4), uint8
+    :return: shape == (N, 4), packed rows
+    """
+    return np.bitwise_or.reduce(exponents.astype(np.uint32) << ROW_SHIFTS, axis=-1)
+
+
+def unpack_rows(rows):
+    """
+    :param rows: shape == (N, 4), packed rows
+    :return: shape == (N, 4, 4), uint8
+    """
+    return ((rows.astype(np.uint32)[..., np.newaxis] >> ROW_SHIFTS) & 0xF).astype(np.uint8)
+
+
+def move_boards(exponents, actions):
+    """
+    Apply one move to every board, without spawning a new tile.
+
+    :param exponents: shape == (N, 4, 4), uint8 exponent boards
+    :param actions: shape == (N,)
+    :return: moved exponent boards, shape == (N, 4, 4), rewards, shape == (N,)
+    """
+    moved = np.empty_like(exponents)
+    rewards = np.zeros(len(exponents), dtype=np.int64)
+
+    for action in range(4):
+        selected = actions == action
+
+        if not np.any(selected):
+            continue
+
+        rows = pack_rows(np.rot90(exponents[selected], k=action, axes=(1, 2)))
+
+        rewards[selected] = np.sum(ROW_REWARD[rows], axis=1)
+        moved[selected] = np.rot90(unpack_rows(ROW_LEFT[rows]), k=4 - action, axes=(1, 2))
+
+    return moved, rewards
+
+
+def is_done(exponents):
+    """
+    A board is done when it is full and no two neighbouring tiles are equal, so no move can merge anything.
+
+    :param exponents: shape == (N, 4, 4)
+    :return: shape == (N,)
+    """
+    full = np.all(exponents > 0, axis=(1, 2))
+    horizontal = np.any(exponents[:, :, 1:] == exponents[:, :, :-1], axis=(1, 2))
+    vertical = np.any(exponents[:, 1:, :] == exponents[:, :-1, :], axis=(1, 2))
+
+    return np.logical_and(full, np.logical_not(np.logical_or(horizontal, vertical)))
+
+
+def to_tiles(exponents):
+    return np.where(exponents > 0, np.left_shift(1, exponents.astype(np.int64)), 0)
+
+
+class Game2048Batch:
+    def __init__(self, num_envs, seed=None):
+        """
+        Pure NumPy 2048 simulator for a batch of boards. Reproduces gym_2048's '2048-v0':
+        reward is the sum of merged tiles, a random tile (2 with 90%, 4 with 10%) is placed on an empty cell after every move
+        (also when the board didn't move, as gym_2048 does), and done means the board is full and cannot merge anymore.
+        Has the same interface as VectorEnv.
+
+        :param num_envs: Number of boards
+        :param seed: Seed of the tile spawns
+        """
+        self.num_envs = num_envs
+        self.random = np.random.default_rng(seed)
+        self.exponents = np.zeros((num_envs, 4, 4), dtype=np.uint8)
+
+    def spawn_tiles(self, indices):
+        """
+        Place one random tile on a random empty cell of each board in indices. Full boards are left as they are.
+        """
+        boards = self.exponents[indices].reshape(-1, 16)
+        empty = boards == 0
+
+        # Uniform choice among the empty cells
+        cells = np.argmax(np.where(empty, self.random.random(boards.shape), -1.0), axis=1)
+        tiles = np.where(self.random.random(len(boards)) < 0.9, 1, 2).astype(np.uint8)
+
+        has_empty = np.any(empty, axis=1)
+        rows = np.flatnonzero(has_empty)
+        boards[rows, cells[has_empty]] = tiles[has_empty]
+
+        self.exponents[indices] = boards.reshape(-1, 4, 4)
+
+    def reset(self):
+        """
+        :return: shape == (num_envs, 4, 4), tile values
+        """
+        self.exponents[:] = 0
+
+        all_boards = np.arange(self.num_envs)
+        self.spawn_tiles(all_boards)
+        self.spawn_tiles(all_boards)
+
+        return to_tiles(self.exponents)
+
+    def reset_at(self, i):
+        """
+        :return: shape == (4, 4), tile values
+        """
+        self.exponents[i] = 0
+        self.spawn_tiles([i])
+        self.spawn_tiles([i])
+
+        return to_tiles(self.exponents[i])
+
+    def step(self, actions):
+        """
+        :param actions: shape == (num_envs,)
+        :return: obs, shape == (num_envs, 4, 4), rewards, shape == (num_envs,), dones, shape == (num_envs,)
+        """
+        self.exponents, rewards = move_boards(self.exponents, np.asarray(actions))
+        self.spawn_tiles(np.arange(self.num_envs))
+
+        return to_tiles(self.exponents), rewards, is_done(self.exponents)
+
+
+class Game2048Env:
+    def __init__(self, seed=None):
+        """
+        Single board version of Game2048Batch with the gym interface, drop-in replacement of gym.make('2048-v0')
+        """
+        self.game = Game2048Batch(1, seed)
+
+    def reset(self):
+        return self.game.reset()[0]
+
+    def step(self, action):
+        obs, rewards, dones = self.game.step([action])
+        return obs[0], rewards[0], dones[0], {}
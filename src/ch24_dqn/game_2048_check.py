@@ -0,0 +1,55 @@
+import gym_2048
+import gym
+import time
+import numpy as np
+from ch24_dqn.game_2048 import *
+from ch24_dqn.vector_env import *
+
+# Checks that the NumPy engine moves, rewards and finishes exactly like gym_2048, then compares the speed
+
+gym_env = gym.make('2048-v0').unwrapped
+gym_env.reset()
+
+N = 2000
+
+# Random boards, dense enough to have many merges and finished boards
+exponents = np.random.randint(0, 6, size=(N, 4, 4)).astype(np.uint8)
+exponents[np.random.random(N) < 0.5] |= 1
+boards = to_tiles(exponents)
+
+for action in range(4):
+    moved, rewards = move_boards(exponents, np.full(N, action))
+
+    for i in range(N):
+        reward, updated = gym_env._slide_left_and_merge(np.rot90(boards[i], k=action))
+
+        assert np.array_equal(np.rot90(updated, k=4 - action), to_tiles(moved[i]))
+        assert reward == rewards[i]
+
+done = is_done(exponents)
+for i in range(N):
+    gym_env.board = boards[i].copy()
+    assert gym_env.is_done() == done[i]
+
+print('Moves, rewards and done match gym_2048')
+
+# Steps/sec of random play
+num_envs = 256
+steps = 200
+
+envs = VectorEnv(lambda: gym.make('2048-v0'), num_envs)
+envs.reset()
+start = time.time()
+for _ in range(steps):
+    envs.step(np.random.randint(0, 4, size=num_envs))
+gym_speed = num_envs * steps / (time.time() - start)
+
+game = Game2048Batch(num_envs)
+game.reset()
+start = time.time()
+for _ in range(steps):
+    game.step(np.random.randint(0, 4, size=num_envs))
+numpy_speed = num_envs * steps / (time.time() - start)
+
+print('gym_2048      : {:.0f} steps/sec'.format(gym_speed))
+print('Game2048Batch : {:.0f} steps/sec ({:.1f}x)'.format(numpy_speed, numpy_speed / gym_speed))
@@ -0,0 +1,54 @@
+import time
+import numpy as np
+from ch24_dqn.board_encoder import *
+
+# Compares the per-board preprocess() loop with the vectorized encode_boards()
+
+layer_count = 12  # 2^1 to 2^11, 0
+table: dict = {2 ** i: i for i in range(layer_count)}
+
+
+# Previous preprocess, 4x4 double loop with dict lookup
+def preprocess(obs):
+    x = np.zeros((4, 4, layer_count))
+
+    for i in range(4):
+        for j in range(4):
+            if obs[i, j] > 0:
+                v = min(obs[i, j], 2 ** (layer_count - 1))
+                x[i, j, table[v]] = 1
+            else:
+                x[i, j, 0] = 1
+
+    return x
+
+
+N = 10000
+
+# Random boards with empty cells and tiles from 2 to 4096
+exponents = np.random.randint(0, 13, size=(N, 4, 4))
+boards = np.where(exponents > 0, 2 ** exponents, 0)
+
+start = time.time()
+expected = np.array([preprocess(b) for b in boards])
+loop_time = time.time() - start
+
+start = time.time()
+encoded = encode_boards(boards, layer_count)
+vectorized_time = time.time() - start
+
+start = time.time()
+encode_boards(boards, layer_count, compact=True)
+compact_time = time.time() - start
+
+start = time.time()
+encoded_tf = encode_boards_tf(boards, layer_count).numpy()
+tf_time = time.time() - start
+
+assert np.array_equal(expected, encoded)
+assert np.array_equal(expected, encoded_tf)
+
+print('preprocess loop    : {:.1f} boards/sec'.format(N / loop_time))
+print('encode_boards      : {:.1f} boards/sec ({:.1f}x)'.format(N / vectorized_time, loop_time / vectorized_time))
+print('encode_boards uint8: {:.1f} boards/sec ({:.1f}x)'.format(N / compact_time, loop_time / compact_time))
+print('encode_boards_tf   : {:.1f} boards/sec ({:.1f}x)'.format(N / tf_time, loop_time / tf_time))
@@ -0,0 +1,100 @@
+import numpy as np
+from ch24_dqn.board_encoder import *
+
+
+def symmetric_transform(boards, transforms):
+    """
+    Apply one of the 8 symmetries of the square to each board.
+    0: identity, 1: flip rows, 2: flip columns, 3: flip both, 4 ~ 7: transpose followed by the same flips as 0 ~ 3
+
+    :param boards: shape == (N, 4, 4, ...)
+    :param transforms: shape == (N,), 0 ~ 7
+    :return: shape == (N, 4, 4, ...)
+    """
+    shape = (-1,) + (1,) * (boards.ndim - 1)
+
+    boards = np.where((transforms >= 4).reshape(shape), boards.swapaxes(1, 2), boards)
+    boards = np.where((transforms & 1 == 1).reshape(shape), boards[:, ::-1], boards)
+    boards = np.where((transforms & 2 == 2).reshape(shape), boards[:, :, ::-1], boards)
+
+    return boards
+
+
+class ReplayMemory:
+    def __init__(self, max_memory, layer_count=12, action_swap=None):
+        """
+        Preallocated ring buffer replay memory.
+        Boards are stored as uint8 exponents (0 for empty, log2(tile) otherwise) and only expanded to one-hot when sampled.
+
+        :param max_memory: Number of transitions to keep
+        :param layer_count: Number of one-hot layers, 2^1 to 2^(layer_count - 1) and empty
+        :param action_swap: If given, every sampled transition gets a random symmetric transform (see symmetric_transform()),
+                            action_swap[action][transform] is the action after the transform
+        """
+        self.max_memory = max_memory
+        self.layer_count = layer_count
+        self.action_swap = None if action_swap is None else np.array(action_swap)
+
+        self.states = np.zeros((max_memory, 4, 4), dtype=np.uint8)
+        self.actions = np.zeros(max_memory, dtype=np.int64)
+        self.rewards = np.zeros(max_memory, dtype=np.float32)
+        self.next_states = np.zeros((max_memory, 4, 4), dtype=np.uint8)
+        self.dones = np.zeros(max_memory, dtype=np.bool_)
+
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # Append transition : (state, action, reward, next_state, done), state is a raw 4x4 board
+    def append(self, s0, a, r, s1, d):
+        i = self.position
+
+        self.states[i] = board_exponents(s0, self.layer_count)
+        self.actions[i] = a
+        self.rewards[i] = r
+        self.next_states[i] = board_exponents(s1, self.layer_count)
+        self.dones[i] = d
+
+        self.position = (i + 1) % self.max_memory
+        self.size = min(self.size + 1, self.max_memory)
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+
+    def sample(self, batch_size, compact=False):
+        return self.get(np.random.randint(0, self.size, size=batch_size), compact)
+
+    def batches(self, batch_size, compact=False):
+        """
+        Shuffle the memory and split it into mini-batches, like one epoch over the memory.
+        """
+        indices = np.random.permutation(self.size)
+
+        for k in range(self.size // batch_size):
+            yield self.get(indices[k * batch_size:(k + 1) * batch_size], compact)
+
+    def get(self, indices, compact=False):
+        """
+        :return: states, actions, rewards, next_states, dones of the given indices. states are one-hot, (batch_size, 4, 4, layer_count)
+                 or uint8 exponent boards, (batch_size, 4, 4) if compact
+        """
+        states = self.states[indices]
+        actions = self.actions[indices]
+        next_states = self.next_states[indices]
+
+        # Augmentation is done here instead of storing every symmetric copy
+        if self.action_swap is not None:
+            transforms = np.random.randint(0, 8, size=len(indices))
+
+            states = symmetric_transform(states, transforms)
+            next_states = symmetric_transform(next_states, transforms)
+            actions = self.action_swap[actions, transforms]
+
+        if not compact:
+            states = one_hot_exponents(states, self.layer_count)
+            next_states = one_hot_exponents(next_states, self.layer_count)
+
+        return states, actions, self.rewards[indices], next_states, self.dones[indices]
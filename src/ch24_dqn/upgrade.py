@@ -1,30 +1,21 @@
-import gym_2048
-import gym
 import numpy as np
 import tensorflow as tf
 import math
 import random
 import matplotlib.pyplot as plt
+from ch24_dqn.replay_memory import *
+from ch24_dqn.board_encoder import *
+from ch24_dqn.game_2048 import *
+from ch24_dqn.dqn_trainer import *
 
-env = gym.make('2048-v0')
+env = Game2048Env()
 
 layer_count = 12  # 2^1 to 2^11, 0
-table: dict = {2 ** i: i for i in range(layer_count)}
 
 
 # Preprocess game state as one-hot
 def preprocess(obs):
-    x = np.zeros((4, 4, layer_count))
-
-    for i in range(4):
-        for j in range(4):
-            if obs[i, j] > 0:
-                v = min(obs[i, j], 2 ** (layer_count - 1))
-                x[i, j, table[v]] = 1
-            else:
-                x[i, j, 0] = 1
-
-    return x
+    return encode_boards(obs, layer_count)
 
 
 # Define model. CNN.
@@ -61,87 +52,39 @@ target_model.load_weights('../dqn_weights/dqn_weights_target')
 
 gamma = 0.9
 batch_size = 512
-max_memory = batch_size * 64  # batches per epoch would be 64
-replay_memory = []
+max_memory = batch_size * 8  # batches per epoch would be 8
 
 action_swap_array = [[0, 0, 2, 2, 1, 3, 1, 3],
                      [1, 3, 1, 3, 0, 0, 2, 2],
                      [2, 2, 0, 0, 3, 1, 3, 1],
                      [3, 1, 3, 1, 2, 2, 0, 0]]
 
+# Image reinforcement, each sampled transition is flipped or transposed randomly with the action swapped accordingly
+replay_memory = ReplayMemory(max_memory, layer_count, action_swap=action_swap_array)
+symmetry_count = 8  # Number of passes over the memory per training, same amount of training as storing all 8 symmetric copies
+
+
+# Soft target update (Polyak averaging) after every train step instead of copying Q to Q' every 4 trainings
+USE_SOFT_UPDATE = False
+tau = 0.01
 
-# Append transition with image reinforcement
-def append_sample(state, action, reward, next_state, done):
-    g0 = state
-    g1 = g0[::-1, :, :]
-    g2 = g0[:, ::-1, :]
-    g3 = g2[::-1, :, :]
-    r0 = state.swapaxes(0, 1)
-    r1 = r0[::-1, :, :]
-    r2 = r0[:, ::-1, :]
-    r3 = r2[::-1, :, :]
-
-    g00 = next_state
-    g10 = g00[::-1, :, :]
-    g20 = g00[:, ::-1, :]
-    g30 = g20[::-1, :, :]
-    r00 = next_state.swapaxes(0, 1)
-    r10 = r00[::-1, :, :]
-    r20 = r00[:, ::-1, :]
-    r30 = r20[::-1, :, :]
-
-    states = [g0, g1, g2, g3, r0, r1, r2, r3]
-    next_states = [g00, g10, g20, g30, r00, r10, r20, r30]
-
-    for i in range(8):
-        replay_memory.append([
-            states[i],
-            action_swap_array[action][i],
-            reward,
-            next_states[i],
-            done
-        ])
+trainer = DQNTrainer(model, target_model, gamma, layer_count, tau=tau if USE_SOFT_UPDATE else None)
+
+
+# Append transition : (state, action, reward, next_state, done)
+def append_sample(s0, a, r, s1, d):
+    replay_memory.append(s0, a, r, s1, d)
 
 
 def train_model():
-    np.random.shuffle(replay_memory)
-
-    # Number of batches per epoch
-    len = max_memory // batch_size
-
-    for k in range(len):
-        # batch_size * (s0, a, r, s1, d)
-        mini_batch = replay_memory[k * batch_size:(k + 1) * batch_size]
-
-        states = np.zeros((batch_size, 4, 4, layer_count))
-        actions = []
-        rewards = []
-        next_states = np.zeros((batch_size, 4, 4, layer_count))
-        dones = []
-
-        # Accumulate all data from mini-batch to train
-        for i in range(batch_size):
-            states[i] = mini_batch[i][0]
-            actions.append(mini_batch[i][1])
-            rewards.append(mini_batch[i][2])
-            next_states[i] = mini_batch[i][3]
-            dones.append(mini_batch[i][4])
-
-        # DQN Returns predicted Q value
-        # batch_size * (q_left, q_up, q_right, q_down)
-        answer = model.predict(states)
-        target = target_model.predict(next_states)
-
-        # Generate y-labels to train
-        # Gradient descent step on loss of (y - Q(s, a|θ))^2
-        for i in range(batch_size):
-            # Reusing variable 'answer' as y-label
-            if dones[i]:
-                answer[i][actions[i]] = rewards[i]
-            else:
-                answer[i][actions[i]] = rewards[i] + gamma * np.amax(target[i])
-
-        model.fit(states, answer, batch_size=batch_size, epochs=1, verbose=0)
+    for _ in range(symmetry_count):
+        train_epoch()
+
+
+def train_epoch():
+    # batch_size * (s0, a, r, s1, d), uint8 exponent boards
+    for states, actions, rewards, next_states, dones in replay_memory.batches(batch_size, compact=True):
+        trainer.train_step(states, actions, rewards, next_states, dones)
 
 
 def softmax(logits):
@@ -179,7 +122,7 @@ for i in range(max_episodes):
 
         # Select action with ε-greedy policy
         if random.random() < epsilon:
-            action = env.action_space.sample()
+            action = np.random.randint(4)
         else:
             x = preprocess(prev_obs)
             q_logits = model.predict(np.expand_dims(x, axis=0))[0]
@@ -209,17 +152,17 @@ for i in range(max_episodes):
         reward += np.count_nonzero(prev_obs) - np.count_nonzero(obs) + 1
 
         # Store transition to replay memory
-        append_sample(preprocess(prev_obs), action, reward, preprocess(obs), done)
+        append_sample(prev_obs, action, reward, obs, done)
 
         # Start train when train data fully filled
         if len(replay_memory) >= max_memory:
             train_model()
-            replay_memory = []
+            replay_memory.clear()
 
             train_count += 1
-            # Every 4 steps, Reset Q'=Q
-            if train_count % 4 == 0:
-                target_model.set_weights(model.get_weights())
+            # Every 4 steps, Reset Q'=Q, unless Q' is already updated softly
+            if not USE_SOFT_UPDATE and train_count % 4 == 0:
+                trainer.update_target()
 
         prev_obs = obs
 
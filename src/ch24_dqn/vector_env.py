@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class VectorEnv:
+    def __init__(self, make_env, num_envs):
+        """
+        Steps several 2048 environments in lockstep, so actions of every game can be chosen with one forward pass.
+
+        :param make_env: Function which creates a single environment
+        :param num_envs: Number of environments
+        """
+        self.num_envs = num_envs
+        self.envs = [make_env() for _ in range(num_envs)]
+
+    def reset(self):
+        """
+        :return: Boards of every environment, shape == (num_envs, 4, 4)
+        """
+        return np.array([env.reset() for env in self.envs])
+
+    def reset_at(self, i):
+        """
+        Reset a single finished environment, the others keep playing.
+
+        :return: Board of the environment i, shape == (4, 4)
+        """
+        return np.asarray(self.envs[i].reset())
+
+    def step(self, actions):
+        """
+        :param actions: shape == (num_envs,)
+        :return: obs, shape == (num_envs, 4, 4), rewards, shape == (num_envs,), dones, shape == (num_envs,)
+        """
+        obs = []
+        rewards = []
+        dones = []
+
+        for env, action in zip(self.envs, actions):
+            o, r, d, _ = env.step(action)
+            obs.append(o)
+            rewards.append(r)
+            dones.append(d)
+
+        return np.array(obs), np.array(rewards, dtype=np.float32), np.array(dones, dtype=np.bool_)
+
+
+def select_actions(q_values, moving_dir, epsilon):
+    """
+    Batched ε-greedy action selection.
+    Greedy actions never pick a direction which is known not to move the board (moving_dir == 0).
+
+    :param q_values: shape == (num_envs, 4)
+    :param moving_dir: shape == (num_envs, 4), 1 for directions which are not known to be invalid
+    :param epsilon: Probability of a random action
+    :return: shape == (num_envs,)
+    """
+    num_envs = q_values.shape[0]
+
+    greedy = np.argmax(np.where(moving_dir > 0, q_values, -np.inf), axis=1)
+    random_actions = np.random.randint(0, 4, size=num_envs)
+
+    return np.where(np.random.random(num_envs) < epsilon, random_actions, greedy)
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import random
+import uuid
+import numpy as np
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CheckpointService:
+    def __init__(self, directory, max_to_keep=5, legacy_epochs_per_checkpoint=None, **trackables):
+        """
+        Checkpoints written in the background, with the training state stored explicitly.
+
+        save() snapshots every variable into an in-memory checkpoint (ram:// file system), which takes about as long as copying the variables,
+        and a background thread writes the snapshot to directory while training continues.
+        Checkpoints have the same format and naming (ckpt-N) as tf.train.CheckpointManager, so they restore the same way.
+        Besides the trackables, each checkpoint holds the global step, the epoch and the TF global random generator,
+        NumPy and Python random states are stored next to it in ckpt-N.rng.json.
+        Pass a tf.data iterator as a trackable to store the position in the dataset too.
+        Metrics are appended to metrics.jsonl, one JSON object per line.
+
+        :param directory: Where the checkpoints are stored
+        :param max_to_keep: Number of checkpoints to keep
+        :param legacy_epochs_per_checkpoint: Checkpoints of tf.train.CheckpointManager don't store the epoch,
+                                             if given the epoch of such a checkpoint is ckpt number * legacy_epochs_per_checkpoint
+        :param trackables: Models, optimizers, iterators to checkpoint, as in tf.train.Checkpoint
+        """
+        # Absolute, so saved paths, pruning and the 'checkpoint' state file don't depend on the working directory
+        self.directory = os.path.abspath(directory)
+        self.max_to_keep = max_to_keep
+        self.legacy_epochs_per_checkpoint = legacy_epochs_per_checkpoint
+
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+        self.checkpoint = tf.train.Checkpoint(step=self.step, epoch=self.epoch, rng=tf.random.get_global_generator(), **trackables)
+
+        self.metrics_file = os.path.join(self.directory, 'metrics.jsonl')
+        self.snapshot_directory = 'ram://checkpoint_service/' + uuid.uuid4().hex
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        state = tf.train.get_checkpoint_state(self.directory)
+        self.checkpoints = [os.path.join(self.directory, p) for p in state.all_model_checkpoint_paths] if state is not None else []
+        self.save_count = max([self.checkpoint_number(p) for p in self.checkpoints], default=0)
+
+        self.in_memory_snapshots = self.ram_file_system_available()
+        if not self.in_memory_snapshots:
+            print('ram:// file system is not available, checkpoints are written synchronously')
+
+        self.writer = ThreadPoolExecutor(1)
+        self.pending = None
+
+    def ram_file_system_available(self):
+        try:
+            tf.io.gfile.makedirs(self.snapshot_directory)
+            return True
+        except (tf.errors.OpError, NotImplementedError):
+            return False
+
+    @staticmethod
+    def checkpoint_number(path):
+        return int(path.rsplit('-', 1)[-1])
+
+    @property
+    def latest_checkpoint(self):
+        return self.checkpoints[-1] if len(self.checkpoints) > 0 else None
+
+    def restore(self, directory=None):
+        """
+        Restore the latest checkpoint, if any, with the step, epoch and random states.
+
+        :param directory: Restore from another directory, e.g. the chief's, if not None
+        :return: Path of the restored checkpoint or None
+        """
+        path = self.latest_checkpoint if directory is None else tf.train.latest_checkpoint(directory)
+
+        if path is None:
+            return None
+
+        self.checkpoint.restore(path).expect_partial()
+
+        stored = {name.split('/')[0] for name, _ in tf.train.list_variables(path)}
+        if 'epoch' not in stored and self.legacy_epochs_per_checkpoint is not None:
+            self.epoch.assign(self.checkpoint_number(path) * self.legacy_epochs_per_checkpoint)
+
+        rng_file = path + '.rng.json'
+        if os.path.exists(rng_file):
+            with open(rng_file, 'r', encoding='utf-8') as f:
+                rng = json.load(f)
+
+            name, keys, pos, has_gauss, cached_gaussian = rng['numpy']
+            np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+            random.setstate((rng['python'][0], tuple(rng['python'][1]), rng['python'][2]))
+
+        return path
+
+    def save(self, step=None, epoch=None):
+        """
+        Snapshot the variables and write them in the background. Only one write is pending at a time,
+        if the previous one isn't done yet this waits for it first.
+
+        :param step: Global step to store, keeps the current value if None
+        :param epoch: Number of finished epochs to store, keeps the current value if None
+        :return: Path of the new checkpoint
+        """
+        if step is not None:
+            self.step.assign(step)
+        if epoch is not None:
+            self.epoch.assign(epoch)
+
+        self.wait()
+
+        self.save_count += 1
+        path = os.path.join(self.directory, 'ckpt-{}'.format(self.save_count))
+
+        numpy_state = np.random.get_state()
+        rng = {
+            'numpy': [numpy_state[0], numpy_state[1].tolist()] + [numpy_state[i] for i in range(2, 5)],
+            'python': random.getstate(),
+        }
+
+        if self.in_memory_snapshots:
+            snapshot = self.checkpoint.write(self.snapshot_directory + '/ckpt-{}'.format(self.save_count))
+            self.pending = self.writer.submit(self.write_snapshot, snapshot, path, rng)
+        else:
+            self.checkpoint.write(path)
+            self.finish(path, rng)
+
+        return path
+
+    def write_snapshot(self, snapshot, path, rng):
+        for file in tf.io.gfile.glob(snapshot + '.*'):
+            tf.io.gfile.copy(file, path + file[len(snapshot):], overwrite=True)
+            tf.io.gfile.remove(file)
+
+        self.finish(path, rng)
+
+    def finish(self, path, rng):
+        with open(path + '.rng.json', 'w', encoding='utf-8') as f:
+            json.dump(rng, f)
+
+        self.checkpoints.append(path)
+
+        while len(self.checkpoints) > self.max_to_keep:
+            for file in tf.io.gfile.glob(self.checkpoints.pop(0) + '.*'):
+                tf.io.gfile.remove(file)
+
+        # Same 'checkpoint' state file as tf.train.CheckpointManager, read by tf.train.latest_checkpoint()
+        # A copy, update_checkpoint_state rewrites the list it gets to relative paths in place
+        tf.compat.v1.train.update_checkpoint_state(self.directory, path, list(self.checkpoints))
+
+    def wait(self):
+        """
+        Wait for the pending background write, call this before exiting.
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def log_metrics(self, step, epoch, **metrics):
+        """
+        Append one line of metrics to metrics.jsonl, with the step, epoch and time. The log is never rewritten.
+        """
+        record = {'step': int(step), 'epoch': int(epoch), 'time': time.time()}
+        record.update({key: float(value) for key, value in metrics.items()})
+
+        with open(self.metrics_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def read_metrics(self, name):
+        """
+        :return: Every logged value of the metric, in logging order
+        """
+        if not os.path.exists(self.metrics_file):
+            return []
+
+        with open(self.metrics_file, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        return [r[name] for r in records if name in r]
@@ -0,0 +1,240 @@
+import os
+import re
+import csv
+import json
+import numpy as np
+
+# Caption sources
+COCO_TRAIN = 0
+COCO_VAL = 1
+FLICKR = 2
+
+# Image file name of each source, formatted with the image id
+IMAGE_FILE_NAMES = {
+    COCO_TRAIN: 'COCO_train2014_{:012d}.jpg',
+    COCO_VAL: 'COCO_val2014_{:012d}.jpg',
+    FLICKR: '{:d}.jpg',
+}
+
+_ARRAY_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def iter_json_array(path, key, chunk_size=1 << 20):
+    """
+    Stream the elements of the array 'key' of a JSON file, one element at a time, without loading the whole file.
+    Elements must be JSON objects, e.g. the 'annotations' of a COCO annotation file.
+    """
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+
+        # Seek to the beginning of the array
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError('{} has no array named {}'.format(path, key))
+
+            buffer += chunk
+            match = array_start.search(buffer)
+
+            if match is not None:
+                buffer = buffer[match.end():]
+                break
+
+            # Keep the tail, the key may be split between two chunks
+            buffer = buffer[-(len(key) + 64):]
+
+        pos = 0
+        while True:
+            pos = _ARRAY_SEPARATOR.match(buffer, pos).end()
+
+            if pos < len(buffer):
+                if buffer[pos] == ']':
+                    return
+
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The element is split between two chunks
+                    element = None
+
+                # An element ending exactly at the end of the buffer may still be incomplete, so read more first
+                if element is not None and end < len(buffer):
+                    yield element
+                    pos = end
+                    continue
+
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError('{} ended inside the array {}'.format(path, key))
+
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def iter_coco_captions(annotation_file):
+    """
+    :return: Iterator of (image_id, caption), in the order of the annotation file
+    """
+    for annotation in iter_json_array(annotation_file, 'annotations'):
+        # ex : {'image_id': 318556, 'id': 48, 'caption': 'A very clean and well decorated empty bathroom'}
+        yield annotation['image_id'], annotation['caption']
+
+
+def iter_flickr_captions(results_file):
+    """
+    :param results_file: results.csv of Flickr30k, 'image_name| comment_number| comment' per line
+    :return: Iterator of (image_id, caption), rows without a caption are skipped
+    """
+    with open(results_file, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter='|')
+        next(reader)  # Header
+
+        for row in reader:
+            if len(row) < 3 or len(row[2].strip()) == 0:
+                continue
+
+            image_name = row[0].strip()
+            image_id = int(os.path.splitext(image_name)[0])
+
+            if IMAGE_FILE_NAMES[FLICKR].format(image_id) != image_name:
+                raise ValueError('Unexpected Flickr image name: {}'.format(image_name))
+
+            yield image_id, row[2].strip()
+
+
+def iter_captions(source, annotation_file):
+    if source == FLICKR:
+        return iter_flickr_captions(annotation_file)
+
+    return iter_coco_captions(annotation_file)
+
+
+class CaptionIndex:
+    def __init__(self, directory, annotation_files):
+        """
+        Columnar index of every caption of the annotation files, built once by streaming the files and reloaded from disk afterwards.
+        Columns are image_ids, sources, and caption_offsets into the utf-8 bytes of every caption, so caption i is
+        caption_bytes[caption_offsets[i]:caption_offsets[i + 1]]. Captions are in the order of annotation_files and of each file.
+        The index is built again when an annotation file changes.
+
+        :param directory: Where the index is stored
+        :param annotation_files: List of (source, path), COCO annotation json or Flickr results.csv
+        """
+        self.directory = directory
+        self.annotation_files = [(source, os.path.abspath(path)) for source, path in annotation_files]
+
+        self.metadata_file = os.path.join(directory, 'metadata.json')
+
+        os.makedirs(directory, exist_ok=True)
+
+        if not self.is_up_to_date():
+            self.build()
+
+        self.image_ids = np.load(self.column_path('image_ids'))
+        self.sources = np.load(self.column_path('sources'))
+        self.caption_offsets = np.load(self.column_path('caption_offsets'))
+        self.caption_bytes = np.load(self.column_path('caption_bytes'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def column_path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def file_metadata(self):
+        return [[source, path, os.path.getsize(path), os.path.getmtime(path)] for source, path in self.annotation_files]
+
+    def is_up_to_date(self):
+        if not os.path.exists(self.metadata_file):
+            return False
+
+        with open(self.metadata_file, 'r', encoding='utf-8') as f:
+            return json.load(f) == self.file_metadata()
+
+    def build(self):
+        image_ids = []
+        sources = []
+        lengths = []
+        caption_bytes = bytearray()
+
+        for source, path in self.annotation_files:
+            print('Indexing captions of {}'.format(path))
+
+            for image_id, caption in iter_captions(source, path):
+                encoded = caption.encode('utf-8')
+
+                image_ids.append(image_id)
+                sources.append(source)
+                lengths.append(len(encoded))
+                caption_bytes += encoded
+
+        caption_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        caption_offsets[1:] = np.cumsum(lengths)
+
+        np.save(self.column_path('image_ids'), np.array(image_ids, dtype=np.int64))
+        np.save(self.column_path('sources'), np.array(sources, dtype=np.uint8))
+        np.save(self.column_path('caption_offsets'), caption_offsets)
+        np.save(self.column_path('caption_bytes'), np.frombuffer(bytes(caption_bytes), dtype=np.uint8))
+
+        # Written last, an interrupted build is built again on the next run
+        with open(self.metadata_file, 'w', encoding='utf-8') as f:
+            json.dump(self.file_metadata(), f)
+
+    def select(self, max_captions_per_image=None, sources=None):
+        """
+        :param max_captions_per_image: Keep only the first captions of each image
+        :param sources: Keep only the captions of these sources
+        :return: Indices of the selected captions, in index order
+        """
+        selected = np.ones(len(self), dtype=np.bool_)
+
+        if sources is not None:
+            selected &= np.isin(self.sources, list(sources))
+
+        if max_captions_per_image is not None:
+            # Rank of each caption among the captions of its image, in index order
+            keys = (self.sources.astype(np.int64) << 48) | self.image_ids
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+
+            group_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            group_sizes = np.diff(np.r_[group_starts, len(keys)])
+
+            rank = np.empty(len(keys), dtype=np.int64)
+            rank[order] = np.arange(len(keys)) - np.repeat(group_starts, group_sizes)
+
+            selected &= rank < max_captions_per_image
+
+        return np.flatnonzero(selected)
+
+    @staticmethod
+    def shuffle(indices, random_state):
+        """
+        Same permutation as sklearn.utils.shuffle(..., random_state=random_state)
+        """
+        permutation = np.arange(len(indices))
+        np.random.RandomState(random_state).shuffle(permutation)
+
+        return indices[permutation]
+
+    def captions(self, indices):
+        """
+        :return: List of captions
+        """
+        data = bytes(self.caption_bytes)
+        starts = self.caption_offsets[indices].tolist()
+        ends = self.caption_offsets[np.asarray(indices) + 1].tolist()
+
+        return [data[s:e].decode('utf-8') for s, e in zip(starts, ends)]
+
+    def image_paths(self, indices, image_folders):
+        """
+        :param image_folders: Image folder of each source, e.g. {COCO_TRAIN: PATH_COCO_TRAIN}
+        :return: List of image paths
+        """
+        formats = {source: image_folders[source] + file_name for source, file_name in IMAGE_FILE_NAMES.items() if source in image_folders}
+
+        return [formats[source].format(image_id) for source, image_id in zip(self.sources[indices].tolist(), self.image_ids[indices].tolist())]
@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+
+class CaptionTokens:
+    def __init__(self, directory, captions, num_words, oov_token='<unk>', filters='!"#$%&()*+.,-/:;=?@[\\]^_`{|}~\t\n'):
+        """
+        Disk cache of the fitted Keras tokenizer and of the tokenized captions, keyed by the hash of the captions and the tokenizer options.
+        Tokens are stored ragged, ids.npy with every caption concatenated as int16 and offsets.npy where caption i is ids[offsets[i]:offsets[i + 1]].
+        A different caption corpus gets its own sub directory, so it never reuses a stale cache.
+
+        :param directory: Where the caches are stored
+        :param captions: List of captions
+        :param num_words: See tf.keras.preprocessing.text.Tokenizer
+        :param oov_token: See tf.keras.preprocessing.text.Tokenizer
+        :param filters: See tf.keras.preprocessing.text.Tokenizer
+        """
+        key = hashlib.sha1(json.dumps([num_words, oov_token, filters]).encode('utf-8'))
+        for caption in captions:
+            key.update(caption.encode('utf-8') + b'\n')
+
+        self.directory = os.path.join(directory, key.hexdigest()[:16])
+
+        self.tokenizer_file = os.path.join(self.directory, 'tokenizer.json')
+        self.ids_file = os.path.join(self.directory, 'ids.npy')
+        self.offsets_file = os.path.join(self.directory, 'offsets.npy')
+
+        if not os.path.exists(self.tokenizer_file):
+            self.build(captions, num_words, oov_token, filters)
+
+        with open(self.tokenizer_file, 'r', encoding='utf-8') as f:
+            self.tokenizer = tf.keras.preprocessing.text.tokenizer_from_json(f.read())
+
+        self.ids = np.load(self.ids_file)
+        self.offsets = np.load(self.offsets_file)
+
+        self.lengths = np.diff(self.offsets)
+        self.max_length = int(self.lengths.max()) if len(self.lengths) > 0 else 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def build(self, captions, num_words, oov_token, filters):
+        print('Tokenizing {} captions'.format(len(captions)))
+
+        tokenizer = tf.keras.preprocessing.text.Tokenizer(num_words=num_words, oov_token=oov_token, filters=filters)
+        tokenizer.fit_on_texts(captions)
+
+        sequences = tokenizer.texts_to_sequences(captions)
+        assert num_words is not None and num_words <= np.iinfo(np.int16).max + 1, 'Token ids must fit in int16'
+
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in sequences])
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        np.save(self.ids_file, np.fromiter((t for s in sequences for t in s), dtype=np.int16, count=offsets[-1]))
+        np.save(self.offsets_file, offsets)
+
+        # Written last, an interrupted build is built again on the next run
+        with open(self.tokenizer_file, 'w', encoding='utf-8') as f:
+            f.write(tokenizer.to_json())
+
+    def sequence(self, i):
+        """
+        :return: Token ids of caption i
+        """
+        return self.ids[self.offsets[i]:self.offsets[i + 1]].astype(np.int32)
+
+    def ragged(self):
+        """
+        :return: Every caption as a tf.RaggedTensor, shape == (len(self), None), int32
+        """
+        return tf.RaggedTensor.from_row_splits(tf.cast(tf.constant(self.ids), tf.int32), tf.constant(self.offsets))
+
+    def batch_padder(self):
+        """
+        tf.data map function, caption indices of a batch -> captions padded only to the longest caption of the batch
+        """
+        ragged = self.ragged()
+
+        def pad(indices):
+            return tf.gather(ragged, indices).to_tensor()  # (batch_size, max length in the batch)
+
+        return pad
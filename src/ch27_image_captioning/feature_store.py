@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+
+class FeatureStore:
+    def __init__(self, directory, feature_shape, shard_size=4096, dtype='float32'):
+        """
+        Disk cache of extracted image features.
+        Features are stored in large memory-mapped shards (shard-00000.npy, ...) instead of one .npy file per image,
+        and index.txt maps each image path to its row, one path per line.
+
+        :param directory: Where the shards and the index are stored
+        :param feature_shape: Shape of the feature of a single image, e.g. (64, 2048)
+        :param shard_size: Number of images per shard
+        :param dtype: Storage dtype of the features
+        """
+        self.directory = directory
+        self.feature_shape = tuple(feature_shape)
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+
+        self.index_file = os.path.join(directory, 'index.txt')
+        self.shards = []
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Image path -> row
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                for row, line in enumerate(f):
+                    self.index[line.rstrip('\n')] = row
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_path):
+        return image_path in self.index
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, 'shard-{:05d}.npy'.format(shard))
+
+    def open_shard(self, shard, writable=False):
+        while len(self.shards) <= shard:
+            self.shards.append(None)
+
+        if self.shards[shard] is None or (writable and not self.shards[shard].flags.writeable):
+            path = self.shard_path(shard)
+
+            if os.path.exists(path):
+                self.shards[shard] = np.load(path, mmap_mode='r+' if writable else 'r')
+            else:
+                self.shards[shard] = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.shard_size,) + self.feature_shape)
+
+        return self.shards[shard]
+
+    def append(self, features, image_paths):
+        """
+        Write a batch of features at the end of the store.
+        The index is written after the features are flushed, so an interrupted run never indexes a missing feature.
+
+        :param features: shape == (batch_size,) + feature_shape
+        :param image_paths: Image path of each feature
+        """
+        row = len(self.index)
+        i = 0
+
+        while i < len(image_paths):
+            shard, offset = divmod(row + i, self.shard_size)
+            count = min(len(image_paths) - i, self.shard_size - offset)
+
+            data = self.open_shard(shard, writable=True)
+            data[offset:offset + count] = features[i:i + count]
+            data.flush()
+
+            i += count
+
+        with open(self.index_file, 'a', encoding='utf-8') as f:
+            for image_path in image_paths:
+                f.write(image_path + '\n')
+                self.index[image_path] = len(self.index)
+
+    def write_features(self, image_paths, load_image, extract, batch_size=64):
+        """
+        Extract and store the features of the images which are not stored yet.
+        Running this again continues from where the previous run stopped.
+
+        :param image_paths: Image paths to extract
+        :param load_image: image_path -> (model inputs..., image_path)
+        :param extract: (model inputs...) -> features, shape == (batch_size,) + feature_shape
+        :param batch_size: Batch size of the feature extractor
+        """
+        pending = [p for p in image_paths if p not in self.index]
+
+        if len(pending) == 0:
+            return
+
+        print('Extracting features of {} images, {} already stored'.format(len(pending), len(self.index)))
+
+        dataset = tf.data.Dataset.from_tensor_slices(pending)
+        dataset = dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(batch_size)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        for batch in tqdm(dataset, total=(len(pending) + batch_size - 1) // batch_size):
+            *inputs, paths = batch
+            features = extract(*inputs)
+
+            self.append(np.asarray(features, dtype=self.dtype), [p.decode('utf-8') for p in paths.numpy()])
+
+    def rows(self, image_paths):
+        """
+        :return: Row of each image path, shape == (len(image_paths),)
+        """
+        return np.array([self.index[p] for p in image_paths], dtype=np.int64)
+
+    def gather_rows(self, rows):
+        """
+        Read the features of the given rows straight from the memory-mapped shards.
+        Each run of consecutive rows of a shard is read as a slice (a view of the memmap, no copy) and copied once into the batch.
+        A batch which is a single run of a float32 store is returned as the view itself.
+
+        :return: shape == (len(rows),) + feature_shape, float32
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if len(rows) == 0:
+            return np.empty((0,) + self.feature_shape, dtype=np.float32)
+
+        # Runs of consecutive rows in the same shard, [starts[i], ends[i]) of the batch
+        breaks = np.flatnonzero((np.diff(rows) != 1) | (np.diff(rows // self.shard_size) != 0)) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(rows)]])
+
+        if len(starts) == 1 and self.dtype == np.float32:
+            shard, offset = divmod(int(rows[0]), self.shard_size)
+            return self.open_shard(shard)[offset:offset + len(rows)]
+
+        result = np.empty((len(rows),) + self.feature_shape, dtype=np.float32)
+
+        for start, end in zip(starts, ends):
+            shard, offset = divmod(int(rows[start]), self.shard_size)
+            result[start:end] = self.open_shard(shard)[offset:offset + end - start]
+
+        return result
+
+    def gather(self, rows):
+        """
+        tf.data friendly version of gather_rows(). Map this on batches of rows, so there is one call per batch.
+        """
+        features = tf.numpy_function(self.gather_rows, [rows], tf.float32)
+        features.set_shape(rows.shape.concatenate(self.feature_shape))
+
+        return features
@@ -1,17 +1,19 @@
 import tensorflow as tf
 
 from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
 
 import numpy as np
 import os
-import json
 import time
 import matplotlib.pyplot as plt
 from PIL import Image
-import pandas as pd
 from tqdm import tqdm
 from ch27_image_captioning.models import *
+from ch27_image_captioning.feature_store import *
+from ch27_image_captioning.caption_index import *
+from ch27_image_captioning.caption_tokens import *
+import tensorflow_addons as tfa
+from ch25_checkpoints.checkpoint_service import *
 
 gpus = tf.config.experimental.list_physical_devices('GPU')
 if gpus:
@@ -69,72 +71,19 @@ else:
 
 PATH_FLICKR = BASE_PATH + '/flickr30k_images/flickr30k_images/'
 
-# Read the json file
-with open(annotation_train, 'r') as f:
-    annotations_train = json.load(f)
+# Captions of every annotation file are streamed once into an index on disk, later runs only load the index
+caption_index = CaptionIndex('./captions/coco_flickr', [(COCO_TRAIN, annotation_train), (COCO_VAL, annotation_val), (FLICKR, PATH_FLICKR + 'results.csv')])
 
-with open(annotation_val, 'r') as f:
-    annotations_val = json.load(f)
-
-# Store captions and image names in vectors
-all_captions = []
-all_img_name_vector = []
-
-dup = [False] * 600000
-
-# Append COCO train captions
-for annot in annotations_train['annotations']:  # ex : {'image_id': 318556, 'id': 48, 'caption': 'A very clean and well decorated empty bathroom'}
-    caption = '<start> ' + annot['caption'] + ' <end>'
-    image_id = annot['image_id']
-
-    # if dup[image_id]:
-    #     continue
-    # dup[image_id] = True
-
-    full_image_path = PATH_COCO_TRAIN + 'COCO_train2014_' + '%012d.jpg' % image_id
-
-    all_img_name_vector.append(full_image_path)
-    all_captions.append(caption)
-
-# Append COCO val captions
-for annot in annotations_val['annotations']:
-    caption = '<start> ' + annot['caption'] + ' <end>'
-    image_id = annot['image_id']
-
-    # if dup[image_id]:
-    #     continue
-    # dup[image_id] = True
-
-    full_image_path = PATH_COCO_VAL + 'COCO_val2014_' + '%012d.jpg' % image_id
-
-    all_img_name_vector.append(full_image_path)
-    all_captions.append(caption)
-
-# print(len(all_captions), len(all_img_name_vector))  # 123287
-
-flickr_dataset = pd.read_csv(PATH_FLICKR + 'results.csv', delimiter='|')
-flickr_dataset = flickr_dataset.to_numpy()
-
-# Append Flickr3k captions
-for image_name, comment_number, comment in flickr_dataset:
-    if type(comment) != str:
-        continue
-
-    # if int(comment_number) != 0:
-    #     continue
-
-    caption = '<start> ' + str(comment) + ' <end>'
-
-    full_image_path = PATH_FLICKR + image_name
-    all_img_name_vector.append(full_image_path)
-    all_captions.append(caption)
-
-# print(len(all_captions), len(all_img_name_vector))  # 123287
-# assert False
+# Indices of the captions to train with
+selected = caption_index.select()
 
 # Shuffle captions and image_names together
 # Set a random state, which always guaranteed to have the same shuffle
-train_captions, img_name_vector = shuffle(all_captions, all_img_name_vector, random_state=1)
+selected = CaptionIndex.shuffle(selected, random_state=1)
+
+train_captions = ['<start> ' + caption + ' <end>' for caption in caption_index.captions(selected)]
+img_name_vector = caption_index.image_paths(selected, {COCO_TRAIN: PATH_COCO_TRAIN, COCO_VAL: PATH_COCO_VAL, FLICKR: PATH_FLICKR})
+all_captions = train_captions
 
 # Select the first N captions from the shuffled set
 # num_examples = 1024
@@ -167,25 +116,23 @@ image_features_extract_model = tf.keras.Model(new_input, hidden_layer)
 # Make unique with sorted(set)
 encode_train = sorted(set(img_name_vector))
 
-image_dataset = tf.data.Dataset.from_tensor_slices(encode_train)
-image_dataset = image_dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(16)
 
-# Disk-caching the features extracted from InceptionV3
-# You just have got to do this once
-# for img, path in tqdm.tqdm(image_dataset):
-#     batch_features = image_features_extract_model(img)
-#     batch_features = tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3]))
-#
-#     for bf, p in zip(batch_features, path):
-#         path_of_feature = p.numpy().decode("utf-8")
-#         np.save(path_of_feature, bf.numpy())
+def extract_features(img):
+    batch_features = image_features_extract_model(img)
+    return tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3]))
+
+
+# Disk-caching the features extracted from InceptionV3 into memory-mapped shards
+# Only the images which are not stored yet are extracted, so an interrupted run continues from where it stopped
+feature_store = FeatureStore('./features/inception_v3', feature_shape=(64, 2048))
+feature_store.write_features(encode_train, load_image, extract_features, batch_size=64)
 
 
 # Choose the top 5000 words from the vocabulary
 num_words = 20000
-tokenizer = tf.keras.preprocessing.text.Tokenizer(num_words=num_words, oov_token="<unk>", filters='!"#$%&()*+.,-/:;=?@[\]^_`{|}~ ')
-tokenizer.fit_on_texts(train_captions)
-# train_seqs = tokenizer.texts_to_sequences(train_captions)
+# The tokenizer and the tokenized captions are cached on disk, keyed by the hash of the captions
+caption_tokens = CaptionTokens('./captions/tokens', train_captions, num_words=num_words, oov_token="<unk>", filters='!"#$%&()*+.,-/:;=?@[\]^_`{|}~ ')
+tokenizer = caption_tokens.tokenizer
 
 tokenizer.word_index['<pad>'] = 0
 tokenizer.index_word[0] = '<pad>'
@@ -198,22 +145,13 @@ tokenizer.index_word[0] = '<pad>'
 # print(tokenizer.index_word[5])  # on
 # assert False
 
-# Create the tokenized vectors
-train_seqs = tokenizer.texts_to_sequences(train_captions)
-
-# print(tokenizer.sequences_to_texts(train_seqs[:10]))
-# assert False
-
-# Pad each vector to the max_length of the captions
-# If you do not provide a max_length value, pad_sequences calculates it automatically
-cap_vector = tf.keras.preprocessing.sequence.pad_sequences(train_seqs, padding='post')
-
 # Calculates the max_length, which is used to store the attention weights
-max_length = max(len(t) for t in train_seqs)  # 49
+max_length = caption_tokens.max_length  # 49
 
 # Create training and validation sets using an 80-20 split
+# cap_train, cap_val are caption indices of caption_tokens
 img_name_train, img_name_val, cap_train, cap_val = train_test_split(img_name_vector,
-                                                                    cap_vector,
+                                                                    np.arange(len(caption_tokens)),
                                                                     test_size=0.1,
                                                                     random_state=0)
 
@@ -236,6 +174,10 @@ vocab_size = num_words + 1
 steps_per_epoch = len(img_name_train) // BATCH_SIZE
 steps_per_epoch_val = len(img_name_val) // BATCH_SIZE
 regularization_rate = 0.001
+# 'l2': l2 loss of the weights added to the loss, as before
+# 'decoupled': AdamW, weights decay inside the optimizer update instead of through the loss and its gradients.
+#              Not the same regularization strength as 'l2' under Adam, the decay rate has to be tuned on its own
+WEIGHT_DECAY = 'l2'
 
 # Shape of the vector extracted from InceptionV3 is (64, 2048)
 # These two variables represent that vector shape
@@ -243,35 +185,35 @@ features_shape = 2048
 attention_features_shape = 64
 
 
-# Load the numpy files`
-def map_func(img_name, cap):
-    img_tensor = np.load(img_name.decode('utf-8') + '.npy')
-    return img_tensor, cap
+pad_captions = caption_tokens.batch_padder()
 
 
-dataset = tf.data.Dataset.from_tensor_slices((img_name_train, cap_train))
+# Features are gathered from the feature store once per batch, captions are padded to the longest caption of the batch
+def map_func(rows, cap):
+    return feature_store.gather(rows), pad_captions(cap)
 
-# Use map to load the numpy files in parallel
-dataset = dataset.map(lambda item1, item2:
-                      tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32]),
-                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+dataset = tf.data.Dataset.from_tensor_slices((feature_store.rows(img_name_train), cap_train))
 
 # Shuffle and batch
 dataset = dataset.shuffle(BUFFER_SIZE, reshuffle_each_iteration=True).batch(BATCH_SIZE)
+dataset = dataset.map(map_func, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
 # Validation dataset
-dataset_val = tf.data.Dataset.from_tensor_slices((img_name_val, cap_val))
-dataset_val = dataset_val.map(lambda item1, item2:
-                              tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32]),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+dataset_val = tf.data.Dataset.from_tensor_slices((feature_store.rows(img_name_val), cap_val))
 dataset_val = dataset_val.shuffle(BUFFER_SIZE, reshuffle_each_iteration=True).batch(BATCH_SIZE)
+dataset_val = dataset_val.map(map_func, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 dataset_val = dataset_val.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
 encoder = CNN_Encoder(feature_dim)
 decoder = RNN_Decoder(embedding_dim, rnn_units, fc_units, vocab_size)
 
-optimizer = tf.keras.optimizers.Adam()
+if WEIGHT_DECAY == 'decoupled':
+    # Starting point for tuning, per step decay of regularization_rate * learning_rate
+    optimizer = tfa.optimizers.AdamW(weight_decay=regularization_rate * 1e-3, learning_rate=1e-3)
+else:
+    optimizer = tf.keras.optimizers.Adam()
 loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 
 
@@ -287,89 +229,95 @@ def loss_function(real, pred):
     return tf.reduce_mean(loss_)
 
 
-# Checkpoints
+# Build the models once, so the variables and the weight decay mask (every weight except the biases) are known before training
+encoder(tf.zeros((1, attention_features_shape, features_shape)))
+decoder(tf.zeros((1, 1), dtype=tf.int32), encoder(tf.zeros((1, attention_features_shape, features_shape))), decoder.reset_state(1))
+
+trainable_variables = encoder.trainable_variables + decoder.trainable_variables
+decay_variables = [t for t in trainable_variables if 'bias' not in t.name]
+
+# Checkpoints are written in the background, and hold the epoch and the random states with the models and the optimizer
+# The loss history is appended to checkpoints/train9/metrics.jsonl
 checkpoint_path = "./checkpoints/train9"
-ckpt = tf.train.Checkpoint(encoder=encoder,
-                           decoder=decoder,
-                           optimizer=optimizer)
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=5)
+checkpoints = CheckpointService(checkpoint_path, max_to_keep=5, legacy_epochs_per_checkpoint=EPOCHS_TO_SAVE,
+                                encoder=encoder,
+                                decoder=decoder,
+                                optimizer=optimizer)
 
-start_epoch = 0
-if ckpt_manager.latest_checkpoint:
-    start_epoch = int(ckpt_manager.latest_checkpoint.split('-')[-1]) * EPOCHS_TO_SAVE
-    # restoring the latest checkpoint in checkpoint_path
-    ckpt.restore(ckpt_manager.latest_checkpoint)
+# restoring the latest checkpoint in checkpoint_path
+checkpoints.restore()
+start_epoch = int(checkpoints.epoch.numpy())
 
 
-@tf.function
-def train_step(img_tensor, target):
-    loss = 0
+train_step_signature = [
+    tf.TensorSpec(shape=(None, attention_features_shape, 2048), dtype=tf.float32),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+]
+
 
+def sequence_loss(img_tensor, target, training):
+    """
+    Teacher forced loss summed over the caption tokens, the whole caption is decoded by a single RNN_Decoder.call_sequence()
+    """
     # print(img_tensor) # shape = (240, 64, 2048) = (batch_size, attention_features_shape, features_shape)
     # print(target) # shape = (240, 49) = (batch_size, max_length)
 
     # initializing the hidden state for each batch because the captions are not related from image to image
-    hidden = decoder.reset_state(batch_size=target.shape[0])  # shape = (batch_size, units)
+    hidden = decoder.reset_state(batch_size=tf.shape(target)[0])  # shape = (batch_size, units)
 
-    # (batch_size, '<start>'), shape = (batch_size, 1)
-    dec_input = tf.expand_dims([tokenizer.word_index['<start>']] * target.shape[0], 1)
-
-    with tf.GradientTape() as tape:
-        # Encode InceptionV3 features into embedding vector
-        features = encoder(img_tensor)  # shape = (batch_size, 64, embedding_dim) = (240, 64, 256)
+    # Encode InceptionV3 features into embedding vector
+    features = encoder(img_tensor)  # shape = (batch_size, 64, embedding_dim) = (240, 64, 256)
 
-        # Start from index 1 to jump the start token
-        for i in range(1, target.shape[1]):
-            # passing the features through the decoder
-            # predictions shape = (batch_size, vocab_size)
-            predictions, hidden, _ = decoder(dec_input, features, hidden, training=True)
+    # Using teacher forcing, the input of each step is the previous target token, starting from '<start>'
+    # predictions shape = (batch_size, max_length - 1, vocab_size)
+    predictions, _, _ = decoder.call_sequence(target[:, :-1], features, hidden, training=training)
 
-            loss += loss_function(target[:, i], predictions)
+    # Same as the sum of the per token losses, each averaged over the batch
+    return loss_function(target[:, 1:], predictions) * tf.cast(tf.shape(target)[1] - 1, tf.float32)
 
-            # using teacher forcing
-            dec_input = tf.expand_dims(target[:, i], 1)
 
-        # l2 regularization on weights. Not applied on biases.
-        trainable_variables = encoder.trainable_variables + decoder.trainable_variables
-        loss += tf.reduce_sum([tf.nn.l2_loss(t) for t in trainable_variables if 'bias' not in t.name]) * regularization_rate
+@tf.function
+def l2_term():
+    # l2 regularization on weights. Not applied on biases.
+    return tf.add_n([tf.nn.l2_loss(t) for t in decay_variables]) * regularization_rate
 
-    avg_loss = (loss / int(target.shape[1]))
 
-    gradients = tape.gradient(loss, trainable_variables)
+@tf.function(input_signature=train_step_signature)
+def train_step(img_tensor, target):
+    with tf.GradientTape() as tape:
+        loss = sequence_loss(img_tensor, target, training=True)
 
-    optimizer.apply_gradients(zip(gradients, trainable_variables))
+        if WEIGHT_DECAY == 'l2':
+            loss += l2_term()
 
-    return avg_loss
+    gradients = tape.gradient(loss, trainable_variables)
 
+    avg_loss = (loss / max_length)  # Batches are padded to their own length, so the global max_length keeps the reported loss comparable
 
-@tf.function
-def calc_validation_loss(img_tensor, target):
-    loss = 0
+    if WEIGHT_DECAY == 'decoupled':
+        optimizer.apply_gradients(zip(gradients, trainable_variables), decay_var_list=decay_variables)
+    else:
+        optimizer.apply_gradients(zip(gradients, trainable_variables))
 
-    # print(img_tensor) # shape = (240, 64, 2048) = (batch_size, attention_features_shape, features_shape)
-    # print(target) # shape = (240, 49) = (batch_size, max_length)
+    return avg_loss
 
-    # initializing the hidden state for each batch because the captions are not related from image to image
-    hidden = decoder.reset_state(batch_size=target.shape[0])  # shape = (batch_size, units)
 
-    # (batch_size, '<start>'), shape = (batch_size, 1)
-    dec_input = tf.expand_dims([tokenizer.word_index['<start>']] * target.shape[0], 1)
+def reported_loss(loss):
+    """
+    The reported loss always includes the l2 term, so the curves of both modes are comparable.
+    With decoupled weight decay train_step leaves it out, and it is only computed here, at report time.
+    """
+    if WEIGHT_DECAY == 'decoupled':
+        return loss + l2_term() / max_length
 
-    # Encode InceptionV3 features into embedding vector
-    features = encoder(img_tensor)  # shape = (batch_size, 64, embedding_dim) = (240, 64, 256)
-
-    # Start from index 1 to jump the start token
-    for i in range(1, target.shape[1]):
-        # passing the features through the decoder
-        # predictions shape = (batch_size, vocab_size)
-        predictions, hidden, _ = decoder(dec_input, features, hidden)
+    return loss
 
-        loss += loss_function(target[:, i], predictions)
 
-        # using teacher forcing
-        dec_input = tf.expand_dims(target[:, i], 1)
+@tf.function(input_signature=train_step_signature)
+def calc_validation_loss(img_tensor, target):
+    loss = sequence_loss(img_tensor, target, training=False)
 
-    avg_loss = (loss / int(target.shape[1]))
+    avg_loss = (loss / max_length)  # Batches are padded to their own length, so the global max_length keeps the reported loss comparable
 
     return avg_loss
 
@@ -379,17 +327,6 @@ print('Start training for {} epochs'.format(EPOCHS))
 print('Batch Size = ', BATCH_SIZE)
 print('Steps per epoch = ', steps_per_epoch)
 
-loss_train_plot = []
-loss_val_plot = []
-loss_train_file = checkpoint_path + '/loss_train.npy'
-loss_val_file = checkpoint_path + '/loss_val.npy'
-
-if os.path.exists(loss_train_file):
-    loss_train_plot = np.load(loss_train_file)
-
-if os.path.exists(loss_val_file):
-    loss_val_plot = np.load(loss_val_file)
-
 for epoch in range(EPOCHS):
     start = time.time()
     total_loss = 0
@@ -401,8 +338,9 @@ for epoch in range(EPOCHS):
         total_loss += batch_loss
 
         if batch % REPORT_PER_BATCH == 0:
+            batch_loss = reported_loss(batch_loss)
             print('Epoch {} Batch {}/{} Loss {:.4f}'.format(current_epoch, batch, steps_per_epoch, batch_loss))
-            loss_train_plot = np.append(loss_train_plot, batch_loss)
+            checkpoints.log_metrics(optimizer.iterations, current_epoch - 1, loss=batch_loss)
 
     total_loss_val = 0
 
@@ -411,22 +349,26 @@ for epoch in range(EPOCHS):
         batch_loss_val = calc_validation_loss(img_tensor_val, target_val)
         total_loss_val += batch_loss_val
 
-    print('Epoch {} Loss {:.6f}'.format(current_epoch, total_loss / steps_per_epoch))
-    loss_train_plot = np.append(loss_train_plot, total_loss / steps_per_epoch)
+    # With decoupled weight decay, the l2 term of the weights at the end of the epoch
+    epoch_loss = reported_loss(total_loss / steps_per_epoch)
+
+    print('Epoch {} Loss {:.6f}'.format(current_epoch, epoch_loss))
     print('Epoch {} Validation Loss {:.6f}'.format(current_epoch, total_loss_val / steps_per_epoch_val))
-    loss_val_plot = np.append(loss_val_plot, total_loss_val / steps_per_epoch_val)
+    checkpoints.log_metrics(optimizer.iterations, current_epoch, loss=epoch_loss, val_loss=total_loss_val / steps_per_epoch_val)
 
     print('Time taken for 1 epoch {} sec\n'.format(time.time() - start))
 
     if (epoch + 1) % EPOCHS_TO_SAVE == 0:
-        ckpt_manager.save()
+        checkpoints.save(step=optimizer.iterations, epoch=current_epoch)
 
-val_gap = 2 + steps_per_epoch // REPORT_PER_BATCH
+checkpoints.wait()
+
+loss_train_plot = checkpoints.read_metrics('loss')
+loss_val_plot = checkpoints.read_metrics('val_loss')
 
-np.save(loss_train_file, loss_train_plot)
-np.save(loss_val_file, loss_val_plot)
+val_gap = 2 + steps_per_epoch // REPORT_PER_BATCH
 
-loss_val_plot = np.r_[loss_val_plot[0], loss_val_plot]
+loss_val_plot = np.r_[loss_val_plot[:1], loss_val_plot]
 
 plt.plot(loss_train_plot, 'b', label='train loss')
 plt.plot(np.arange(len(loss_val_plot)) * val_gap, loss_val_plot, 'r--', label='val loss')
@@ -489,7 +431,7 @@ def plot_attention(image, result, attention_plot):
 for it in range(0):
     rid = np.random.randint(0, len(img_name_val))
     image = img_name_val[rid]
-    real_caption = ' '.join([tokenizer.index_word[i] for i in cap_val[rid] if i not in [0]])
+    real_caption = ' '.join([tokenizer.index_word[i] for i in caption_tokens.sequence(cap_val[rid]) if i not in [0]])
     result, attention_plot = evaluate(image)
 
     print('Real Caption:', real_caption)
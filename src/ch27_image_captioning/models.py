@@ -9,6 +9,13 @@ class BahdanauAttention(tf.keras.Model):
         self.V = tf.keras.layers.Dense(1)
 
     def call(self, features, hidden):
+        return self.attend(self.W1(features), features, hidden)
+
+    def attend(self, keys, features, hidden):
+        """
+        Attention with the features already projected by W1, keys == W1(features).
+        The features are the same for every token of a caption, so the projection can be done once per caption.
+        """
         # features(CNN_encoder output) shape == (batch_size, 64, embedding_dim)
 
         # hidden shape == (batch_size, hidden_size) == (batch_size, units)
@@ -17,7 +24,7 @@ class BahdanauAttention(tf.keras.Model):
 
         # Bahdanau Score function = tanh( W1 * key + W2 * query )
         # score shape == (batch_size, 64, hidden_size), Matrix broadcasting works in here
-        score = tf.nn.tanh(self.W1(features) + self.W2(hidden_with_time_axis))
+        score = tf.nn.tanh(keys + self.W2(hidden_with_time_axis))
 
         # attention_weights shape == (batch_size, 64, 1)
         # you get 1 at the last axis because you are applying score to self.V
@@ -63,9 +70,10 @@ class RNN_Decoder(tf.keras.Model):
                                         return_sequences=True,
                                         return_state=True,
                                         recurrent_initializer='glorot_uniform')
-        self.fc1 = tf.keras.layers.Dense(self.fc_units, kernel_regularizer='l2')
+        # Weights are regularized by the training loop, see image_captioning.py
+        self.fc1 = tf.keras.layers.Dense(self.fc_units)
         self.dropout = tf.keras.layers.Dropout(0.1)
-        self.fc2 = tf.keras.layers.Dense(vocab_size, kernel_regularizer='l2')
+        self.fc2 = tf.keras.layers.Dense(vocab_size)
 
         self.attention = BahdanauAttention(self.rnn_units)
 
@@ -100,5 +108,45 @@ class RNN_Decoder(tf.keras.Model):
 
         return x, state, attention_weights
 
+    def call_sequence(self, x, features, hidden, training=False):
+        """
+        Teacher forced decoding of whole captions, same result as calling call() once per token.
+        Each GRU only sees a single step per call() and starts from a zero state, so the only recurrence is the attention query 'hidden'.
+        That loop runs in a single tf.scan, everything else (embedding, attention keys, fc1, fc2) is computed once over the sequence.
+
+        :param x: shape == (batch_size, seq_len), input tokens
+        :param features: shape == (batch_size, 64, embedding_dim)
+        :param hidden: shape == (batch_size, units), initial state
+        :return: predictions, shape == (batch_size, seq_len, vocab_size), last state, attention_weights, shape == (batch_size, seq_len, 64, 1)
+        """
+        keys = self.attention.W1(features)  # (batch_size, 64, units)
+
+        # (seq_len, batch_size, embedding_dim), time major for tf.scan
+        x = tf.transpose(self.embedding(x), [1, 0, 2])
+
+        zero_state = tf.zeros_like(hidden)
+
+        def step(previous, x_t):
+            context_vector, attention_weights = self.attention.attend(keys, features, previous[0])
+
+            x_t = tf.concat([context_vector, x_t], axis=-1)  # (batch_size, embedding_dim + embedding_dim)
+
+            x_t, _ = self.gru1.cell(x_t, [zero_state])
+            x_t, _ = self.gru2.cell(x_t, [zero_state])
+            state, _ = self.gru3.cell(x_t, [zero_state])  # (batch_size, hidden_size)
+
+            return state, attention_weights
+
+        states, attention_weights = tf.scan(step, x, initializer=(hidden, tf.zeros_like(features[:, :, :1])))
+
+        states = tf.transpose(states, [1, 0, 2])  # (batch_size, seq_len, hidden_size)
+        attention_weights = tf.transpose(attention_weights, [1, 0, 2, 3])  # (batch_size, seq_len, 64, 1)
+
+        x = self.fc1(states)  # (batch_size, seq_len, fc_units)
+        x = self.dropout(x, training=training)
+        x = self.fc2(x)  # (batch_size, seq_len, vocab)
+
+        return x, states[:, -1], attention_weights
+
     def reset_state(self, batch_size):
         return tf.zeros((batch_size, self.rnn_units))
@@ -1,21 +1,38 @@
+import os
 import time
+import tempfile
 import matplotlib.pyplot as plt
 from ch28_cycle_gan.model import *
 from ch28_cycle_gan.dataset_loader import *
+from ch28_cycle_gan.distribute import *
+from ch25_checkpoints.checkpoint_service import *
 import tqdm
 
+# Data parallel training, every replica trains on its own BATCH_SIZE images and the gradients are averaged
+# None: Single device
+# 'devices': NUM_REPLICAS logical CPU devices in this process
+# 'workers': One replica per process on localhost, start them with python -m ch28_cycle_gan.distribute --workers 4
+DISTRIBUTE = 'workers' if 'TF_CONFIG' in os.environ else None
+NUM_REPLICAS = 4
+
 gpus = tf.config.experimental.list_physical_devices('GPU')
 if gpus:
     try:
         # Currently, memory growth needs to be the same across GPUs
         for gpu in gpus:
             tf.config.experimental.set_memory_growth(gpu, True)
-        logical_gpus = tf.config.experimental.list_logical_devices('GPU')
-        print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
     except RuntimeError as e:
         # Memory growth must be set before GPUs have been initialized
         print(e)
 
+# Created before any other op, which would initialize the devices
+strategy = make_strategy(DISTRIBUTE, NUM_REPLICAS)
+print('Replicas = ', strategy.num_replicas_in_sync)
+
+if gpus:
+    logical_gpus = tf.config.experimental.list_logical_devices('GPU')
+    print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
+
 REAL_LABEL = 1.0
 BUFFER_SIZE = 5000
 IMG_WIDTH = 256
@@ -41,10 +58,14 @@ elif version == 4:
 else:
     assert False
 
-train_A = image_folder_to_dataset('dataset/{}/trainA'.format(dsdir), buffer_size=BUFFER_SIZE)
-train_B = image_folder_to_dataset('dataset/{}/trainB'.format(dsdir), buffer_size=BUFFER_SIZE)
-test_A = image_folder_to_dataset('dataset/{}/testA'.format(dsdir), buffer_size=BUFFER_SIZE)
-test_B = image_folder_to_dataset('dataset/{}/testB'.format(dsdir), buffer_size=BUFFER_SIZE)
+# Each domain is decoded once into a memory mapped uint8 array, 1/4 the size of the float32 images
+# Only the chief decodes, the other workers wait for its cache files
+train_images_A = decode_image_folder('dataset/{}/trainA'.format(dsdir), image_size=(IMG_HEIGHT, IMG_WIDTH), wait=not is_chief())
+train_images_B = decode_image_folder('dataset/{}/trainB'.format(dsdir), image_size=(IMG_HEIGHT, IMG_WIDTH), wait=not is_chief())
+train_A = decoded_image_dataset(train_images_A)
+train_B = decoded_image_dataset(train_images_B)
+test_A = decoded_image_dataset(decode_image_folder('dataset/{}/testA'.format(dsdir), image_size=(IMG_HEIGHT, IMG_WIDTH), wait=not is_chief()))
+test_B = decoded_image_dataset(decode_image_folder('dataset/{}/testB'.format(dsdir), image_size=(IMG_HEIGHT, IMG_WIDTH), wait=not is_chief()))
 custom = image_folder_to_dataset('dataset/custom', buffer_size=100)
 
 print('Domain A images :', len(train_A))
@@ -103,10 +124,11 @@ def preprocess_image_test(image):
     return image
 
 
-train_A = train_A.map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE).cache().shuffle(BUFFER_SIZE, reshuffle_each_iteration=True)
-train_B = train_B.map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE).cache().shuffle(BUFFER_SIZE, reshuffle_each_iteration=True)
-test_A = test_A.map(preprocess_image_test, num_parallel_calls=tf.data.experimental.AUTOTUNE).cache().shuffle(BUFFER_SIZE, reshuffle_each_iteration=True)
-test_B = test_B.map(preprocess_image_test, num_parallel_calls=tf.data.experimental.AUTOTUNE).cache().shuffle(BUFFER_SIZE, reshuffle_each_iteration=True)
+# Augmented after the uint8 cache, so every epoch gets a new random jitter
+train_A = train_A.map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+train_B = train_B.map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+test_A = test_A.map(preprocess_image_test, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+test_B = test_B.map(preprocess_image_test, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 custom = custom.map(preprocess_image_test, num_parallel_calls=tf.data.experimental.AUTOTUNE).cache().shuffle(BUFFER_SIZE, reshuffle_each_iteration=True)
 
 sample_A = next(iter(train_A.batch(1)))
@@ -123,13 +145,15 @@ sample_C = next(iter(custom.batch(1).shuffle(1, 5)))
 #
 # plt.show()
 
-generator_a2b = ResNetGenerator()
-generator_b2a = ResNetGenerator()
-discriminator_a = Discriminator(lsgan=USE_LSGAN)
-discriminator_b = Discriminator(lsgan=USE_LSGAN)
+# Variables created in the scope are mirrored on every replica
+with strategy.scope():
+    generator_a2b = ResNetGenerator()
+    generator_b2a = ResNetGenerator()
+    discriminator_a = Discriminator(lsgan=USE_LSGAN)
+    discriminator_b = Discriminator(lsgan=USE_LSGAN)
 
-to_zebra = generator_a2b(sample_A)
-to_horse = generator_b2a(sample_B)
+    to_zebra = generator_a2b(sample_A)
+    to_horse = generator_b2a(sample_B)
 plt.figure(figsize=(8, 8))
 contrast = 8
 
@@ -157,52 +181,75 @@ plt.imshow(discriminator_b(sample_B)[0, ..., -1], cmap='RdBu_r')
 
 plt.show()
 
+# Images per replica
+BATCH_SIZE = 1
+GLOBAL_BATCH_SIZE = BATCH_SIZE * strategy.num_replicas_in_sync
+EPOCHS = 5
+LAMBDA = 10.0
+EPOCHS_TO_SAVE = 1
+REPORT_PER_BATCH = 10
+STEPS_PER_EPOCH = min(len(train_A), len(train_B)) // GLOBAL_BATCH_SIZE
+
+# Losses are reduced by hand, as the mean of each image and then the mean over the global batch,
+# so the gradients summed across the replicas are the gradients of the global batch mean
 if USE_LSGAN:
-    loss_obj = tf.keras.losses.MeanSquaredError()
+    loss_obj = tf.keras.losses.MeanSquaredError(reduction=tf.keras.losses.Reduction.NONE)
 else:
-    loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+    loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+
+mae = tf.keras.losses.MeanAbsoluteError(reduction=tf.keras.losses.Reduction.NONE)
+
 
-mae = tf.keras.losses.MeanAbsoluteError()
+def global_batch_mean(loss):
+    per_image = tf.reduce_mean(loss, axis=[1, 2])
+    return tf.nn.compute_average_loss(per_image, global_batch_size=GLOBAL_BATCH_SIZE)
 
 
 def discriminator_loss(real, generated):
-    real_loss = loss_obj(tf.ones_like(real), real)
-    generated_loss = loss_obj(tf.zeros_like(generated), generated)
+    real_loss = global_batch_mean(loss_obj(tf.ones_like(real), real))
+    generated_loss = global_batch_mean(loss_obj(tf.zeros_like(generated), generated))
     total_disc_loss = real_loss + generated_loss
     return total_disc_loss * 0.5
 
 
 def generator_loss(generated):
-    loss = loss_obj(tf.ones_like(generated), generated)
+    loss = global_batch_mean(loss_obj(tf.ones_like(generated), generated))
     return loss
 
 
 def cycle_consistency_loss(real, cycled):
-    loss = mae(real, cycled)
+    loss = global_batch_mean(mae(real, cycled))
     return loss
 
 
 def identity_loss(real, same):
-    loss = mae(real, same)
+    loss = global_batch_mean(mae(real, same))
     return loss
 
 
-generator_a2b_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
-generator_b2a_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
+with strategy.scope():
+    generator_a2b_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
+    generator_b2a_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
 
-discriminator_a_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
-discriminator_b_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
+    discriminator_a_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
+    discriminator_b_optimizer = tf.keras.optimizers.Adam(2e-4, beta_1=0.5)
 
-ckpt = tf.train.Checkpoint(generator_a2b=generator_a2b,
-                           generator_b2a=generator_b2a,
-                           discriminator_a=discriminator_a,
-                           discriminator_b=discriminator_b,
-                           generator_a2b_optimizer=generator_a2b_optimizer,
-                           generator_b2a_optimizer=generator_b2a_optimizer,
-                           discriminator_a_optimizer=discriminator_a_optimizer,
-                           discriminator_b_optimizer=discriminator_b_optimizer)
+# Every worker saves, as the checkpoint may need every replica, but only the chief saves to checkpoint_path
+if is_chief():
+    save_path = checkpoint_path
+else:
+    save_path = os.path.join(tempfile.gettempdir(), 'cycle_gan_worker_{}'.format(task_index()))
 
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=10)
+# Checkpoints are written in the background, and hold the epoch and the random states with the models and the optimizers
+checkpoints = CheckpointService(save_path, max_to_keep=10, legacy_epochs_per_checkpoint=EPOCHS_TO_SAVE,
+                                generator_a2b=generator_a2b,
+                                generator_b2a=generator_b2a,
+                                discriminator_a=discriminator_a,
+                                discriminator_b=discriminator_b,
+                                generator_a2b_optimizer=generator_a2b_optimizer,
+                                generator_b2a_optimizer=generator_b2a_optimizer,
+                                discriminator_a_optimizer=discriminator_a_optimizer,
+                                discriminator_b_optimizer=discriminator_b_optimizer)
 
 
 def generate_images(model, test_input, save=None):
@@ -226,57 +273,86 @@ def generate_images(model, test_input, save=None):
     plt.show()
 
 
-BATCH_SIZE = 1
-EPOCHS = 5
-LAMBDA = 10.0
-EPOCHS_TO_SAVE = 1
-REPORT_PER_BATCH = 10
-STEPS_PER_EPOCH = min(len(train_A), len(train_B)) // BATCH_SIZE
-
+# Every worker restores the chief's checkpoint
 start_epoch = 0
-if ckpt_manager.latest_checkpoint:
-    start_epoch = int(ckpt_manager.latest_checkpoint.split('-')[-1]) * EPOCHS_TO_SAVE
-    ckpt.restore(ckpt_manager.latest_checkpoint)
+if checkpoints.restore(checkpoint_path):
+    start_epoch = int(checkpoints.epoch.numpy())
     print('Latest checkpoint Epoch {} restored'.format(start_epoch))
 
-train_A = train_A.batch(BATCH_SIZE)
-train_B = train_B.batch(BATCH_SIZE)
 test_A = test_A.batch(BATCH_SIZE)
 test_B = test_B.batch(BATCH_SIZE)
 
-zipped = tf.data.Dataset.zip((train_A, train_B))
+
+def training_dataset(input_context):
+    """
+    Per replica batches of one input pipeline (one per worker), each pipeline reads its own shard of the images.
+    Repeated, so every worker runs exactly STEPS_PER_EPOCH steps per epoch even if the shards differ in size.
+    """
+    batch_size = input_context.get_per_replica_batch_size(GLOBAL_BATCH_SIZE)
+    shard = dict(num_shards=input_context.num_input_pipelines, shard_index=input_context.input_pipeline_id)
+
+    a = decoded_image_dataset(train_images_A, **shard).map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    b = decoded_image_dataset(train_images_B, **shard).map(preprocess_image_train, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    a = a.batch(batch_size, drop_remainder=True).repeat()
+    b = b.batch(batch_size, drop_remainder=True).repeat()
+
+    return tf.data.Dataset.zip((a, b)).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+zipped = iter(distribute_datasets_from_function(strategy, training_dataset))
 
 print('Start Epoch = ', start_epoch)
 print('Start training for {} epochs'.format(EPOCHS))
-print('Batch Size = ', BATCH_SIZE)
+print('Batch Size = ', GLOBAL_BATCH_SIZE)
 print('Steps per epoch = ', STEPS_PER_EPOCH)
 
-# Run the trained model on the test dataset
-for inp in test_B.take(5):
-    generate_images(generator_b2a, inp)
+# Only the chief writes to checkpoint_path and shows the previews
+if is_chief():
+    # Run the trained model on the test dataset
+    for inp in test_B.take(5):
+        generate_images(generator_b2a, inp)
 
-generate_images(generator_a2b, sample_A, checkpoint_path + 'a2b.jpg')
-generate_images(generator_b2a, sample_B, checkpoint_path + 'b2a.jpg')
-generate_images(generator_b2a, sample_C)
+    generate_images(generator_a2b, sample_A, checkpoint_path + 'a2b.jpg')
+    generate_images(generator_b2a, sample_B, checkpoint_path + 'b2a.jpg')
+    generate_images(generator_b2a, sample_C)
 
 
-@tf.function
-def train_step(real_a, real_b):
-    with tf.GradientTape(persistent=True) as tape:
-        fake_b = generator_a2b(real_a, training=True)
-        cycled_a = generator_b2a(fake_b, training=True)
+def batched_call(model, inputs):
+    """
+    Run model once on the concatenation of the inputs, instead of once per input.
+    Instance normalization normalizes each image on its own, so the outputs are the same as separate calls.
 
-        fake_a = generator_b2a(real_b, training=True)
-        cycled_b = generator_a2b(fake_a, training=True)
+    :return: One output per input
+    """
+    outputs = model(tf.concat(inputs, axis=0), training=True)
+    return tf.split(outputs, [tf.shape(x)[0] for x in inputs], axis=0)
+
+
+generator_variables = generator_a2b.trainable_variables + generator_b2a.trainable_variables
+discriminator_variables = discriminator_a.trainable_variables + discriminator_b.trainable_variables
+
+
+def train_step(real_a, real_b):
+    # Each tape records only the ops that depend on its own variables, and is released by its gradient() call
+    with tf.GradientTape(watch_accessed_variables=False) as gen_tape, tf.GradientTape(watch_accessed_variables=False) as disc_tape:
+        gen_tape.watch(generator_variables)
+        disc_tape.watch(discriminator_variables)
 
-        same_a = generator_b2a(real_a, training=True)
-        same_b = generator_a2b(real_b, training=True)
+        # The fake and identity passes of a generator are independent, so they share one call
+        if APPEND_IDENTITY_LOSS:
+            fake_b, same_b = batched_call(generator_a2b, [real_a, real_b])
+            fake_a, same_a = batched_call(generator_b2a, [real_b, real_a])
+        else:
+            fake_b = generator_a2b(real_a, training=True)
+            fake_a = generator_b2a(real_b, training=True)
 
-        disc_real_a = discriminator_a(real_a, training=True)
-        disc_real_b = discriminator_b(real_b, training=True)
+        # Cycled passes depend on the fakes of the other generator
+        cycled_a = generator_b2a(fake_b, training=True)
+        cycled_b = generator_a2b(fake_a, training=True)
 
-        disc_fake_a = discriminator_a(fake_a, training=True)
-        disc_fake_b = discriminator_b(fake_b, training=True)
+        disc_real_a, disc_fake_a = batched_call(discriminator_a, [real_a, fake_a])
+        disc_real_b, disc_fake_b = batched_call(discriminator_b, [real_b, fake_b])
 
         # calculate the loss
         gen_a2b_loss = generator_loss(disc_fake_b)
@@ -295,12 +371,20 @@ def train_step(real_a, real_b):
         disc_a_loss = discriminator_loss(disc_real_a, disc_fake_a)
         disc_b_loss = discriminator_loss(disc_real_b, disc_fake_b)
 
+        # gen_a2b_loss doesn't depend on generator_b2a and gen_b2a_loss doesn't depend on generator_a2b,
+        # so the gradients of the sums are the gradients of each loss w.r.t. its own model, with the cycle loss counted once
+        total_gen_loss = total_gen_a2b_loss + total_gen_b2a_loss - total_cycle_consistency_loss
+        total_disc_loss = disc_a_loss + disc_b_loss
+
     # Calculate the gradients for generator and discriminator
-    generator_a2b_gradients = tape.gradient(total_gen_a2b_loss, generator_a2b.trainable_variables)
-    generator_b2a_gradients = tape.gradient(total_gen_b2a_loss, generator_b2a.trainable_variables)
+    generator_gradients = gen_tape.gradient(total_gen_loss, generator_variables)
+    discriminator_gradients = disc_tape.gradient(total_disc_loss, discriminator_variables)
+
+    generator_a2b_gradients = generator_gradients[:len(generator_a2b.trainable_variables)]
+    generator_b2a_gradients = generator_gradients[len(generator_a2b.trainable_variables):]
 
-    discriminator_a_gradients = tape.gradient(disc_a_loss, discriminator_a.trainable_variables)
-    discriminator_b_gradients = tape.gradient(disc_b_loss, discriminator_b.trainable_variables)
+    discriminator_a_gradients = discriminator_gradients[:len(discriminator_a.trainable_variables)]
+    discriminator_b_gradients = discriminator_gradients[len(discriminator_a.trainable_variables):]
 
     # Apply the gradients to the optimizer
     generator_a2b_optimizer.apply_gradients(zip(generator_a2b_gradients, generator_a2b.trainable_variables))
@@ -308,32 +392,47 @@ def train_step(real_a, real_b):
     discriminator_a_optimizer.apply_gradients(zip(discriminator_a_gradients, discriminator_a.trainable_variables))
     discriminator_b_optimizer.apply_gradients(zip(discriminator_b_gradients, discriminator_b.trainable_variables))
 
+    return total_gen_a2b_loss, total_gen_b2a_loss, disc_a_loss, disc_b_loss
+
+
+@tf.function
+def distributed_train_step(real_a, real_b):
+    losses = strategy.run(train_step, args=(real_a, real_b))
+
+    # Each replica returns its share of the global batch mean
+    return [strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None) for loss in losses]
+
 
 for epoch in range(EPOCHS):
     start = time.time()
 
     current_epoch = start_epoch + epoch + 1
 
-    # n = 0
     print('-------------------------------------------------------------')
-    for image_a, image_b in tqdm.tqdm(zipped):
-        train_step(image_a, image_b)
-        # if n % REPORT_PER_BATCH == 0:
-        #     print('Epoch {} Batch {}/{}'.format(current_epoch, n, STEPS_PER_EPOCH))
-        # n += 1
+    for n in tqdm.tqdm(range(STEPS_PER_EPOCH)):
+        losses = distributed_train_step(*next(zipped))
+        if n % REPORT_PER_BATCH == 0:
+            gen_a2b_loss, gen_b2a_loss, disc_a_loss, disc_b_loss = losses
+            checkpoints.log_metrics(generator_a2b_optimizer.iterations, current_epoch - 1,
+                                    gen_a2b_loss=gen_a2b_loss, gen_b2a_loss=gen_b2a_loss,
+                                    disc_a_loss=disc_a_loss, disc_b_loss=disc_b_loss)
 
     if (epoch + 1) % EPOCHS_TO_SAVE == 0:
-        ckpt_save_path = ckpt_manager.save()
+        ckpt_save_path = checkpoints.save(step=generator_a2b_optimizer.iterations, epoch=current_epoch)
         print('Saving checkpoint for epoch {} at {}'.format(current_epoch, ckpt_save_path))
 
     print('Time taken for epoch {} is {} sec\n'.format(current_epoch, time.time() - start))
 
     # Using a consistent image (sample_A) so that the progress of the model is clearly visible.
-    generate_images(generator_a2b, sample_A, checkpoint_path + str(current_epoch) + 'a2b.jpg')
-    generate_images(generator_b2a, sample_B, checkpoint_path + str(current_epoch) + 'b2a.jpg')
+    if is_chief():
+        generate_images(generator_a2b, sample_A, checkpoint_path + str(current_epoch) + 'a2b.jpg')
+        generate_images(generator_b2a, sample_B, checkpoint_path + str(current_epoch) + 'b2a.jpg')
+
+checkpoints.wait()
 
-# Run the trained model on the test dataset
-for inp in test_A.take(5):
-    generate_images(generator_a2b, inp)
+if is_chief():
+    # Run the trained model on the test dataset
+    for inp in test_A.take(5):
+        generate_images(generator_a2b, inp)
 
-generate_images(generator_a2b, sample_C)
+    generate_images(generator_a2b, sample_C)
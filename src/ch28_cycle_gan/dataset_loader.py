@@ -1,4 +1,7 @@
+import os
+import time
 import pathlib
+import numpy as np
 import tensorflow as tf
 
 
@@ -14,7 +17,91 @@ def image_folder_to_dataset(folder_path, buffer_size=1000):
     path = pathlib.Path(folder_path)
     files = list(map(lambda a: str(a).encode('utf-8'), path.glob('*.jpg')))
 
-    dataset = tf.data.Dataset.from_tensor_slices(files)
-    dataset = dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).shuffle(buffer_size)
+    # Shuffle the file names, not the decoded images
+    dataset = tf.data.Dataset.from_tensor_slices(files).shuffle(buffer_size, reshuffle_each_iteration=True)
+    dataset = dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     return dataset
+
+
+def load_decoded(cache_file, num_images, image_size):
+    """
+    :return: Memory mapped cache of decode_image_folder, None if there is none or it doesn't match
+    """
+    if not os.path.exists(cache_file):
+        return None
+
+    images = np.load(cache_file, mmap_mode='r')
+    if len(images) == num_images and images.shape[1:3] == tuple(image_size):
+        return images
+
+    return None
+
+
+def decode_image_folder(folder_path, image_size=(256, 256), batch_size=64, wait=False, poll_interval=1.0):
+    """
+    Decode every jpg of the folder once into a uint8 array stored next to the folder (<folder>.uint8.npy),
+    and memory map it. Images of another size are resized to image_size.
+    The cache is decoded again if the number of images in the folder changes.
+
+    :param wait: Don't decode, wait until another process, e.g. the chief worker, has written the cache
+    :return: Memory mapped uint8 array, shape == (number of images, height, width, 3)
+    """
+    path = pathlib.Path(folder_path)
+    files = sorted(str(p) for p in path.glob('*.jpg'))
+    cache_file = str(path) + '.uint8.npy'
+
+    images = load_decoded(cache_file, len(files), image_size)
+    if images is not None:
+        return images
+
+    if wait:
+        print('Waiting for the decoded images of {}'.format(folder_path))
+        while images is None:
+            time.sleep(poll_interval)
+            images = load_decoded(cache_file, len(files), image_size)
+        return images
+
+    print('Decoding {} images of {}'.format(len(files), folder_path))
+
+    def decode(image_path):
+        image = load_image(image_path)
+        image = tf.image.resize(image, image_size)  # Exact copy if the size is already image_size
+        return tf.saturate_cast(tf.round(image), tf.uint8)
+
+    # Per process, so concurrent decodes of the same folder don't write into one file
+    temp_file = '{}.{}.tmp.npy'.format(cache_file, os.getpid())
+    images = np.lib.format.open_memmap(temp_file, mode='w+', dtype=np.uint8, shape=(len(files),) + tuple(image_size) + (3,))
+
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    dataset = dataset.map(decode, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(batch_size)
+
+    for i, batch in enumerate(dataset):
+        images[i * batch_size:i * batch_size + len(batch)] = batch.numpy()
+
+    images.flush()
+    del images
+
+    # Renamed when complete, an interrupted decode is decoded again on the next run
+    os.replace(temp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def decoded_image_dataset(images, shuffle=True, num_shards=1, shard_index=0):
+    """
+    Dataset of uint8 images read from the memory mapped array of decode_image_folder.
+    Only the indices are shuffled, with every image in the shuffle buffer, and reshuffled each epoch.
+    With num_shards > 1, only every num_shards-th image starting at shard_index is read.
+    """
+    dataset = tf.data.Dataset.range(len(images)).shard(num_shards, shard_index)
+
+    if shuffle:
+        dataset = dataset.shuffle(max(len(images) // num_shards, 1), reshuffle_each_iteration=True)
+
+    def read(i):
+        image = tf.numpy_function(lambda index: np.asarray(images[index]), [i], tf.uint8)
+        image.set_shape(images.shape[1:])
+        return image
+
+    return dataset.map(read, num_parallel_calls=tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tensorflow as tf
+
+
+def make_strategy(mode=None, num_replicas=2):
+    """
+    Create the distribution strategy, before any other TensorFlow op runs.
+
+    None: Default strategy, a single device.
+    'devices': MirroredStrategy over num_replicas logical CPU devices of this process.
+    'workers': MultiWorkerMirroredStrategy over the processes of TF_CONFIG, one replica per process. See launch_local_workers().
+
+    Gradients are all-reduced (summed) across the replicas in optimizer.apply_gradients().
+    """
+    if mode is None:
+        return tf.distribute.get_strategy()
+
+    if mode == 'devices':
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration() for _ in range(num_replicas)])
+
+        devices = ['/cpu:{}'.format(i) for i in range(num_replicas)]
+        return tf.distribute.MirroredStrategy(devices=devices, cross_device_ops=tf.distribute.ReductionToOneDevice(reduce_to_device='/cpu:0'))
+
+    if mode == 'workers':
+        assert 'TF_CONFIG' in os.environ, 'TF_CONFIG is not set, start the workers with python -m ch28_cycle_gan.distribute'
+
+        # The worker processes share the cores of the host
+        num_workers = len(json.loads(os.environ['TF_CONFIG'])['cluster']['worker'])
+        tf.config.threading.set_intra_op_parallelism_threads(max(os.cpu_count() // num_workers, 1))
+
+        if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+            return tf.distribute.MultiWorkerMirroredStrategy()
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+    raise ValueError('Unknown distribute mode: {}, must be None, \'devices\' or \'workers\''.format(mode))
+
+
+def distribute_datasets_from_function(strategy, dataset_fn):
+    if hasattr(strategy, 'distribute_datasets_from_function'):
+        return strategy.distribute_datasets_from_function(dataset_fn)
+    return strategy.experimental_distribute_datasets_from_function(dataset_fn)
+
+
+def task_index():
+    """
+    :return: Index of this worker in TF_CONFIG, 0 if there is no TF_CONFIG
+    """
+    if 'TF_CONFIG' not in os.environ:
+        return 0
+
+    return json.loads(os.environ['TF_CONFIG'])['task']['index']
+
+
+def is_chief():
+    """
+    Worker 0 is the chief, it writes the checkpoints and the images.
+    """
+    return task_index() == 0
+
+
+def launch_local_workers(module, num_workers, port=12345):
+    """
+    Run module (python -m module) in num_workers processes on localhost, each with its own TF_CONFIG.
+    Only the chief shows plots, the other workers use the Agg matplotlib backend.
+
+    :return: Exit code, nonzero if any worker failed
+    """
+    cluster = {'worker': ['localhost:{}'.format(port + i) for i in range(num_workers)]}
+    processes = []
+
+    for i in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': i}})
+        if i > 0:
+            env['MPLBACKEND'] = 'Agg'
+
+        processes.append(subprocess.Popen([sys.executable, '-m', module], env=env))
+
+    # Killed workers have negative exit codes
+    codes = [p.wait() for p in processes]
+    return next((c for c in codes if c != 0), 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data parallel CycleGAN training with local worker processes')
+    parser.add_argument('--workers', type=int, default=2, help='Number of worker processes')
+    parser.add_argument('--port', type=int, default=12345, help='Port of worker 0, worker i listens on port + i')
+    parser.add_argument('--module', default='ch28_cycle_gan.cycle_gan', help='Training module to run')
+    args = parser.parse_args()
+
+    sys.exit(launch_local_workers(args.module, args.workers, args.port))
@@ -0,0 +1,394 @@
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import tensorflow_addons as tfa
+from ch28_cycle_gan.model import *
+
+RESNET_GENERATOR_BLOCKS = ['enc1', 'enc2', 'enc3',
+                           'res1', 'res2', 'res3', 'res4', 'res5', 'res6', 'res7', 'res8', 'res9',
+                           'dec1', 'dec2', 'dec3']
+DISCRIMINATOR_BLOCKS = ['dsc1', 'dsc2', 'dsc3', 'dsc4', 'dsc5']
+
+
+# The previous blocks, a tf.keras.Model around a tf.keras.Sequential of layers, to compare the latency with
+# and to check that their checkpoints restore into the current flat layers
+
+
+class ReferenceCNR2d(tf.keras.Model):
+    def __init__(self, filters, kernel_size, stride, padding=None, norm='inorm', relu=0.0, bias=True, drop=0.0, padding_type='same'):
+        super().__init__()
+
+        layers = []
+        if padding is not None:
+            if padding_type.lower() == 'zero':
+                layers += [ReferencePadding(padding=padding, padding_type='CONSTANT', constant=0)]
+            else:
+                layers += [ReferencePadding(padding=padding)]
+
+            padding_type = 'valid'
+
+        layers += [tf.keras.layers.Conv2D(filters=filters,
+                                          kernel_size=kernel_size,
+                                          strides=stride,
+                                          padding=padding_type,
+                                          use_bias=bias,
+                                          kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))]
+
+        if norm is not None:
+            if norm == 'bnorm':
+                layers += [tf.keras.layers.BatchNormalization()]
+            elif norm == 'inorm':
+                layers += [tfa.layers.InstanceNormalization()]
+
+        if relu is not None:
+            if relu > 0.0:
+                layers += [tf.keras.layers.LeakyReLU(relu)]
+            else:
+                layers += [tf.keras.layers.ReLU()]
+
+        if drop is not None and drop > 0.0:
+            layers += [tf.keras.layers.Dropout(drop)]
+
+        self.cnr2d = tf.keras.Sequential(layers)
+
+    def call(self, x, training=False):
+        return self.cnr2d(x, training=training)
+
+
+class ReferenceDECNR2d(tf.keras.Model):
+    def __init__(self, filters, kernel_size, stride, norm='inorm', relu=0.0, bias=True, drop=0.0, padding_type='same'):
+        super().__init__()
+
+        layers = []
+        layers += [tf.keras.layers.Conv2DTranspose(filters=filters,
+                                                   padding=padding_type,
+                                                   kernel_size=kernel_size,
+                                                   strides=stride,
+                                                   use_bias=bias,
+                                                   kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))]
+
+        if norm is not None:
+            if norm == 'bnorm':
+                layers += [tf.keras.layers.BatchNormalization()]
+            elif norm == 'inorm':
+                layers += [tfa.layers.InstanceNormalization()]
+
+        if relu is not None:
+            if relu > 0.0:
+                layers += [tf.keras.layers.LeakyReLU(relu)]
+            else:
+                layers += [tf.keras.layers.ReLU()]
+
+        if drop is not None and drop > 0.0:
+            layers += [tf.keras.layers.Dropout(drop)]
+
+        self.decnr2d = tf.keras.Sequential(layers)
+
+    def call(self, x, training=False):
+        return self.decnr2d(x, training=training)
+
+
+class ReferenceResBlock(tf.keras.Model):
+    def __init__(self, filters, kernel_size, stride, padding, norm='inorm', relu=0.0, drop=0.0, bias=True):
+        super().__init__()
+
+        layers = []
+        layers += [ReferenceCNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=relu, bias=bias)]
+
+        if drop is not None and drop > 0.0:
+            layers += [tf.keras.layers.Dropout(drop)]
+
+        layers += [ReferenceCNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=None, bias=bias)]
+
+        self.resblk = tf.keras.Sequential(layers)
+
+    def call(self, x, training=False):
+        return x + self.resblk(x, training=training)
+
+
+class ReferencePadding(tf.keras.Model):
+    def __init__(self, padding, padding_type='REFLECT', constant=0):
+        super(ReferencePadding, self).__init__()
+        self.padding = padding
+        self.padding_type = padding_type
+        self.constant = constant
+
+    def call(self, x):
+        return tf.pad(x, [[0, 0], [self.padding, self.padding], [self.padding, self.padding], [0, 0]], mode=self.padding_type, constant_values=self.constant)
+
+
+class ReferenceResNetGenerator(tf.keras.Model):
+    """
+    ResNetGenerator of the reference blocks, with the same block names.
+    """
+
+    def __init__(self, out_channels=3, nker=64, norm='inorm'):
+        super(ReferenceResNetGenerator, self).__init__()
+
+        self.enc1 = ReferenceCNR2d(1 * nker, kernel_size=7, stride=1, norm=norm, relu=0.0, padding=3)
+        self.enc2 = ReferenceCNR2d(2 * nker, kernel_size=3, stride=2, norm=norm, relu=0.0)
+        self.enc3 = ReferenceCNR2d(4 * nker, kernel_size=3, stride=2, norm=norm, relu=0.0)
+
+        self.res1 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res2 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res3 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res4 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res5 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res6 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res7 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res8 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+        self.res9 = ReferenceResBlock(4 * nker, kernel_size=3, stride=1, norm=norm, relu=0.0, padding=1)
+
+        self.dec1 = ReferenceDECNR2d(2 * nker, kernel_size=3, stride=2, norm=norm, relu=0.0)
+        self.dec2 = ReferenceDECNR2d(1 * nker, kernel_size=3, stride=2, norm=norm, relu=0.0)
+        self.dec3 = ReferenceCNR2d(out_channels, kernel_size=7, stride=1, norm=None, relu=None, bias=False, padding=3)
+
+    def call(self, x, training=False):
+        for name in RESNET_GENERATOR_BLOCKS:
+            x = getattr(self, name)(x, training=training)
+
+        return tf.nn.tanh(x)
+
+
+def restore_reference(reference, generator, direction='a2b'):
+    """
+    Write the reference generator to a checkpoint, the way cycle_gan.py wrote it before the flat layers,
+    and restore it into the flat generator. Asserts that every object of the flat generator is restored.
+    Not assert_consumed(), the layer-N dependencies of the Sequentials (padding, activations) have no counterpart.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = tf.train.Checkpoint(**{'generator_' + direction: reference}).write(directory + '/ckpt')
+        status = tf.train.Checkpoint(**{'generator_' + direction: generator}).restore(path)
+        status.assert_existing_objects_matched()
+
+
+def folded_kernel(conv, norm, out_axis):
+    """
+    Kernel and bias of the conv as numpy arrays. A BatchNormalization after the conv is folded into them,
+    bn(conv(x) + b) = conv(x) * s + (b - mean) * s + beta, with s = gamma / sqrt(var + eps).
+
+    :return: kernel, bias (None if there is neither a conv bias nor a batch norm)
+    """
+    kernel = conv.kernel.numpy()
+    bias = conv.bias.numpy() if conv.use_bias else None
+
+    if not isinstance(norm, tf.keras.layers.BatchNormalization):
+        return kernel, bias
+
+    mean = norm.moving_mean.numpy()
+    scale = 1 / np.sqrt(norm.moving_variance.numpy() + norm.epsilon)
+    if norm.scale:
+        scale = scale * norm.gamma.numpy()
+
+    shape = [1] * kernel.ndim
+    shape[out_axis] = -1
+
+    kernel = kernel * scale.reshape(shape)
+    bias = ((bias if bias is not None else 0) - mean) * scale
+    if norm.center:
+        bias = bias + norm.beta.numpy()
+
+    return kernel, bias
+
+
+def instance_norm(norm):
+    """
+    tfa InstanceNormalization with per channel moments and gamma folded into the normalization scale.
+    """
+    gamma = tf.constant(norm.gamma.numpy()) if norm.scale else None
+    beta = tf.constant(norm.beta.numpy()) if norm.center else None
+    epsilon = norm.epsilon
+
+    def apply(x):
+        mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
+        scale = tf.math.rsqrt(variance + epsilon)
+        if gamma is not None:
+            scale = scale * gamma
+
+        x = (x - mean) * scale
+        if beta is not None:
+            x = x + beta
+
+        return x
+
+    return apply
+
+
+def fold_cnr2d(layer):
+    kernel, bias = folded_kernel(layer.conv, layer.norm, out_axis=3)
+    kernel = tf.constant(kernel)
+    bias = tf.constant(bias) if bias is not None else None
+    norm = instance_norm(layer.norm) if isinstance(layer.norm, tfa.layers.InstanceNormalization) else None
+
+    strides = layer.conv.strides
+    padding = layer.conv.padding.upper()
+
+    p = layer.padding
+    if layer.pad_mode == 'CONSTANT':
+        # Zero padding becomes the explicit padding of the conv
+        padding = [[0, 0], [p, p], [p, p], [0, 0]]
+
+    def apply(x):
+        if layer.pad_mode == 'REFLECT':
+            x = tf.pad(x, [[0, 0], [p, p], [p, p], [0, 0]], mode='REFLECT')
+
+        x = tf.nn.conv2d(x, kernel, strides=strides, padding=padding)
+        if bias is not None:
+            x = tf.nn.bias_add(x, bias)
+
+        if norm is not None:
+            x = norm(x)
+
+        return activation(x, layer.relu)
+
+    return apply
+
+
+def fold_decnr2d(layer):
+    # Conv2DTranspose kernel shape == (height, width, out channels, in channels)
+    kernel, bias = folded_kernel(layer.deconv, layer.norm, out_axis=2)
+    kernel = tf.constant(kernel)
+    bias = tf.constant(bias) if bias is not None else None
+    norm = instance_norm(layer.norm) if isinstance(layer.norm, tfa.layers.InstanceNormalization) else None
+
+    kernel_size = layer.deconv.kernel_size
+    strides = layer.deconv.strides
+    padding = layer.deconv.padding.upper()
+    filters = layer.deconv.filters
+
+    def output_length(length, k, s):
+        return length * s if padding == 'SAME' else length * s + max(k - s, 0)
+
+    def apply(x):
+        shape = tf.shape(x)
+        output_shape = tf.stack([shape[0],
+                                 output_length(shape[1], kernel_size[0], strides[0]),
+                                 output_length(shape[2], kernel_size[1], strides[1]),
+                                 filters])
+
+        x = tf.nn.conv2d_transpose(x, kernel, output_shape, strides=strides, padding=padding)
+        if bias is not None:
+            x = tf.nn.bias_add(x, bias)
+
+        if norm is not None:
+            x = norm(x)
+
+        return activation(x, layer.relu)
+
+    return apply
+
+
+def fold(layer):
+    """
+    :return: Function equal to layer(x, training=False), with the weights as constants, batch norm folded into the conv,
+             zero padding folded into the conv padding and reflect padding fed straight into the conv
+    """
+    if isinstance(layer, ResBlock):
+        first = fold(layer.first)
+        second = fold(layer.second)
+        return lambda x: x + second(first(x))
+
+    if isinstance(layer, CNR2d):
+        return fold_cnr2d(layer)
+
+    if isinstance(layer, DECNR2d):
+        return fold_decnr2d(layer)
+
+    raise ValueError('Cannot fold {}'.format(type(layer).__name__))
+
+
+def export_model(model, image_size=(None, None)):
+    """
+    Inference only tf.function of a ResNetGenerator or a Discriminator, built from folded blocks in a single graph.
+    The weights are constants of the graph, so the model can't be trained or restored anymore.
+
+    :param image_size: (height, width), None for any size
+    """
+    if isinstance(model, ResNetGenerator):
+        blocks = [fold(getattr(model, name)) for name in RESNET_GENERATOR_BLOCKS]
+        output = tf.nn.tanh
+    elif isinstance(model, Discriminator):
+        blocks = [fold(getattr(model, name)) for name in DISCRIMINATOR_BLOCKS]
+        output = tf.identity if model.lsgan else tf.nn.sigmoid
+    else:
+        raise ValueError('Cannot export {}'.format(type(model).__name__))
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + tuple(image_size) + (3,), dtype=tf.float32)])
+    def inference(x):
+        for block in blocks:
+            x = block(x)
+
+        return output(x)
+
+    return inference
+
+
+def save_exported(inference, path):
+    module = tf.Module()
+    module.inference = inference
+    tf.saved_model.save(module, path, signatures=inference.get_concrete_function())
+
+
+def measure_latency(function, image_size=(256, 256), batch_size=1, warmup=5, runs=50):
+    """
+    :return: Milliseconds per image, the median of runs calls after warmup calls
+    """
+    x = tf.random.uniform((batch_size,) + tuple(image_size) + (3,), -1, 1)
+
+    for _ in range(warmup):
+        function(x).numpy()
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(x).numpy()
+        times.append(time.perf_counter() - start)
+
+    return np.median(times) * 1000 / batch_size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a folded inference graph of the CycleGAN generator and measure its latency')
+    parser.add_argument('--checkpoint', default=None, help='CycleGAN checkpoint directory, random weights if not given')
+    parser.add_argument('--direction', default='a2b', choices=['a2b', 'b2a'], help='Generator to export')
+    parser.add_argument('--norm', default='inorm', choices=['inorm', 'bnorm'], help='Normalization of the generator with random weights')
+    parser.add_argument('--size', type=int, default=256, help='Image height and width')
+    parser.add_argument('--batch', type=int, default=1, help='Images per call')
+    parser.add_argument('--save', default=None, help='Where to save the exported SavedModel')
+    args = parser.parse_args()
+
+    image_size = (args.size, args.size)
+
+    reference = ReferenceResNetGenerator(norm=args.norm)
+    reference(tf.zeros((1,) + image_size + (3,)))
+    if args.checkpoint is not None:
+        checkpoint = tf.train.Checkpoint(**{'generator_' + args.direction: reference})
+        checkpoint.restore(tf.train.latest_checkpoint(args.checkpoint)).expect_partial()
+
+    # The flat generator gets its weights from a checkpoint of the nested reference
+    generator = ResNetGenerator(norm=args.norm)
+    generator(tf.zeros((1,) + image_size + (3,)))
+    restore_reference(reference, generator, args.direction)
+    print('Reference checkpoint restored into the flat layers, no unmatched objects')
+
+    nested = tf.function(lambda x: reference(x, training=False))
+    flat = tf.function(lambda x: generator(x, training=False))
+    folded = export_model(generator, image_size)
+
+    x = tf.random.uniform((2,) + image_size + (3,), -1, 1)
+    print('Max difference, nested and flat = {:.2e}'.format(np.max(np.abs(nested(x).numpy() - flat(x).numpy()))))
+    print('Max difference, flat and folded = {:.2e}'.format(np.max(np.abs(flat(x).numpy() - folded(x).numpy()))))
+
+    nested_time = measure_latency(nested, image_size, args.batch)
+    flat_time = measure_latency(flat, image_size, args.batch)
+    folded_time = measure_latency(folded, image_size, args.batch)
+
+    print('Nested: {:.2f} ms/image'.format(nested_time))
+    print('Flat: {:.2f} ms/image, {:.2f}x'.format(flat_time, nested_time / flat_time))
+    print('Folded: {:.2f} ms/image, {:.2f}x'.format(folded_time, nested_time / folded_time))
+
+    if args.save is not None:
+        save_exported(folded, args.save)
+        print('Saved to', args.save)
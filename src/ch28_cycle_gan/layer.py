@@ -2,99 +2,146 @@ import tensorflow as tf
 import tensorflow_addons as tfa
 
 
-class CNR2d(tf.keras.Model):
+def normalization(norm):
+    if norm == 'bnorm':
+        return tf.keras.layers.BatchNormalization()
+    elif norm == 'inorm':
+        return tfa.layers.InstanceNormalization()
+
+    return None
+
+
+def activation(x, relu):
+    if relu is None:
+        return x
+
+    if relu > 0.0:
+        return tf.nn.leaky_relu(x, alpha=relu)
+    else:
+        return tf.nn.relu(x)
+
+
+def layers_with_weights(*layers):
+    """
+    Checkpoint dependencies named like the layers of a tf.keras.Sequential (layer_with_weights-N),
+    so the flat layers restore checkpoints of the former Model(Sequential) layers.
+    """
+    return {'layer_with_weights-{}'.format(i): layer for i, layer in enumerate(l for l in layers if l is not None)}
+
+
+class CNR2d(tf.keras.layers.Layer):
     def __init__(self, filters, kernel_size, stride, padding=None, norm='inorm', relu=0.0, bias=True, drop=0.0, padding_type='same'):
         super().__init__()
 
-        layers = []
+        self.padding = padding
+        self.pad_mode = None
         if padding is not None:
-            if padding_type.lower() == 'zero':
-                layers += [Padding(padding=padding, padding_type='CONSTANT', constant=0)]
-            else:
-                layers += [Padding(padding=padding)]
-
+            self.pad_mode = 'CONSTANT' if padding_type.lower() == 'zero' else 'REFLECT'
             padding_type = 'valid'
 
-        layers += [tf.keras.layers.Conv2D(filters=filters,
-                                          kernel_size=kernel_size,
-                                          strides=stride,
-                                          padding=padding_type,
-                                          use_bias=bias,
-                                          kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))]
+        self.relu = relu
 
-        if norm is not None:
-            if norm == 'bnorm':
-                layers += [tf.keras.layers.BatchNormalization()]
-            elif norm == 'inorm':
-                layers += [tfa.layers.InstanceNormalization()]
+        conv = tf.keras.layers.Conv2D(filters=filters,
+                                      kernel_size=kernel_size,
+                                      strides=stride,
+                                      padding=padding_type,
+                                      use_bias=bias,
+                                      kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))
 
-        if relu is not None:
-            if relu > 0.0:
-                layers += [tf.keras.layers.LeakyReLU(relu)]
-            else:
-                layers += [tf.keras.layers.ReLU()]
+        self.cnr2d = layers_with_weights(conv, normalization(norm))
+        self.dropout = tf.keras.layers.Dropout(drop) if drop is not None and drop > 0.0 else None
 
-        if drop is not None and drop > 0.0:
-            layers += [tf.keras.layers.Dropout(drop)]
+    @property
+    def conv(self):
+        return self.cnr2d['layer_with_weights-0']
 
-        self.cnr2d = tf.keras.Sequential(layers)
+    @property
+    def norm(self):
+        return self.cnr2d.get('layer_with_weights-1')
 
     def call(self, x, training=False):
-        return self.cnr2d(x, training=training)
+        if self.pad_mode is not None:
+            x = tf.pad(x, [[0, 0], [self.padding, self.padding], [self.padding, self.padding], [0, 0]], mode=self.pad_mode)
+
+        x = self.conv(x)
 
+        if self.norm is not None:
+            x = self.norm(x, training=training)
 
-class DECNR2d(tf.keras.Model):
+        x = activation(x, self.relu)
+
+        if self.dropout is not None:
+            x = self.dropout(x, training=training)
+
+        return x
+
+
+class DECNR2d(tf.keras.layers.Layer):
     def __init__(self, filters, kernel_size, stride, norm='inorm', relu=0.0, bias=True, drop=0.0, padding_type='same'):
         super().__init__()
 
-        layers = []
-        layers += [tf.keras.layers.Conv2DTranspose(filters=filters,
-                                                   padding=padding_type,
-                                                   kernel_size=kernel_size,
-                                                   strides=stride,
-                                                   use_bias=bias,
-                                                   kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))]
+        self.relu = relu
 
-        if norm is not None:
-            if norm == 'bnorm':
-                layers += [tf.keras.layers.BatchNormalization()]
-            elif norm == 'inorm':
-                layers += [tfa.layers.InstanceNormalization()]
+        deconv = tf.keras.layers.Conv2DTranspose(filters=filters,
+                                                 padding=padding_type,
+                                                 kernel_size=kernel_size,
+                                                 strides=stride,
+                                                 use_bias=bias,
+                                                 kernel_initializer=tf.keras.initializers.random_normal(0.0, 0.02))
 
-        if relu is not None:
-            if relu > 0.0:
-                layers += [tf.keras.layers.LeakyReLU(relu)]
-            else:
-                layers += [tf.keras.layers.ReLU()]
+        self.decnr2d = layers_with_weights(deconv, normalization(norm))
+        self.dropout = tf.keras.layers.Dropout(drop) if drop is not None and drop > 0.0 else None
 
-        if drop is not None and drop > 0.0:
-            layers += [tf.keras.layers.Dropout(drop)]
+    @property
+    def deconv(self):
+        return self.decnr2d['layer_with_weights-0']
 
-        self.decnr2d = tf.keras.Sequential(layers)
+    @property
+    def norm(self):
+        return self.decnr2d.get('layer_with_weights-1')
 
     def call(self, x, training=False):
-        return self.decnr2d(x, training=training)
+        x = self.deconv(x)
+
+        if self.norm is not None:
+            x = self.norm(x, training=training)
 
+        x = activation(x, self.relu)
 
-class ResBlock(tf.keras.Model):
+        if self.dropout is not None:
+            x = self.dropout(x, training=training)
+
+        return x
+
+
+class ResBlock(tf.keras.layers.Layer):
     def __init__(self, filters, kernel_size, stride, padding, norm='inorm', relu=0.0, drop=0.0, bias=True):
         super().__init__()
 
-        layers = []
-        layers += [CNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=relu, bias=bias)]
+        first = CNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=relu, bias=bias)
+        second = CNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=None, bias=bias)
 
-        if drop is not None and drop > 0.0:
-            layers += [tf.keras.layers.Dropout(drop)]
+        self.resblk = layers_with_weights(first, second)
+        self.dropout = tf.keras.layers.Dropout(drop) if drop is not None and drop > 0.0 else None
 
-        layers += [CNR2d(filters, kernel_size=kernel_size, stride=stride, padding=padding, norm=norm, relu=None, bias=bias)]
+    @property
+    def first(self):
+        return self.resblk['layer_with_weights-0']
 
-        self.resblk = tf.keras.Sequential(layers)
+    @property
+    def second(self):
+        return self.resblk['layer_with_weights-1']
 
     def call(self, x, training=False):
-        return x + self.resblk(x, training=training)
+        y = self.first(x, training=training)
+
+        if self.dropout is not None:
+            y = self.dropout(y, training=training)
+
+        return x + self.second(y, training=training)
 
 
-class Padding(tf.keras.Model):
+class Padding(tf.keras.layers.Layer):
     def __init__(self, padding, padding_type='REFLECT', constant=0):
         super(Padding, self).__init__()
         self.padding = padding
@@ -0,0 +1,181 @@
+import os
+import pathlib
+import argparse
+import numpy as np
+import tensorflow as tf
+from ch28_cycle_gan.model import *
+
+
+def tile_starts(length, tile_size, stride):
+    """
+    :return: Start of every tile along one axis, the last tile ends at length
+    """
+    if length <= tile_size:
+        return [0]
+
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+def feather_weights(tile_size, overlap):
+    """
+    Blending weights of a tile, rising linearly from the border over overlap pixels.
+    Weights are never zero, so every pixel gets a weighted mean of the tiles which cover it.
+
+    :return: shape == (tile_size, tile_size, 1)
+    """
+    ramp = np.ones(tile_size, dtype=np.float32)
+
+    if overlap > 0:
+        rising = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        ramp[:overlap] = rising
+        ramp[-overlap:] = rising[::-1]
+
+    return np.outer(ramp, ramp)[..., np.newaxis]
+
+
+class TiledGenerator:
+    def __init__(self, generator, tile_size=256, overlap=32, batch_size=8):
+        """
+        Run a fully convolutional generator on images of any size, tile by tile.
+        The image is split into tile_size tiles overlapping by overlap pixels, batch_size tiles are run at a time,
+        and the outputs are blended with feathered weights. Generator memory only depends on tile_size and batch_size,
+        and the float32 blending buffers only hold one band of tile_size rows, finished rows are emitted band by band.
+        The input and output images themselves are still held as whole uint8 arrays.
+        Instance normalization sees one tile at a time, the overlap hides the seams this leaves between tiles.
+
+        :param generator: Model mapping [-1, 1] images to [-1, 1] images of the same size, e.g. ResNetGenerator
+        :param tile_size: Tile height and width, multiple of 4 for ResNetGenerator
+        :param overlap: Overlap of neighbouring tiles in pixels
+        :param batch_size: Number of tiles run at a time
+        """
+        assert 0 <= 2 * overlap < tile_size, 'overlap must be less than half of tile_size'
+
+        self.generator = generator
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.weights = feather_weights(tile_size, overlap)
+
+        self.run = tf.function(lambda x: generator(x, training=False),
+                               input_signature=[tf.TensorSpec(shape=(None, tile_size, tile_size, 3), dtype=tf.float32)])
+
+    def bands(self, image):
+        """
+        Generate the output from top to bottom. A band of tiles is run at a time,
+        and the rows no later band overlaps are finished and yielded.
+
+        :param image: uint8, shape == (height, width, 3)
+        :return: Generator of (first row, finished rows), rows are uint8, shape == (number of rows, width, 3)
+        """
+        height, width = image.shape[:2]
+
+        # Images smaller than a tile are reflect padded up to one tile
+        pad_h = max(self.tile_size - height, 0)
+        pad_w = max(self.tile_size - width, 0)
+        padded = np.pad(image, [[0, pad_h], [0, pad_w], [0, 0]], mode='reflect') if pad_h > 0 or pad_w > 0 else image
+
+        stride = self.tile_size - self.overlap
+        ys = tile_starts(padded.shape[0], self.tile_size, stride)
+        xs = tile_starts(padded.shape[1], self.tile_size, stride)
+
+        # Rows [top, top + tile_size) of the output
+        output = np.zeros((self.tile_size, padded.shape[1], 3), dtype=np.float32)
+        weight_sum = np.zeros((self.tile_size, padded.shape[1], 1), dtype=np.float32)
+        top = 0
+
+        for j, y in enumerate(ys):
+            # Move the band down to start at y, the rows above were already yielded
+            shift = y - top
+            if shift > 0:
+                output[:-shift] = output[shift:].copy()
+                weight_sum[:-shift] = weight_sum[shift:].copy()
+                output[-shift:] = 0
+                weight_sum[-shift:] = 0
+                top = y
+
+            for i in range(0, len(xs), self.batch_size):
+                batch_xs = xs[i:i + self.batch_size]
+
+                tiles = np.stack([padded[y:y + self.tile_size, x:x + self.tile_size] for x in batch_xs])
+                tiles = tiles.astype(np.float32) / 127.5 - 1
+
+                generated = self.run(tf.constant(tiles)).numpy()
+
+                for x, tile in zip(batch_xs, generated):
+                    output[:, x:x + self.tile_size] += tile * self.weights
+                    weight_sum[:, x:x + self.tile_size] += self.weights
+
+            # Rows before the next band are finished
+            end = min(ys[j + 1] if j + 1 < len(ys) else top + self.tile_size, height)
+
+            if end > top:
+                rows = output[:end - top, :width] / weight_sum[:end - top, :width]
+                yield top, np.clip((rows + 1) * 127.5 + 0.5, 0, 255).astype(np.uint8)
+
+    def __call__(self, image):
+        """
+        :param image: uint8, shape == (height, width, 3)
+        :return: Generated image, uint8, shape == (height, width, 3)
+        """
+        result = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
+
+        for top, rows in self.bands(image):
+            result[top:top + len(rows)] = rows
+
+        return result
+
+
+def load_generator(checkpoint_path, direction='a2b'):
+    """
+    Restore one generator of the latest CycleGAN checkpoint in checkpoint_path.
+
+    :param direction: 'a2b' or 'b2a'
+    """
+    generator = ResNetGenerator()
+
+    checkpoint = tf.train.Checkpoint(**{'generator_' + direction: generator})
+    latest = tf.train.latest_checkpoint(checkpoint_path)
+    assert latest is not None, 'No checkpoint in {}'.format(checkpoint_path)
+
+    checkpoint.restore(latest).expect_partial()
+    print('Restored generator_{} from {}'.format(direction, latest))
+
+    return generator
+
+
+def translate_folder(tiled_generator, input_folder, output_folder):
+    """
+    Translate every jpg and png of input_folder, one image at a time, into output_folder with the same file names.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    files = sorted(p for p in pathlib.Path(input_folder).iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+
+    for i, file in enumerate(files):
+        image = tf.image.decode_image(tf.io.read_file(str(file)), channels=3, expand_animations=False).numpy()
+
+        translated = tiled_generator(image)
+
+        if file.suffix.lower() == '.png':
+            encoded = tf.io.encode_png(translated)
+        else:
+            encoded = tf.io.encode_jpeg(translated, quality=95)
+
+        tf.io.write_file(os.path.join(output_folder, file.name), encoded)
+        print('{}/{} {} {}x{}'.format(i + 1, len(files), file.name, image.shape[1], image.shape[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translate a folder of images of any size with a CycleGAN generator, tile by tile')
+    parser.add_argument('--checkpoint', default='./checkpoints/monet', help='CycleGAN checkpoint directory')
+    parser.add_argument('--direction', default='a2b', choices=['a2b', 'b2a'], help='Generator to run')
+    parser.add_argument('--input', default='dataset/custom', help='Folder of input images')
+    parser.add_argument('--output', default='dataset/custom_translated', help='Folder of translated images')
+    parser.add_argument('--tile', type=int, default=256, help='Tile size')
+    parser.add_argument('--overlap', type=int, default=32, help='Overlap of neighbouring tiles')
+    parser.add_argument('--batch', type=int, default=8, help='Tiles run at a time')
+    args = parser.parse_args()
+
+    tiled = TiledGenerator(load_generator(args.checkpoint, args.direction), tile_size=args.tile, overlap=args.overlap, batch_size=args.batch)
+    translate_folder(tiled, args.input, args.output)
@@ -0,0 +1,54 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def bucket_by_length(dataset, max_length, tokens_per_batch, bucket_width=4):
+    """
+    Group (inp, tar) pairs of similar length into batches, so most of each batch is real tokens instead of padding.
+    Each bucket gets its own batch size, keeping about tokens_per_batch tokens per batch.
+    Batches are padded to their own longest sequence, shapes stay (None, None) for train_step's input_signature.
+
+    :param dataset: Dataset of (inp, tar) 1-D sequences no longer than max_length
+    :param max_length: Maximum sequence length
+    :param tokens_per_batch: Token budget of a batch, batch_size * sequence length
+    :param bucket_width: Length range of a bucket
+    :return: Batched dataset
+    """
+    # Bucket i holds lengths in [boundaries[i - 1], boundaries[i])
+    boundaries = list(range(bucket_width + 1, max_length + 1, bucket_width))
+    bucket_max_lengths = [b - 1 for b in boundaries] + [max_length]
+    batch_sizes = [max(1, tokens_per_batch // length) for length in bucket_max_lengths]
+
+    def element_length(inp, tar):
+        return tf.maximum(tf.shape(inp)[0], tf.shape(tar)[0])
+
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(element_length,
+                                                                        bucket_boundaries=boundaries,
+                                                                        bucket_batch_sizes=batch_sizes,
+                                                                        padded_shapes=([None], [None])))
+
+
+def report_batches(name, dataset, step=None, max_batches=None):
+    """
+    Print the padding ratio of a batched (inp, tar) dataset and tokens/sec, of step if given or of iterating otherwise.
+    step must not update the model being trained, e.g. a forward only step.
+    """
+    real_tokens = 0
+    total_tokens = 0
+
+    start = time.time()
+    for batch, (inp, tar) in enumerate(dataset):
+        if max_batches is not None and batch >= max_batches:
+            break
+
+        if step is not None:
+            step(inp, tar)
+
+        inp = inp.numpy()
+        tar = tar.numpy()
+        real_tokens += np.count_nonzero(inp) + np.count_nonzero(tar)
+        total_tokens += inp.size + tar.size
+    elapsed = time.time() - start
+
+    print('{}: padding ratio {:.3f}, {:.1f} tokens/sec'.format(name, 1 - real_tokens / max(total_tokens, 1), real_tokens / elapsed))
@@ -0,0 +1,110 @@
+import time
+from ch29_transformer.models import *
+
+# Compares the full recompute decoding loop with the cached incremental decoding.
+# Uses a randomly initialized model with the same size as transformer.py, every run decodes exactly MAX_LENGTH tokens.
+
+MAX_LENGTH = 40
+REPEAT = 5
+
+num_layers = 4
+d_model = 128
+dff = 512
+num_heads = 8
+
+input_vocab_size = 8216
+target_vocab_size = 8089
+input_length = 30
+
+transformer = Transformer(num_layers, d_model, num_heads, dff,
+                          input_vocab_size, target_vocab_size,
+                          pe_input=input_vocab_size,
+                          pe_target=target_vocab_size,
+                          dropout_rate=0.1)
+
+
+def create_masks(inp, tar):
+    enc_padding_mask = create_padding_mask(inp)
+    dec_padding_mask = create_padding_mask(inp)
+
+    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1], MAX_LENGTH + 1)
+    dec_target_padding_mask = create_padding_mask(tar)
+    combined_mask = tf.logical_or(dec_target_padding_mask, look_ahead_mask)
+
+    return enc_padding_mask, combined_mask, dec_padding_mask
+
+
+# Traced once for any output length, so both loops run in graph mode
+@tf.function(input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+                              tf.TensorSpec(shape=(None, None), dtype=tf.int32)])
+def full_step(encoder_input, output):
+    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
+
+    predictions = transformer(encoder_input, output, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    return predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
+
+
+def evaluate_full(encoder_input):
+    output = tf.expand_dims([target_vocab_size - 2], 0)
+    logits = []
+
+    for i in range(MAX_LENGTH):
+        predictions = full_step(encoder_input, output)
+        logits.append(predictions)
+
+        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
+        output = tf.concat([output, predicted_id], axis=-1)
+
+    return output, logits
+
+
+@tf.function
+def decode_step(target_token, cache, step, dec_padding_mask):
+    return transformer.decode_step(target_token, cache, step, dec_padding_mask)
+
+
+def evaluate_cached(encoder_input):
+    enc_padding_mask = create_padding_mask(encoder_input)
+    cache = transformer.init_decoding(encoder_input, enc_padding_mask, MAX_LENGTH)
+
+    output = tf.expand_dims([target_vocab_size - 2], 0)
+    logits = []
+
+    for i in range(MAX_LENGTH):
+        predictions, cache = decode_step(output[:, -1:], cache, tf.constant(i), enc_padding_mask)
+        logits.append(predictions)
+
+        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
+        output = tf.concat([output, predicted_id], axis=-1)
+
+    return output, logits
+
+
+def benchmark(name, evaluate, encoder_input):
+    # Warm up, builds the model and traces the tf.function
+    evaluate(encoder_input)
+
+    start = time.time()
+    for _ in range(REPEAT):
+        evaluate(encoder_input)
+    elapsed = time.time() - start
+
+    print('{}: {:.1f} tokens/sec'.format(name, MAX_LENGTH * REPEAT / elapsed))
+
+    return MAX_LENGTH * REPEAT / elapsed
+
+
+encoder_input = tf.random.uniform((1, input_length), 1, input_vocab_size - 2, dtype=tf.int32)
+
+# Both loops must predict the same tokens
+output_full, logits_full = evaluate_full(encoder_input)
+output_cached, logits_cached = evaluate_cached(encoder_input)
+
+assert np.array_equal(output_full.numpy(), output_cached.numpy())
+for a, b in zip(logits_full, logits_cached):
+    assert np.allclose(a.numpy(), b.numpy(), atol=1e-4)
+
+full = benchmark('Full recompute', evaluate_full, encoder_input)
+cached = benchmark('KV cached', evaluate_cached, encoder_input)
+
+print('Speedup: {:.2f}x'.format(cached / full))
@@ -0,0 +1,94 @@
+import tensorflow as tf
+
+# Compute dtype of each precision mode. Variables are always float32.
+PRECISIONS = {
+    'float32': 'float32',
+    'mixed_bfloat16': 'bfloat16',
+    'mixed_float16': 'float16',
+}
+
+
+def cpu_supports_bfloat16():
+    """
+    True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX-BF16). Only Linux is checked.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def gpu_compute_capabilities():
+    capabilities = []
+
+    for gpu in tf.config.list_physical_devices('GPU'):
+        details = tf.config.experimental.get_device_details(gpu)
+        capabilities.append(details.get('compute_capability', (0, 0)))
+
+    return capabilities
+
+
+def precision_supported(precision):
+    """
+    A mixed precision mode is only worth it when the device computes its dtype natively,
+    float16 needs a GPU with Tensor Cores (compute capability 7.0), bfloat16 a GPU of compute capability 8.0 or a bfloat16 CPU.
+    """
+    if precision == 'float32':
+        return True
+
+    capabilities = gpu_compute_capabilities()
+
+    if precision == 'mixed_float16':
+        return len(capabilities) > 0 and all(c >= (7, 0) for c in capabilities)
+
+    if precision == 'mixed_bfloat16':
+        if len(capabilities) > 0:
+            return all(c >= (8, 0) for c in capabilities)
+        return cpu_supports_bfloat16()
+
+    raise ValueError('Unknown precision: {}, must be one of {}'.format(precision, list(PRECISIONS)))
+
+
+def set_precision(precision):
+    """
+    Set the Keras global dtype policy. Must be called before the model is created.
+    Falls back to float32 when the device has no native support for the requested dtype.
+
+    :param precision: 'float32', 'mixed_bfloat16' or 'mixed_float16'
+    :return: The precision actually used
+    """
+    if not precision_supported(precision):
+        print('{} is not supported natively on this device, falling back to float32'.format(precision))
+        precision = 'float32'
+
+    if hasattr(tf.keras.mixed_precision, 'set_global_policy'):
+        tf.keras.mixed_precision.set_global_policy(precision)
+    else:
+        tf.keras.mixed_precision.experimental.set_policy(precision)
+
+    return precision
+
+
+def loss_scale_optimizer(optimizer, precision):
+    """
+    Wrap the optimizer with dynamic loss scaling for float16, whose gradients would underflow otherwise.
+    bfloat16 has the exponent range of float32 and needs no loss scaling.
+    """
+    if precision != 'mixed_float16':
+        return optimizer
+
+    if hasattr(tf.keras.mixed_precision, 'LossScaleOptimizer'):
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+    return tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale='dynamic')
+
+
+def scale_loss(optimizer, loss):
+    return optimizer.get_scaled_loss(loss) if hasattr(optimizer, 'get_scaled_loss') else loss
+
+
+def unscale_gradients(optimizer, gradients):
+    return optimizer.get_unscaled_gradients(gradients) if hasattr(optimizer, 'get_unscaled_gradients') else gradients
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+
+class TokenCache:
+    def __init__(self, directory):
+        """
+        Disk cache of subword tokenizers and tokenized corpora, so the corpus is tokenized once instead of on every run.
+        Each tokenized corpus is stored as two arrays, {name}-ids.npy with every sequence concatenated as int16
+        and {name}-offsets.npy where sequence i is ids[offsets[i]:offsets[i + 1]].
+        {name}-vocab.txt holds the hash of the vocabulary which encoded the corpus, a corpus encoded by another vocabulary is not reused.
+
+        :param directory: Where the tokenizers and the arrays are stored
+        """
+        self.directory = directory
+
+        os.makedirs(directory, exist_ok=True)
+
+    def tokenizer_prefix(self, name):
+        return os.path.join(self.directory, 'tokenizer_' + name)
+
+    def tokenizer(self, name, corpus, target_vocab_size=2 ** 13):
+        """
+        Load the tokenizer saved under name, or build it from the corpus and save it.
+
+        :param corpus: Function returning an iterable of the corpus strings, only called when building
+        """
+        prefix = self.tokenizer_prefix(name)
+
+        if os.path.exists(prefix + '.subwords'):
+            return tfds.features.text.SubwordTextEncoder.load_from_file(prefix)
+
+        tokenizer = tfds.features.text.SubwordTextEncoder.build_from_corpus(corpus(), target_vocab_size=target_vocab_size)
+        tokenizer.save_to_file(prefix)
+
+        return tokenizer
+
+    def vocab_hash(self, tokenizer_name):
+        """
+        :return: sha1 of the vocabulary file of the tokenizer saved under tokenizer_name
+        """
+        with open(self.tokenizer_prefix(tokenizer_name) + '.subwords', 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def paths(self, name):
+        return os.path.join(self.directory, name + '-ids.npy'), os.path.join(self.directory, name + '-offsets.npy')
+
+    def vocab_path(self, name):
+        return os.path.join(self.directory, name + '-vocab.txt')
+
+    def cached(self, name, tokenizer_name):
+        """
+        True if the corpus is cached and was encoded by the current vocabulary of the tokenizer saved under tokenizer_name.
+        """
+        # The offsets are written last, an interrupted write is not a cached corpus
+        if not os.path.exists(self.paths(name)[1]) or not os.path.exists(self.vocab_path(name)):
+            return False
+
+        with open(self.vocab_path(name), 'r', encoding='utf-8') as f:
+            return f.read().strip() == self.vocab_hash(tokenizer_name)
+
+    def write(self, name, sequences, tokenizer_name):
+        """
+        :param sequences: Iterable of token id sequences
+        :param tokenizer_name: Name of the saved tokenizer which encoded the sequences
+        """
+        sequences = [np.asarray(s, dtype=np.int64) for s in sequences]
+
+        ids = np.concatenate(sequences) if len(sequences) > 0 else np.zeros(0, dtype=np.int64)
+        assert ids.size == 0 or (ids.min() >= 0 and ids.max() <= np.iinfo(np.int16).max), 'Token ids must fit in int16'
+
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in sequences])
+
+        ids_path, offsets_path = self.paths(name)
+
+        # Removed first, so a cache interrupted while rewritten is never read with the old offsets
+        if os.path.exists(offsets_path):
+            os.remove(offsets_path)
+
+        np.save(ids_path, ids.astype(np.int16))
+
+        with open(self.vocab_path(name), 'w', encoding='utf-8') as f:
+            f.write(self.vocab_hash(tokenizer_name))
+
+        np.save(offsets_path, offsets)
+
+    def read(self, name):
+        """
+        :return: ids, offsets
+        """
+        ids_path, offsets_path = self.paths(name)
+
+        return np.load(ids_path, mmap_mode='r'), np.load(offsets_path)
+
+    def dataset(self, name):
+        """
+        Dataset of the int64 token id sequences of a cached corpus, sliced in the graph without any Python per example.
+        """
+        ids, offsets = self.read(name)
+
+        ids = tf.constant(ids)
+        offsets = tf.constant(offsets)
+
+        def sequence(i):
+            return tf.cast(ids[offsets[i]:offsets[i + 1]], tf.int64)
+
+        return tf.data.Dataset.range(len(offsets) - 1).map(sequence, num_parallel_calls=tf.data.experimental.AUTOTUNE)
@@ -2,13 +2,20 @@ import matplotlib.pyplot as plt
 import time
 import os
 from ch29_transformer.models import *
+from ch29_transformer.bucketing import *
+from ch29_transformer.token_cache import *
+from ch29_transformer.precision import *
+from ch25_checkpoints.checkpoint_service import *
 import tensorflow_datasets as tfds
 
 examples, metadata = tfds.load('ted_hrlr_translate/pt_to_en', with_info=True, as_supervised=True)
 train_examples, val_examples = examples['train'], examples['validation']
 
-tokenizer_en = tfds.features.text.SubwordTextEncoder.build_from_corpus((en.numpy() for pt, en in train_examples), target_vocab_size=2 ** 13)
-tokenizer_pt = tfds.features.text.SubwordTextEncoder.build_from_corpus((pt.numpy() for pt, en in train_examples), target_vocab_size=2 ** 13)
+# Tokenizers and tokenized examples are built on the first run only
+token_cache = TokenCache('./token_cache/ted_hrlr_translate_pt_to_en')
+
+tokenizer_en = token_cache.tokenizer('en', lambda: (en.numpy() for pt, en in train_examples))
+tokenizer_pt = token_cache.tokenizer('pt', lambda: (pt.numpy() for pt, en in train_examples))
 
 # sample_string = 'Transformer is awesome.'
 #
@@ -23,35 +30,40 @@ tokenizer_pt = tfds.features.text.SubwordTextEncoder.build_from_corpus((pt.numpy
 BUFFER_SIZE = 20000
 BATCH_SIZE = 64
 MAX_LENGTH = 40
+TOKENS_PER_BATCH = BATCH_SIZE * MAX_LENGTH  # Token budget of a length bucketed batch
+REPORT_BUCKETING = False  # Compare padding and speed of plain padded batches against bucketed batches
 
 
-def encode(lang1, lang2):
-    lang1 = [tokenizer_pt.vocab_size] + tokenizer_pt.encode(lang1.numpy()) + [tokenizer_pt.vocab_size + 1]
-    lang2 = [tokenizer_en.vocab_size] + tokenizer_en.encode(lang2.numpy()) + [tokenizer_en.vocab_size + 1]
-
-    return lang1, lang2
+def encode(tokenizer, sentence):
+    return [tokenizer.vocab_size] + tokenizer.encode(sentence) + [tokenizer.vocab_size + 1]
 
 
-def tf_encode(pt, en):
-    result_pt, result_en = tf.py_function(encode, [pt, en], [tf.int64, tf.int64])
-    result_pt.set_shape([None])
-    result_en.set_shape([None])
+def load_encoded(name, examples):
+    """
+    :return: Dataset of encoded (pt, en) pairs, read from the token cache
+    """
+    for lang, tokenizer, column in (('pt', tokenizer_pt, 0), ('en', tokenizer_en, 1)):
+        # Encoded again if the tokenizer was rebuilt or replaced
+        if not token_cache.cached(name + '_' + lang, lang):
+            token_cache.write(name + '_' + lang, (encode(tokenizer, example[column].numpy()) for example in examples), lang)
 
-    return result_pt, result_en
+    return tf.data.Dataset.zip((token_cache.dataset(name + '_pt'), token_cache.dataset(name + '_en')))
 
 
 def filter_max_length(x, y, max_length=MAX_LENGTH):
     return tf.logical_and(tf.size(x) <= max_length, tf.size(y) <= max_length)
 
 
-train_dataset = train_examples.map(tf_encode)
+train_dataset = load_encoded('train', train_examples)
 train_dataset = train_dataset.filter(filter_max_length)
 # Cache the dataset to memory to get a speedup while reading from it.
 train_dataset = train_dataset.cache()
-train_dataset = train_dataset.shuffle(BUFFER_SIZE).padded_batch(BATCH_SIZE)
-train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+train_examples_encoded = train_dataset
+# Batch pairs of similar length together, with larger batches for shorter buckets
+train_dataset = bucket_by_length(train_dataset.shuffle(BUFFER_SIZE), MAX_LENGTH, TOKENS_PER_BATCH)
+train_dataset = train_dataset.shuffle(BUFFER_SIZE // BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
 
-val_dataset = val_examples.map(tf_encode)
+val_dataset = load_encoded('validation', val_examples)
 val_dataset = val_dataset.filter(filter_max_length).padded_batch(BATCH_SIZE)
 
 # pt_batch, en_batch = next(iter(val_dataset))
@@ -67,6 +79,11 @@ val_dataset = val_dataset.filter(filter_max_length).padded_batch(BATCH_SIZE)
 # plt.colorbar()
 # plt.show()
 
+# 'float32', 'mixed_bfloat16' or 'mixed_float16'. Mixed modes compute in 16 bits with float32 weights,
+# and fall back to float32 on devices without native support.
+PRECISION = 'float32'
+precision = set_precision(PRECISION)
+
 num_layers = 4
 d_model = 128
 dff = 512
@@ -84,6 +101,7 @@ learning_rate = CustomSchedule(d_model)
 # plt.show()
 
 optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+optimizer = loss_scale_optimizer(optimizer, precision)
 
 loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 
@@ -114,6 +132,8 @@ def accuracy_function(real, pred):
 
 train_loss = tf.keras.metrics.Mean(name='train_loss')
 train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
+# Non padding tokens trained on, counted on the device so the batches are never copied back to the host
+train_tokens = tf.Variable(0, dtype=tf.int64, trainable=False)
 
 transformer = Transformer(num_layers, d_model, num_heads, dff,
                           input_vocab_size, target_vocab_size,
@@ -128,28 +148,28 @@ def create_masks(inp, tar):
 
     # Used in the 2nd attention block in the decoder.
     # This padding mask is used to mask the encoder outputs.
-    dec_padding_mask = create_padding_mask(inp)
+    dec_padding_mask = enc_padding_mask
 
     # Used in the 1st attention block in the decoder.
     # It is used to pad and mask future tokens in the input received by the decoder.
-    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    # The look ahead mask is sliced from a table computed once
+    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1], MAX_LENGTH)
     dec_target_padding_mask = create_padding_mask(tar)
-    combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+    combined_mask = tf.logical_or(dec_target_padding_mask, look_ahead_mask)
 
     return enc_padding_mask, combined_mask, dec_padding_mask
 
 
 checkpoint_path = os.path.abspath('.') + "/checkpoints/train"
 
-ckpt = tf.train.Checkpoint(transformer=transformer,
-                           optimizer=optimizer)
-
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=5)
+# Checkpoints are written in the background, and hold the epoch and the random states with the model and the optimizer
+checkpoints = CheckpointService(checkpoint_path, max_to_keep=5, transformer=transformer, optimizer=optimizer)
 
 # if a checkpoint exists, restore the latest checkpoint.
-if ckpt_manager.latest_checkpoint:
-    ckpt.restore(ckpt_manager.latest_checkpoint)
-    print('Latest checkpoint restored!!')
+if checkpoints.restore():
+    print('Latest checkpoint of epoch {} restored!!'.format(int(checkpoints.epoch.numpy())))
+
+start_epoch = int(checkpoints.epoch.numpy())
 
 EPOCHS = 20
 
@@ -175,19 +195,39 @@ def train_step(inp, tar):
     with tf.GradientTape() as tape:
         predictions = transformer(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask)
         loss = loss_function(tar_real, predictions)
+        scaled_loss = scale_loss(optimizer, loss)  # Loss scaling of mixed_float16, loss itself otherwise
 
-    gradients = tape.gradient(loss, transformer.trainable_variables)
+    gradients = unscale_gradients(optimizer, tape.gradient(scaled_loss, transformer.trainable_variables))
     optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
 
     train_loss(loss)
     train_accuracy(accuracy_function(tar_real, predictions))
+    train_tokens.assign_add(tf.math.count_nonzero(inp) + tf.math.count_nonzero(tar))
+
+
+# Forward pass and loss only, so the bucketing report doesn't train the model it measures
+@tf.function(input_signature=train_step_signature)
+def forward_step(inp, tar):
+    tar_inp = tar[:, :-1]
+    tar_real = tar[:, 1:]
+
+    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+
+    predictions = transformer(inp, tar_inp, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    return loss_function(tar_real, predictions)
+
 
+if REPORT_BUCKETING:
+    report_batches('Padded batches', train_examples_encoded.shuffle(BUFFER_SIZE).padded_batch(BATCH_SIZE), forward_step, max_batches=200)
+    report_batches('Bucketed batches', train_dataset, forward_step, max_batches=200)
 
-for epoch in range(EPOCHS):
+# Continues from the restored epoch up to EPOCHS
+for epoch in range(start_epoch, EPOCHS):
     start = time.time()
 
     train_loss.reset_states()
     train_accuracy.reset_states()
+    train_tokens.assign(0)
 
     # inp -> portuguese, tar -> english
     for (batch, (inp, tar)) in enumerate(train_dataset):
@@ -197,12 +237,25 @@ for epoch in range(EPOCHS):
             print('Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch + 1, batch, train_loss.result(), train_accuracy.result()))
 
     if (epoch + 1) % 1 == 0:
-        ckpt_save_path = ckpt_manager.save()
+        ckpt_save_path = checkpoints.save(step=optimizer.iterations, epoch=epoch + 1)
         print('Saving checkpoint for epoch {} at {}'.format(epoch + 1, ckpt_save_path))
 
+    checkpoints.log_metrics(optimizer.iterations, epoch + 1, loss=train_loss.result(), accuracy=train_accuracy.result())
+
     print('Epoch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch + 1, train_loss.result(), train_accuracy.result()))
+    print('Tokens/sec: {:.1f}'.format(int(train_tokens.numpy()) / (time.time() - start)))
     print('Time taken for 1 epoch: {} secs\n'.format(time.time() - start))
 
+checkpoints.wait()
+
+
+# Incremental decoding step. The self attention cache has a fixed shape of MAX_LENGTH positions,
+# but the cached encoder keys and values and dec_padding_mask have the input sentence length,
+# relaxed shapes trace a generic length after the first lengths instead of once per sentence length.
+@tf.function(experimental_relax_shapes=True)
+def decode_step(target_token, cache, step, dec_padding_mask):
+    return transformer.decode_step(target_token, cache, step, dec_padding_mask)
+
 
 def evaluate(inp_sentence):
     start_token = [tokenizer_pt.vocab_size]
@@ -212,34 +265,28 @@ def evaluate(inp_sentence):
     inp_sentence = start_token + tokenizer_pt.encode(inp_sentence) + end_token
     encoder_input = tf.expand_dims(inp_sentence, 0)
 
-    # as the target is english, the first word to the transformer should be the english start token.
-    decoder_input = [tokenizer_en.vocab_size]
-    output = tf.expand_dims(decoder_input, 0)
+    enc_padding_mask = create_padding_mask(encoder_input)
 
-    for i in range(MAX_LENGTH):
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
+    # Encoder runs only once, keys and values of the decoder are cached per layer
+    cache = transformer.init_decoding(encoder_input, enc_padding_mask, MAX_LENGTH)
 
-        # predictions.shape == (batch_size, seq_len, vocab_size)
-        predictions = transformer(encoder_input,
-                                  output,
-                                  False,
-                                  enc_padding_mask,
-                                  combined_mask,
-                                  dec_padding_mask)
+    # as the target is english, the first word to the transformer should be the english start token.
+    output = [tokenizer_en.vocab_size]
 
-        # select the last word from the seq_len dimension
-        predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
+    for i in range(MAX_LENGTH):
+        # predictions.shape == (batch_size, 1, vocab_size)
+        predictions, cache = decode_step(tf.constant([[output[-1]]]), cache, tf.constant(i), enc_padding_mask)
 
-        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
+        predicted_id = int(tf.argmax(predictions[0, -1, :]))
 
         # return the result if the predicted_id is equal to the end token
         if predicted_id == tokenizer_en.vocab_size + 1:
-            return tf.squeeze(output, axis=0)
+            break
 
-        # concatenate the predicted_id to the output which is given to the decoder as its input.
-        output = tf.concat([output, predicted_id], axis=-1)
+        # append the predicted_id to the output which is given to the decoder as its input.
+        output.append(predicted_id)
 
-    return tf.squeeze(output, axis=0)
+    return tf.constant(output, dtype=tf.int32)
 
 
 def translate(sentence):
@@ -0,0 +1,107 @@
+import time
+from ch30_transformer_captioning.layers import *
+
+# Compares the previous MultiHeadAttention (3 Dense projections, transposed heads, float mask)
+# with the current one (fused QKV projection, einsum heads, boolean mask) at the encoder shapes of image_captioning.py
+
+BATCH_SIZE = 80
+SEQ_LEN = 128
+d_model = 512
+num_heads = 8
+REPEAT = 50
+
+
+class ReferenceMultiHeadAttention(tf.keras.layers.Layer):
+    def __init__(self, d_model, num_heads):
+        super(ReferenceMultiHeadAttention, self).__init__()
+        self.num_heads = num_heads
+        self.d_model = d_model
+
+        assert d_model % self.num_heads == 0
+
+        self.depth = d_model // self.num_heads
+
+        self.wq = tf.keras.layers.Dense(d_model)
+        self.wk = tf.keras.layers.Dense(d_model)
+        self.wv = tf.keras.layers.Dense(d_model)
+
+        self.dense = tf.keras.layers.Dense(d_model)
+
+    def split_heads(self, x, batch_size):
+        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
+        return tf.transpose(x, perm=[0, 2, 1, 3])
+
+    def call(self, v, k, q, mask):
+        batch_size = tf.shape(q)[0]
+
+        q = self.wq(q)  # (batch_size, seq_len, d_model)
+        k = self.wk(k)  # (batch_size, seq_len, d_model)
+        v = self.wv(v)  # (batch_size, seq_len, d_model)
+
+        q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
+        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
+        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+
+        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+
+        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
+        concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
+
+        output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
+
+        return output, attention_weights
+
+
+reference = ReferenceMultiHeadAttention(d_model, num_heads)
+fused = MultiHeadAttention(d_model, num_heads)
+
+x = tf.random.normal((BATCH_SIZE, SEQ_LEN, d_model))
+
+# Padding of the last 8 positions, as float(1 to mask) and bool(True to mask)
+padding = tf.concat([tf.zeros((BATCH_SIZE, SEQ_LEN - 8)), tf.ones((BATCH_SIZE, 8))], axis=-1)
+float_mask = padding[:, tf.newaxis, tf.newaxis, :]
+bool_mask = tf.cast(float_mask, tf.bool)
+
+# Build both layers and share the weights
+reference(x, x, x, float_mask)
+fused(x, x, x, bool_mask, self_attention=True)
+fused.set_weights(reference.get_weights())
+
+
+@tf.function
+def run_reference(x):
+    return reference(x, x, x, float_mask)[0]
+
+
+@tf.function
+def run_fused(x):
+    return fused(x, x, x, bool_mask, self_attention=True)[0]
+
+
+@tf.function
+def run_fused_without_weights(x):
+    return fused(x, x, x, bool_mask, return_attention=False, self_attention=True)[0]
+
+
+assert np.allclose(run_reference(x).numpy(), run_fused(x).numpy(), atol=1e-4)
+
+
+def benchmark(name, run):
+    run(x).numpy()
+
+    start = time.time()
+    for _ in range(REPEAT):
+        result = run(x)
+    result.numpy()
+    elapsed = (time.time() - start) / REPEAT
+
+    print('{}: {:.2f} ms'.format(name, elapsed * 1000))
+
+    return elapsed
+
+
+reference_time = benchmark('Reference MultiHeadAttention', run_reference)
+fused_time = benchmark('Fused MultiHeadAttention', run_fused)
+fused_time_without_weights = benchmark('Fused MultiHeadAttention, no attention_weights', run_fused_without_weights)
+
+print('Speedup: {:.2f}x, {:.2f}x without attention_weights'.format(reference_time / fused_time, reference_time / fused_time_without_weights))
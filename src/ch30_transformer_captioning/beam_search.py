@@ -0,0 +1,131 @@
+from ch30_transformer_captioning.models import *
+
+
+class BeamSearchDecoder(tf.Module):
+    def __init__(self, transformer, start_token, end_token, max_length, beam_width=3, alpha=0.6, feature_shape=(64, 2560)):
+        """
+        Batched beam search over image features, compiled as a single tf.function.
+        Every buffer has a fixed shape of (batch_size, beam_width, ...), finished sequences stop growing on their own
+        and the loop exits as soon as every sequence of the batch is finished.
+
+        :param transformer: Trained captioning Transformer
+        :param start_token: Index of '<start>'
+        :param end_token: Index of '<end>'
+        :param max_length: Maximum number of tokens to generate
+        :param beam_width: Number of beams per image
+        :param alpha: Length normalization strength, score = log_prob / ((5 + length) / 6) ** alpha
+        :param feature_shape: Shape of an extracted image feature
+        """
+        super(BeamSearchDecoder, self).__init__()
+
+        self.transformer = transformer
+        self.start_token = start_token
+        self.end_token = end_token
+        self.max_length = max_length
+        self.beam_width = beam_width
+        self.alpha = alpha
+
+        self.search = tf.function(self._search, input_signature=[tf.TensorSpec(shape=(None,) + tuple(feature_shape), dtype=tf.float32)])
+
+    def length_penalty(self, length):
+        return tf.pow((5.0 + tf.cast(length, tf.float32)) / 6.0, self.alpha)
+
+    def gather_beams(self, x, beam_indices, batch_size):
+        """
+        Reorder the beams of x, shape == (batch_size * beam_width, ...)
+        """
+        x = tf.reshape(x, tf.concat([[batch_size, self.beam_width], tf.shape(x)[1:]], axis=0))
+        x = tf.gather(x, beam_indices, batch_dims=1)
+
+        return tf.reshape(x, tf.concat([[batch_size * self.beam_width], tf.shape(x)[2:]], axis=0))
+
+    def _search(self, features):
+        """
+        :param features: shape == (batch_size, 64, 2560)
+        :return: sequences, shape == (batch_size, max_length + 1) starting with '<start>' and padded with 0,
+                 scores, shape == (batch_size,) length normalized log probabilities
+        """
+        batch_size = tf.shape(features)[0]
+        beam_width = self.beam_width
+
+        # Encoder input has no padding, so no mask is needed. Encoder output is shared by the beams of an image.
+        cache = self.transformer.init_decoding(features, None, self.max_length)
+        cache = [{key: tf.repeat(value, beam_width, axis=0) for key, value in layer_cache.items()} for layer_cache in cache]
+
+        sequences = tf.concat([tf.fill((batch_size, beam_width, 1), self.start_token),
+                               tf.zeros((batch_size, beam_width, self.max_length), dtype=tf.int32)], axis=-1)
+
+        # Only the first beam is alive at the beginning, otherwise every beam would pick the same tokens
+        log_probs = tf.tile([[0.0] + [-1e9] * (beam_width - 1)], [batch_size, 1])  # (batch_size, beam_width)
+        lengths = tf.zeros((batch_size, beam_width), dtype=tf.int32)
+        finished = tf.zeros((batch_size, beam_width), dtype=tf.bool)
+
+        for step in tf.range(self.max_length):
+            if tf.reduce_all(finished):
+                break
+
+            tokens = tf.reshape(tf.gather(sequences, step, axis=2), (-1, 1))  # (batch_size * beam_width, 1)
+
+            predictions, cache = self.transformer.decode_step(tokens, cache, step, None)
+            vocab_size = tf.shape(predictions)[-1]
+
+            step_log_probs = tf.nn.log_softmax(predictions[:, 0, :], axis=-1)
+            step_log_probs = tf.reshape(step_log_probs, (batch_size, beam_width, vocab_size))
+
+            # Finished beams can only be continued with <pad>, without changing their log probability
+            pad_only = tf.where(tf.equal(tf.range(vocab_size), 0), 0.0, -1e9)
+            step_log_probs = tf.where(finished[:, :, tf.newaxis], pad_only, step_log_probs)
+
+            candidate_log_probs = log_probs[:, :, tf.newaxis] + step_log_probs  # (batch_size, beam_width, vocab_size)
+            candidate_lengths = tf.where(finished, lengths, step + 1)[:, :, tf.newaxis]
+            candidate_scores = candidate_log_probs / self.length_penalty(candidate_lengths)
+
+            candidate_scores = tf.reshape(candidate_scores, (batch_size, -1))
+            _, top_indices = tf.math.top_k(candidate_scores, k=beam_width)  # (batch_size, beam_width)
+
+            beam_indices = top_indices // vocab_size
+            token_indices = top_indices % vocab_size
+
+            log_probs = tf.gather(tf.reshape(candidate_log_probs, (batch_size, -1)), top_indices, batch_dims=1)
+            lengths = tf.gather(tf.squeeze(candidate_lengths, -1), beam_indices, batch_dims=1)
+            was_finished = tf.gather(finished, beam_indices, batch_dims=1)
+            finished = tf.logical_or(was_finished, tf.equal(token_indices, self.end_token))
+
+            # Write the new tokens at step + 1 of the reordered sequences
+            sequences = tf.gather(sequences, beam_indices, batch_dims=1)
+            sequences += tf.one_hot(step + 1, self.max_length + 1, dtype=tf.int32)[tf.newaxis, tf.newaxis, :] * token_indices[:, :, tf.newaxis]
+
+            # Only the self attention cache depends on the beam history, encoder keys and values are identical across beams
+            cache = [dict(layer_cache,
+                          k=self.gather_beams(layer_cache['k'], beam_indices, batch_size),
+                          v=self.gather_beams(layer_cache['v'], beam_indices, batch_size)) for layer_cache in cache]
+
+        scores = log_probs / self.length_penalty(tf.maximum(lengths, 1))
+        best = tf.argmax(scores, axis=-1, output_type=tf.int32)  # (batch_size,)
+
+        return tf.gather(sequences, best, batch_dims=1), tf.gather(scores, best, batch_dims=1)
+
+    def __call__(self, features):
+        return self.search(features)
+
+    def caption_dataset(self, dataset):
+        """
+        Caption every image of a dataset of (features, ...) batches.
+
+        :return: List of token lists, '<start>', '<end>' and padding removed
+        """
+        captions = []
+
+        for batch in dataset:
+            features = batch[0] if isinstance(batch, (tuple, list)) else batch
+            sequences, _ = self.search(features)
+
+            for seq in sequences.numpy():
+                tokens = []
+                for token in seq[1:]:
+                    if token == self.end_token or token == 0:
+                        break
+                    tokens.append(int(token))
+                captions.append(tokens)
+
+        return captions
@@ -0,0 +1,113 @@
+import time
+import collections
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FeatureExtractor:
+    def __init__(self, load_image, detect, embed, batch_size=128, detector_threads=4, max_batches_in_flight=2):
+        """
+        Pipelined two model feature extraction, the stored feature is concat([embed(images), detect(image) of each image], axis=-1).
+        JPEG decode and resize run in parallel tf.data map calls, the detector runs image by image on its own thread pool,
+        the image model runs on whole batches on another thread, and finished batches are written by a writer thread.
+        Up to max_batches_in_flight batches are processed at the same time, so every stage keeps running while the others work.
+
+        :param load_image: image_path -> (detector input, image model input, image_path)
+        :param detect: Single detector input -> features, shape == (feature_len, detector_feature_dim)
+        :param embed: Batch of image model inputs -> features, shape == (batch_size, feature_len, image_feature_dim)
+        :param batch_size: Batch size of the image model
+        :param detector_threads: Number of detector calls running at the same time
+        :param max_batches_in_flight: Number of batches being processed at the same time
+        """
+        self.load_image = load_image
+        self.detect = detect
+        self.embed = embed
+        self.batch_size = batch_size
+        self.detector_threads = detector_threads
+        self.max_batches_in_flight = max_batches_in_flight
+
+    def timed(self, function, *args):
+        start = time.time()
+        result = np.asarray(function(*args))
+
+        return result, time.time() - start
+
+    def write_features(self, feature_store, image_paths):
+        """
+        Extract and store the features of the images which are not stored yet. Batches are appended to feature_store in order
+        as soon as they are done, so running this again continues from where the previous run stopped.
+        Prints images/sec of each stage at the end.
+
+        :param feature_store: FeatureStore
+        :param image_paths: Image paths to extract
+        """
+        pending = [p for p in image_paths if p not in feature_store]
+
+        if len(pending) == 0:
+            return
+
+        print('Extracting features of {} images, {} already stored'.format(len(pending), len(feature_store)))
+
+        dataset = tf.data.Dataset.from_tensor_slices(pending)
+        dataset = dataset.map(self.load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(self.batch_size)
+        dataset = dataset.prefetch(self.max_batches_in_flight)
+
+        # Busy seconds of each stage, summed over the threads of the stage
+        seconds = collections.Counter()
+        in_flight = collections.deque()
+
+        def finish_oldest(writer):
+            paths, embed_future, detect_futures = in_flight.popleft()
+
+            image_features, embed_seconds = embed_future.result()
+            detections = [f.result() for f in detect_futures]
+
+            seconds['image model'] += embed_seconds
+            seconds['detector'] += sum(s for _, s in detections)
+
+            features = np.concatenate([image_features, np.stack([d for d, _ in detections])], axis=-1)
+
+            return writer.submit(self.timed, feature_store.append, features, paths)
+
+        start = time.time()
+        write_future = None
+
+        with ThreadPoolExecutor(self.detector_threads) as detector_pool, ThreadPoolExecutor(1) as embed_pool, ThreadPoolExecutor(1) as writer:
+            iterator = iter(dataset)
+
+            for _ in tqdm(range((len(pending) + self.batch_size - 1) // self.batch_size)):
+                wait_start = time.time()
+                detector_inputs, image_inputs, paths = next(iterator)
+                seconds['input wait'] += time.time() - wait_start
+
+                paths = [p.decode('utf-8') for p in paths.numpy()]
+
+                embed_future = embed_pool.submit(self.timed, self.embed, image_inputs)
+                detect_futures = [detector_pool.submit(self.timed, self.detect, detector_inputs[i]) for i in range(len(paths))]
+
+                in_flight.append((paths, embed_future, detect_futures))
+
+                if len(in_flight) >= self.max_batches_in_flight:
+                    # Writes are kept in order, one at a time
+                    if write_future is not None:
+                        seconds['write'] += write_future.result()[1]
+                    write_future = finish_oldest(writer)
+
+            while len(in_flight) > 0:
+                if write_future is not None:
+                    seconds['write'] += write_future.result()[1]
+                write_future = finish_oldest(writer)
+
+            if write_future is not None:
+                seconds['write'] += write_future.result()[1]
+
+        elapsed = time.time() - start
+        count = len(pending)
+
+        print('Extracted {} images in {:.1f} sec, {:.2f} images/sec'.format(count, elapsed, count / elapsed))
+        print('  detector: {:.2f} images/sec ({} threads)'.format(count * self.detector_threads / max(seconds['detector'], 1e-9), self.detector_threads))
+        print('  image model: {:.2f} images/sec'.format(count / max(seconds['image model'], 1e-9)))
+        print('  write: {:.2f} images/sec'.format(count / max(seconds['write'], 1e-9)))
+        print('  waited {:.1f} sec for decoding and resizing'.format(seconds['input wait']))
@@ -1,14 +1,19 @@
 from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
 
 import os
 import json
 import time
 import matplotlib.pyplot as plt
 from PIL import Image
-import pandas as pd
 from tqdm import tqdm
 from ch30_transformer_captioning.models import *
+from ch30_transformer_captioning.beam_search import *
+from ch30_transformer_captioning.feature_extractor import *
+from ch27_image_captioning.feature_store import FeatureStore
+from ch27_image_captioning.caption_index import *
+from ch27_image_captioning.caption_tokens import *
+from ch29_transformer.precision import *
+from ch25_checkpoints.checkpoint_service import *
 import io
 import tensorflow_hub as hub
 
@@ -68,76 +73,19 @@ else:
 
 PATH_FLICKR = BASE_PATH + '/flickr30k_images/flickr30k_images/'
 
-# Read the json file
-with open(annotation_train, 'r') as f:
-    annotations_train = json.load(f)
+# Captions of every annotation file are streamed once into an index on disk, later runs only load the index
+caption_index = CaptionIndex('./captions/coco', [(COCO_TRAIN, annotation_train), (COCO_VAL, annotation_val)])
 
-with open(annotation_val, 'r') as f:
-    annotations_val = json.load(f)
-
-# Store captions and image names in vectors
-all_captions = []
-all_img_name_vector = []
-
-dup = [0] * 600000
-
-# Append COCO train captions
-for annot in annotations_train['annotations']:  # ex : {'image_id': 318556, 'id': 48, 'caption': 'A very clean and well decorated empty bathroom'}
-    caption = '<start> ' + annot['caption'] + ' <end>'
-    image_id = annot['image_id']
-
-    if dup[image_id] == 2:
-        continue
-    dup[image_id] += 1
-
-    full_image_path = PATH_COCO_TRAIN + 'COCO_train2014_' + '%012d.jpg' % image_id
-
-    all_img_name_vector.append(full_image_path)
-    all_captions.append(caption)
-
-# Append COCO val captions
-for annot in annotations_val['annotations']:
-    caption = '<start> ' + annot['caption'] + ' <end>'
-    image_id = annot['image_id']
-
-    if dup[image_id] == 2:
-        continue
-    dup[image_id] += 1
-
-    full_image_path = PATH_COCO_VAL + 'COCO_val2014_' + '%012d.jpg' % image_id
-
-    all_img_name_vector.append(full_image_path)
-    all_captions.append(caption)
-
-# print(len(all_captions), len(all_img_name_vector))  # 123287
-
-flickr_dataset = pd.read_csv(PATH_FLICKR + 'results.csv', delimiter='|')
-flickr_dataset = flickr_dataset.to_numpy()
-
-# Append Flickr3k captions
-# for image_name, comment_number, comment in flickr_dataset:
-#     if type(comment) != str:
-#         continue
-#
-#     if len(str(comment).split(';')) > 1:
-#         print(str(comment).split(';')[0])
-#
-#     if int(comment_number) != 0:
-#         continue
-#
-#     caption = '<start> ' + str(comment) + ' <end>'
-#
-#     full_image_path = PATH_FLICKR + image_name
-#     all_img_name_vector.append(full_image_path)
-#     all_captions.append(caption)
-
-
-# print(len(all_captions), len(all_img_name_vector))  # 123287
-# assert False
+# Indices of the captions to train with
+selected = caption_index.select(max_captions_per_image=2)  # At most 2 captions per image
 
 # Shuffle captions and image_names together
 # Set a random state, which always guaranteed to have the same shuffle
-train_captions, img_name_vector = shuffle(all_captions, all_img_name_vector, random_state=1)
+selected = CaptionIndex.shuffle(selected, random_state=1)
+
+train_captions = ['<start> ' + caption + ' <end>' for caption in caption_index.captions(selected)]
+img_name_vector = caption_index.image_paths(selected, {COCO_TRAIN: PATH_COCO_TRAIN, COCO_VAL: PATH_COCO_VAL})
+all_captions = train_captions
 
 # Select the first N captions from the shuffled set
 # num_examples = 47
@@ -172,9 +120,6 @@ imagenet_feature_dim_b = 2048
 # Make unique with sorted(set)
 encode_train = sorted(set(img_name_vector))
 
-image_dataset = tf.data.Dataset.from_tensor_slices(encode_train)
-image_dataset = image_dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(1)
-
 frcnn = hub.load("https://tfhub.dev/tensorflow/faster_rcnn/resnet101_v1_640x640/1")
 
 num_detections = 64
@@ -191,60 +136,62 @@ loaded = np.loadtxt(path_embedding_table)
 assert np.array_equal(embedding_table, loaded)
 
 
-def extract_feature(img1, img2):
-    frcnn_output = frcnn(img1)
+def detect_objects(img1):
+    """
+    :param img1: shape == (640, 640, 3), a single image. The TF-Hub detector only takes batches of 1
+    :return: shape == (64, 512)
+    """
+    frcnn_output = frcnn(img1[tf.newaxis, ...])
+
+    class_ids = tf.cast(frcnn_output['detection_classes'][0, :num_detections], tf.int32)  # (64,)
+    detection_boxes = frcnn_output['detection_boxes'][0, :num_detections]  # (64, 4)
 
-    class_ids = tf.cast(frcnn_output['detection_classes'][:, :num_detections], tf.int32)  # (1, 64)
-    detection_boxes = frcnn_output['detection_boxes'][:, :num_detections]  # (1, 64, 4)
+    return tf.concat([tf.nn.embedding_lookup(embedding_table, class_ids), detection_boxes], axis=-1)  # (64, 508) + (64, 4) -> (64, 512)
 
-    frcnn_features = tf.concat([tf.nn.embedding_lookup(embedding_table, class_ids), detection_boxes], axis=-1)  # (1, 64, 508) + (1, 64, 4) -> (1, 64, 512)
 
+# Traced once for every batch size
+@tf.function(input_signature=[tf.TensorSpec(shape=(None, 299, 299, 3), dtype=tf.float32)])
+def embed_images(img2):
     imagenet_features = image_features_extract_model(img2)
-    imagenet_features = tf.reshape(imagenet_features, (imagenet_features.shape[0], -1, imagenet_features.shape[3]))  # (1, 64, 2048)
+
+    return tf.reshape(imagenet_features, (tf.shape(imagenet_features)[0], -1, imagenet_features.shape[3]))  # (batch_size, 64, 2048)
+
+
+def extract_feature(img1, img2):
+    frcnn_features = tf.stack([detect_objects(img1[i]) for i in range(img1.shape[0])])  # (batch_size, 64, 512)
+    imagenet_features = embed_images(img2)  # (batch_size, 64, 2048)
 
     concatenated_feature = tf.concat([imagenet_features, frcnn_features], axis=-1)  # (1, 64, 2048) + (1, 64, 512) -> (1, 64, 2560)
 
     return concatenated_feature
 
 
-# Disk-caching the features extracted from pre-trained model
-# You just have got to do this once
-# for img1, img2, path in tqdm(image_dataset):
-#
-#     extracted_feature = extract_feature(img1, img2)
-#
-#     for bf, p in zip(extracted_feature, path):
-#         path_of_feature = p.numpy().decode("utf-8")
-#         np.save(path_of_feature, bf.numpy())
-#
-# assert False
+# Disk-caching the features extracted from pre-trained model into memory-mapped shards
+# Only the images which are not stored yet are extracted, so an interrupted run continues from where it stopped
+# Decoding, the detector and Inception-V3 run concurrently, the detector on FRCNN_THREADS threads and Inception-V3 on batches of EXTRACT_BATCH_SIZE
+EXTRACT_BATCH_SIZE = 128
+FRCNN_THREADS = 4
+
+feature_store = FeatureStore('./features/inception_v3_frcnn', feature_shape=(64, 2560))
+feature_extractor = FeatureExtractor(load_image, detect_objects, embed_images, batch_size=EXTRACT_BATCH_SIZE, detector_threads=FRCNN_THREADS)
+feature_extractor.write_features(feature_store, encode_train)
 
 # Choose the top 5000 words from the vocabulary
 num_words = 20000
-tokenizer = tf.keras.preprocessing.text.Tokenizer(num_words=num_words, oov_token="<unk>", filters='!"#$%&()*+.,-/:;=?@[\]^_`{|}~ ')
-tokenizer.fit_on_texts(train_captions)
-# train_seqs = tokenizer.texts_to_sequences(train_captions)
+# The tokenizer and the tokenized captions are cached on disk, keyed by the hash of the captions
+caption_tokens = CaptionTokens('./captions/tokens', train_captions, num_words=num_words, oov_token="<unk>", filters='!"#$%&()*+.,-/:;=?@[\]^_`{|}~ ')
+tokenizer = caption_tokens.tokenizer
 
 tokenizer.word_index['<pad>'] = 0
 tokenizer.index_word[0] = '<pad>'
 
-# Saving tokenizer
-# tokenizer_json = tokenizer.to_json()
-# with io.open('tokenizer.json', 'w', encoding='utf-8') as f:
-#     f.write(json.dumps(tokenizer_json, ensure_ascii=False))
-# assert False
-
-# Create the tokenized vectors
-train_seqs = tokenizer.texts_to_sequences(train_captions)
-
-cap_vector = tf.keras.preprocessing.sequence.pad_sequences(train_seqs, padding='post')
-
-MAX_LENGTH = max(len(t) for t in train_seqs)  # 49
+MAX_LENGTH = caption_tokens.max_length  # 49
 
 print('Max sentence length :', MAX_LENGTH)
 
 # Create training and validation sets
-img_name_train, img_name_val, cap_train, cap_val = train_test_split(img_name_vector, cap_vector, test_size=0.1, random_state=0)
+# cap_train, cap_val are caption indices of caption_tokens
+img_name_train, img_name_val, cap_train, cap_val = train_test_split(img_name_vector, np.arange(len(caption_tokens)), test_size=0.1, random_state=0)
 
 EPOCHS = 2
 REPORT_PER_BATCH = 100
@@ -264,25 +211,31 @@ vocab_size = num_words + 1
 steps_per_epoch = len(img_name_train) // BATCH_SIZE
 
 
-# Load the numpy files
-def map_func(img_name, cap):
-    img_tensor = np.load(img_name.decode('utf-8') + '.npy')
-    return img_tensor, cap
+pad_captions = caption_tokens.batch_padder()
+
+
+# Features are gathered from the feature store once per batch, captions are padded to the longest caption of the batch
+def map_func(rows, cap):
+    return feature_store.gather(rows), pad_captions(cap)
 
 
 # Train dataset
-dataset = tf.data.Dataset.from_tensor_slices((img_name_train, cap_train))
-dataset = dataset.map(lambda item1, item2: tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32]), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+dataset = tf.data.Dataset.from_tensor_slices((feature_store.rows(img_name_train), cap_train))
 dataset = dataset.shuffle(BUFFER_SIZE, reshuffle_each_iteration=True).batch(BATCH_SIZE)
+dataset = dataset.map(map_func, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-dataset.cache()
 
 # Validation dataset
-dataset_val = tf.data.Dataset.from_tensor_slices((img_name_val, cap_val))
-dataset_val = dataset_val.map(lambda item1, item2: tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32]), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+dataset_val = tf.data.Dataset.from_tensor_slices((feature_store.rows(img_name_val), cap_val))
 dataset_val = dataset_val.shuffle(BUFFER_SIZE, reshuffle_each_iteration=True).batch(BATCH_SIZE)
+dataset_val = dataset_val.map(map_func, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 dataset_val = dataset_val.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
+# 'float32', 'mixed_bfloat16' or 'mixed_float16'. Mixed modes compute in 16 bits with float32 weights,
+# and fall back to float32 on devices without native support.
+PRECISION = 'float32'
+precision = set_precision(PRECISION)
+
 # Transformer model
 transformer = Transformer(enc_layers, dec_layers, d_model, num_heads, dff,
                           vocab_size,
@@ -306,6 +259,7 @@ learning_rate = CustomSchedule(d_model)
 # assert False
 
 optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.999, epsilon=1e-9)
+optimizer = loss_scale_optimizer(optimizer, precision)
 # loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 loss_object = tf.keras.losses.CategoricalCrossentropy(from_logits=True, label_smoothing=0.1, reduction='none')
 
@@ -338,18 +292,17 @@ def accuracy_function(real, pred):
 
 
 def create_masks(inp, tar):
-    # Encoder padding mask
-    enc_padding_mask = create_padding_mask(tf.ones(shape=(tf.shape(inp)[0], tf.shape(inp)[1] * 2)))
-
-    # Used in the 2nd attention block in the decoder.
-    # This padding mask is used to mask the encoder outputs.
-    dec_padding_mask = create_padding_mask(tf.ones(shape=(tf.shape(inp)[0], tf.shape(inp)[1] * 2)))
+    # The encoder input is image features which never has padding,
+    # so the encoder padding mask and the padding mask of the 2nd attention block in the decoder are skipped.
+    enc_padding_mask = None
+    dec_padding_mask = None
 
     # Used in the 1st attention block in the decoder.
     # It is used to pad and mask future tokens in the input received by the decoder.
-    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    # The look ahead mask is sliced from a table computed once
+    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1], max_position_encodings)
     dec_target_padding_mask = create_padding_mask(tar)
-    combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+    combined_mask = tf.logical_or(dec_target_padding_mask, look_ahead_mask)
 
     return enc_padding_mask, combined_mask, dec_padding_mask
 
@@ -373,37 +326,31 @@ def train_step(inp, tar):
     with tf.GradientTape() as tape:
         predictions = transformer(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask)
         loss = loss_function(tar_real, predictions)
+        scaled_loss = scale_loss(optimizer, loss)  # Loss scaling of mixed_float16, loss itself otherwise
 
-    gradients = tape.gradient(loss, transformer.trainable_variables)
+    gradients = unscale_gradients(optimizer, tape.gradient(scaled_loss, transformer.trainable_variables))
     optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
 
     train_loss(loss)
     train_accuracy(accuracy_function(tar_real, predictions))
 
 
-# Checkpoints
+# Checkpoints are written in the background, and hold the epoch and the random states with the model and the optimizer
+# The loss history is appended to checkpoints/train/metrics.jsonl
 checkpoint_path = "./checkpoints/train"
-ckpt = tf.train.Checkpoint(transformoer=transformer,
-                           optimizer=optimizer)
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=50)
+checkpoints = CheckpointService(checkpoint_path, max_to_keep=50, legacy_epochs_per_checkpoint=EPOCHS_TO_SAVE,
+                                transformoer=transformer,
+                                optimizer=optimizer)
 
-start_epoch = 0
-if ckpt_manager.latest_checkpoint:
-    start_epoch = int(ckpt_manager.latest_checkpoint.split('-')[-1]) * EPOCHS_TO_SAVE
-    # restoring the latest checkpoint in checkpoint_path
-    ckpt.restore(ckpt_manager.latest_checkpoint)
+# restoring the latest checkpoint in checkpoint_path
+checkpoints.restore()
+start_epoch = int(checkpoints.epoch.numpy())
 
 print('Start Epoch = ', start_epoch)
 print('Start training for {} epochs'.format(EPOCHS))
 print('Batch Size = ', BATCH_SIZE)
 print('Steps per epoch = ', steps_per_epoch)
 
-loss_train_plot = []
-loss_train_file = checkpoint_path + '/loss_train.npy'
-
-if os.path.exists(loss_train_file):
-    loss_train_plot = np.load(loss_train_file)
-
 for epoch in range(EPOCHS):
     start = time.time()
 
@@ -417,18 +364,21 @@ for epoch in range(EPOCHS):
 
         if batch % REPORT_PER_BATCH == 0:
             print('Epoch {} Batch {}/{} Loss {:.6f} Accuracy {:.6f}'.format(current_epoch, batch, steps_per_epoch, train_loss.result(), train_accuracy.result()))
-            loss_train_plot = np.append(loss_train_plot, train_loss.result())
+            checkpoints.log_metrics(optimizer.iterations, current_epoch - 1, loss=train_loss.result())
 
     if (epoch + 1) % EPOCHS_TO_SAVE == 0:
-        ckpt_save_path = ckpt_manager.save()
-        np.save(loss_train_file, loss_train_plot)
+        ckpt_save_path = checkpoints.save(step=optimizer.iterations, epoch=current_epoch)
         print('Saving checkpoint for epoch {} at {}'.format(current_epoch, ckpt_save_path))
 
     print('Epoch {} Loss {:.6f} Accuracy {:.6f}'.format(current_epoch, train_loss.result(), train_accuracy.result()))
-    loss_train_plot = np.append(loss_train_plot, train_loss.result())
+    checkpoints.log_metrics(optimizer.iterations, current_epoch, loss=train_loss.result(), accuracy=train_accuracy.result())
 
     print('Time taken for {} epoch {} sec\n'.format(current_epoch, time.time() - start))
 
+checkpoints.wait()
+
+loss_train_plot = checkpoints.read_metrics('loss')
+
 plt.plot(loss_train_plot, 'b', label='train loss')
 plt.legend()
 plt.xlabel('Timestep')
@@ -436,39 +386,31 @@ plt.ylabel('Loss')
 plt.show()
 
 
-def evaluate(image):
-    img1, img2, _ = load_image(image)
-
-    extracted_feature = extract_feature(img1[tf.newaxis, ...], img2[tf.newaxis, ...])
+BEAM_WIDTH = 3
 
-    # as the target is english, the first word to the transformer should be the english start token.
-    decoder_input = [tokenizer.word_index['<start>']]
-    output = tf.expand_dims(decoder_input, 0)
+# Batched beam search, traced once for any number of images
+beam_search = BeamSearchDecoder(transformer,
+                                start_token=tokenizer.word_index['<start>'],
+                                end_token=tokenizer.word_index['<end>'],
+                                max_length=MAX_LENGTH,
+                                beam_width=BEAM_WIDTH)
 
-    for i in range(MAX_LENGTH):
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(extracted_feature, output)
 
-        # predictions.shape == (batch_size, seq_len, vocab_size)
-        predictions = transformer(extracted_feature,
-                                  output,
-                                  False,
-                                  enc_padding_mask,
-                                  combined_mask,
-                                  dec_padding_mask)
-
-        # select the last word from the seq_len dimension
-        predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
-        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
+def evaluate(image):
+    img1, img2, _ = load_image(image)
 
-        # return the result if the predicted_id is equal to the end token
+    extracted_feature = extract_feature(img1[tf.newaxis, ...], img2[tf.newaxis, ...])
 
-        if predicted_id == tokenizer.word_index['<end>']:
-            return tf.squeeze(output, axis=0)
+    sequences, _ = beam_search(extracted_feature)
 
-        # concatenate the predicted_id to the output which is given to the decoder as its input.
-        output = tf.concat([output, predicted_id], axis=-1)
+    # cut the result at the end token
+    output = []
+    for token in sequences[0].numpy():
+        if token == tokenizer.word_index['<end>'] or token == 0:
+            break
+        output.append(token)
 
-    return tf.squeeze(output, axis=0)
+    return tf.constant(output, dtype=tf.int32)
 
 
 def decode(seq):
@@ -491,11 +433,15 @@ def decode_and_plot(image):
 for it in range(10):
     rid = np.random.randint(0, len(img_name_val))
     image = img_name_val[rid]
-    real_caption = ' '.join([tokenizer.index_word[i] for i in cap_val[rid][1:-1] if i not in [0]])
+    real_caption = ' '.join([tokenizer.index_word[i] for i in caption_tokens.sequence(cap_val[rid])[1:-1] if i not in [0]])
 
     print('Real Caption:', real_caption)
     decode_and_plot(image)
 
+# Caption the whole validation set, one beam search call per batch
+# val_captions = beam_search.caption_dataset(dataset_val)
+# print(' '.join(tokenizer.index_word[i] for i in val_captions[0]))
+
 # assert False
 
 image_url = 'https://tensorflow.org/images/surf.jpg'
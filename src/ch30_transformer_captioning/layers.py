@@ -1,3 +1,4 @@
+import functools
 import tensorflow as tf
 import numpy as np
 
@@ -16,12 +17,12 @@ def get_angles(position, d_model):
     return position * angle_rates
 
 
-def positional_encoding(position, d_model):
+@functools.lru_cache(maxsize=None)
+def positional_encoding_table(position, d_model):
     """
+    NumPy positional encoding table, computed once per (position, d_model) and shared by every Encoder, Decoder.
 
-    :param position: Maximum sequence length
-    :param d_model: Model's dimension, Input word's embedding dimension
-    :return: positional encoding table, shape == (1, position, d_model)
+    :return: shape == (1, position, d_model), read only
     """
     angle_rads = get_angles(position, d_model)
 
@@ -31,30 +32,54 @@ def positional_encoding(position, d_model):
     # Apply cos to odd indices in the array; 2i+1
     angle_rads[:, 1::2] = np.cos(angle_rads[:, 1::2])
 
-    pos_encoding = angle_rads[np.newaxis, ...]
+    pos_encoding = angle_rads[np.newaxis, ...].astype(np.float32)
+    pos_encoding.setflags(write=False)
+
+    return pos_encoding
+
+
+def positional_encoding(position, d_model):
+    """
+
+    :param position: Maximum sequence length
+    :param d_model: Model's dimension, Input word's embedding dimension
+    :return: positional encoding table, shape == (1, position, d_model)
+    """
 
-    return tf.cast(pos_encoding, dtype=tf.float32)
+    return tf.constant(positional_encoding_table(position, d_model), dtype=tf.float32)
 
 
 def create_padding_mask(seq):
     """
     :param seq: shape == (batch_size, seq_len), sentences.
-    :return:
+    :return: True on the padding
     """
 
-    seq = tf.cast(tf.math.equal(seq, 0), tf.float32)
+    seq = tf.math.equal(seq, 0)
 
     # Add extra dimensions to add the padding to the attention logits and basically make this vector broadcastable.
     return seq[:, tf.newaxis, tf.newaxis, :]  # (batch_size, 1, 1, seq_len)
 
 
-def create_look_ahead_mask(size):
+@functools.lru_cache(maxsize=None)
+def look_ahead_mask_table(max_length):
+    """
+    Look ahead mask of max_length, computed once. Shorter masks are sliced from it.
+    """
+    table = np.triu(np.ones((max_length, max_length), dtype=np.bool_), k=1)
+    table.setflags(write=False)
+
+    return table
+
+
+def create_look_ahead_mask(size, max_length=256):
     """
-    :param size: sentence length
-    :return:
+    :param size: sentence length, can be a tensor
+    :param max_length: Maximum sentence length, size must not exceed it
+    :return: True on the future positions
     """
 
-    mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
+    mask = tf.constant(look_ahead_mask_table(max_length))[:size, :size]
     return mask  # (seq_len, seq_len)
 
 
@@ -70,7 +95,7 @@ def scaled_dot_product_attention(q, k, v, mask):
       q: query shape == (..., seq_len_q, depth)
       k: key shape == (..., seq_len_k, depth)
       v: value shape == (..., seq_len_v, depth_v)
-      mask: Float tensor with shape broadcastable to (..., seq_len_q, seq_len_k). Defaults to None.
+      mask: Bool tensor(True to mask) or Float tensor(1 to mask) with shape broadcastable to (..., seq_len_q, seq_len_k). Defaults to None.
 
     Returns:
       output, attention_weights
@@ -79,15 +104,20 @@ def scaled_dot_product_attention(q, k, v, mask):
     matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
 
     # scale matmul_qk by square root of depth_k
+    # Masking and softmax are done in float32, -1e9 doesn't fit in float16
     dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    scaled_attention_logits = tf.cast(matmul_qk, tf.float32) / tf.math.sqrt(dk)
 
     # add the mask to the scaled tensor.
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        if mask.dtype == tf.bool:
+            scaled_attention_logits = tf.where(mask, -1e9, scaled_attention_logits)
+        else:
+            scaled_attention_logits += (mask * -1e9)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores add up to 1.
     attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
+    attention_weights = tf.cast(attention_weights, v.dtype)
 
     output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
 
@@ -103,6 +133,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         assert d_model % self.num_heads == 0
 
         self.depth = d_model // self.num_heads
+        self.scale = self.depth ** -0.5
 
         self.wq = tf.keras.layers.Dense(d_model)
         self.wk = tf.keras.layers.Dense(d_model)
@@ -113,32 +144,145 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     def split_heads(self, x, batch_size):
         """
         Split the last dimension into (num_heads, depth).
-        Transpose the result such that the shape is (batch_size, num_heads, seq_len, depth)
+        The result is kept as (batch_size, seq_len, num_heads, depth), einsum handles the heads without transposing.
         """
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+        return tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
 
-    def call(self, v, k, q, mask):
-        batch_size = tf.shape(q)[0]
+    def project_qkv(self, x):
+        """
+        Fused projection for self attention. q, k, v are computed with a single matmul over the concatenated kernels.
+        Variables are still the ones of wq, wk, wv, so checkpoints are unchanged.
+        The float32 kernels are cast to the dtype of x, so this also works under a mixed precision policy.
+
+        :param x: shape == (batch_size, seq_len, d_model)
+        :return: q, k, v, shape == (batch_size, seq_len, num_heads, depth)
+        """
+        for dense in [self.wq, self.wk, self.wv]:
+            if not dense.built:
+                dense.build(x.shape)
+
+        batch_size = tf.shape(x)[0]
+
+        kernel = tf.cast(tf.concat([self.wq.kernel, self.wk.kernel, self.wv.kernel], axis=-1), x.dtype)  # (d_model, 3 * d_model)
+        bias = tf.cast(tf.concat([self.wq.bias, self.wk.bias, self.wv.bias], axis=-1), x.dtype)  # (3 * d_model,)
+
+        qkv = tf.einsum('bsd,de->bse', x, kernel) + bias  # (batch_size, seq_len, 3 * d_model)
+        qkv = tf.reshape(qkv, (batch_size, -1, 3, self.num_heads, self.depth))
+
+        return qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2]
+
+    def project_kv(self, v, k):
+        """
+        Project and split key, value into heads.
+        The result can be kept and reused on every decoding step when k, v don't change (e.g. encoder output).
+
+        :return: k, v, shape == (batch_size, seq_len, num_heads, depth)
+        """
+        batch_size = tf.shape(k)[0]
 
-        q = self.wq(q)  # (batch_size, seq_len, d_model)
         k = self.wk(k)  # (batch_size, seq_len, d_model)
         v = self.wv(v)  # (batch_size, seq_len, d_model)
 
-        q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+        k = self.split_heads(k, batch_size)  # (batch_size, seq_len_k, num_heads, depth)
+        v = self.split_heads(v, batch_size)  # (batch_size, seq_len_v, num_heads, depth)
+
+        return k, v
+
+    def attend(self, q, k, v, mask, return_attention=True):
+        """
+        Scaled dot product attention over the heads, see scaled_dot_product_attention()
+
+        :param q: shape == (batch_size, seq_len_q, num_heads, depth)
+        :param k: shape == (batch_size, seq_len_k, num_heads, depth)
+        :param v: shape == (batch_size, seq_len_v, num_heads, depth)
+        :param mask: Bool tensor(True to mask) or Float tensor(1 to mask), broadcastable to (batch_size, num_heads, seq_len_q, seq_len_k)
+        :param return_attention: If False, attention_weights is None
+        :return: output, shape == (batch_size, seq_len_q, d_model), attention_weights
+        """
+        batch_size = tf.shape(q)[0]
 
-        # scaled_attention.shape == (batch_size, num_heads, seq_len_q, depth)
-        # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
-        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+        # Scaling q instead of the logits, seq_len_k times fewer multiplications
+        logits = tf.einsum('bqhd,bkhd->bhqk', q * self.scale, k)  # (batch_size, num_heads, seq_len_q, seq_len_k)
 
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
+        # Masking and softmax are done in float32 under mixed precision, -1e9 doesn't fit in float16 and the sum of softmax loses precision
+        logits = tf.cast(logits, tf.float32)
+
+        if mask is not None:
+            if mask.dtype == tf.bool:
+                logits = tf.where(mask, -1e9, logits)
+            else:
+                logits += (mask * -1e9)
+
+        attention_weights = tf.nn.softmax(logits, axis=-1)  # (batch_size, num_heads, seq_len_q, seq_len_k)
+        attention_weights = tf.cast(attention_weights, v.dtype)
+
+        scaled_attention = tf.einsum('bhqk,bkhd->bqhd', attention_weights, v)  # (batch_size, seq_len_q, num_heads, depth)
         concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
 
         output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
 
-        return output, attention_weights
+        return output, attention_weights if return_attention else None
+
+    def call(self, v, k, q, mask, return_attention=True, self_attention=False):
+        """
+        :param self_attention: If True, v, k and q must be the same tensor, and it's projected with a single fused matmul. See project_qkv()
+        """
+        if self_attention:
+            q, k, v = self.project_qkv(q)
+        else:
+            k, v = self.project_kv(v, k)
+            q = self.split_heads(self.wq(q), tf.shape(q)[0])  # (batch_size, seq_len_q, num_heads, depth)
+
+        return self.attend(q, k, v, mask, return_attention)
+
+    def call_with_kv(self, q, k, v, mask, return_attention=True):
+        """
+        Attention with already projected key, value. See project_kv()
+
+        :param q: shape == (batch_size, seq_len_q, d_model)
+        :param k: shape == (batch_size, seq_len_k, num_heads, depth)
+        :param v: shape == (batch_size, seq_len_v, num_heads, depth)
+        """
+        q = self.split_heads(self.wq(q), tf.shape(q)[0])  # (batch_size, seq_len_q, num_heads, depth)
+
+        return self.attend(q, k, v, mask, return_attention)
+
+    def call_cached(self, x, cache, step, mask, return_attention=True):
+        """
+        Self attention for a single new position during incremental decoding.
+        Key and value of the new position are written into the cache at index 'step',
+        so the previous positions never have to be projected again.
+
+        :param x: shape == (batch_size, 1, d_model), input of the newest position
+        :param cache: {'k', 'v'}, shape == (batch_size, max_length, num_heads, depth)
+        :param step: Index of the newest position
+        :param mask: Masks cache slots which are not written yet, broadcastable to (batch_size, num_heads, 1, max_length)
+        :return: output, attention_weights, updated cache
+        """
+        q, k_new, v_new = self.project_qkv(x)  # (batch_size, 1, num_heads, depth)
+
+        # Write to the slot of 'step', shape == (1, max_length, 1, 1)
+        slot = tf.one_hot(step, tf.shape(cache['k'])[1], dtype=k_new.dtype)[tf.newaxis, :, tf.newaxis, tf.newaxis]
+
+        k = cache['k'] + slot * k_new  # (batch_size, max_length, num_heads, depth)
+        v = cache['v'] + slot * v_new  # (batch_size, max_length, num_heads, depth)
+
+        output, attention_weights = self.attend(q, k, v, mask, return_attention)
+
+        return output, attention_weights, {'k': k, 'v': v}
+
+
+def create_decoding_mask(step, max_length):
+    """
+    Look ahead mask for incremental decoding. Masks cache slots after 'step'.
+
+    :param step: Index of the newest position
+    :param max_length: Length of the decoding cache
+    :return: shape == (1, 1, 1, max_length)
+    """
+
+    mask = tf.range(max_length) > step
+    return mask[tf.newaxis, tf.newaxis, tf.newaxis, :]
 
 
 def point_wise_feed_forward_network(d_model, dff):
@@ -172,7 +316,7 @@ class EncoderLayer(tf.keras.layers.Layer):
         self.dropout2 = tf.keras.layers.Dropout(dropout_rate)
 
     def call(self, x, training, mask):
-        attn_output, _ = self.mha(x, x, x, mask)  # (batch_size, input_seq_len, d_model)
+        attn_output, _ = self.mha(x, x, x, mask, return_attention=False, self_attention=True)  # (batch_size, input_seq_len, d_model)
         attn_output = self.dropout1(attn_output, training=training)
         out1 = self.layer_norm1(x + attn_output)  # (batch_size, input_seq_len, d_model)
 
@@ -211,11 +355,11 @@ class DecoderLayer(tf.keras.layers.Layer):
     def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
         # enc_output.shape == (batch_size, input_seq_len, d_model)
 
-        attn1, _ = self.mha1(x, x, x, look_ahead_mask)  # (batch_size, target_seq_len, d_model)
+        attn1, _ = self.mha1(x, x, x, look_ahead_mask, return_attention=False, self_attention=True)  # (batch_size, target_seq_len, d_model)
         attn1 = self.dropout1(attn1, training=training)
         out1 = self.layer_norm1(attn1 + x)
 
-        attn2, _ = self.mha2(enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
+        attn2, _ = self.mha2(enc_output, enc_output, out1, padding_mask, return_attention=False)  # (batch_size, target_seq_len, d_model)
         attn2 = self.dropout2(attn2, training=training)
         out2 = self.layer_norm2(attn2 + out1)  # (batch_size, target_seq_len, d_model)
 
@@ -224,3 +368,26 @@ class DecoderLayer(tf.keras.layers.Layer):
         out3 = self.layer_norm3(ffn_output + out2)  # (batch_size, target_seq_len, d_model)
 
         return out3
+
+    def call_cached(self, x, cache, step, look_ahead_mask, padding_mask):
+        """
+        Incremental(inference only) version of call(). Only computes the newest position.
+
+        :param x: shape == (batch_size, 1, d_model)
+        :param cache: {'k', 'v'}: self attention cache, {'enc_k', 'enc_v'}: projected encoder output
+        :param step: Index of the newest position
+        :return: output, updated cache
+        """
+
+        attn1, _, self_cache = self.mha1.call_cached(x, cache, step, look_ahead_mask, return_attention=False)  # (batch_size, 1, d_model)
+        out1 = self.layer_norm1(attn1 + x)
+
+        attn2, _ = self.mha2.call_with_kv(out1, cache['enc_k'], cache['enc_v'], padding_mask, return_attention=False)  # (batch_size, 1, d_model)
+        out2 = self.layer_norm2(attn2 + out1)  # (batch_size, 1, d_model)
+
+        ffn_output = self.ffn(out2)  # (batch_size, 1, d_model)
+        out3 = self.layer_norm3(ffn_output + out2)  # (batch_size, 1, d_model)
+
+        cache = dict(cache, k=self_cache['k'], v=self_cache['v'])
+
+        return out3, cache
@@ -32,11 +32,12 @@ class Encoder(tf.keras.layers.Layer):
         # x.shape == (batch_size, image_feature_len:64, feature_dim:2048+512=2560)
         seq_len = tf.shape(x)[1]
 
-        xi = self.dense1(x[:, :, :2048]) + self.pos_encoding[:, :seq_len, :]  # shape == (batch_size, image_feature_len, d_model)
+        xi = self.dense1(x[:, :, :2048])  # shape == (batch_size, image_feature_len, d_model)
+        xi += tf.cast(self.pos_encoding[:, :seq_len, :], xi.dtype)
         xf = self.dense2(x[:, :, 2048:])  # shape == (batch_size, image_feature_len, d_model)
 
         x = tf.concat([xi, xf], axis=1)  # shape == (batch_size, image_feature_len*2:128, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))  # Scaling for normalization
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))  # Scaling for normalization
 
         x = self.dropout(x, training=training)
 
@@ -75,8 +76,8 @@ class Decoder(tf.keras.layers.Layer):
         seq_len = tf.shape(x)[1]
 
         x = self.embedding(x)  # (batch_size, target_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))  # Scaling for normalization
-        x += self.pos_encoding[:, :seq_len, :]  # Broadcasting works here
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))  # Scaling for normalization
+        x += tf.cast(self.pos_encoding[:, :seq_len, :], x.dtype)  # Broadcasting works here
 
         x = self.dropout(x, training=training)
 
@@ -86,6 +87,48 @@ class Decoder(tf.keras.layers.Layer):
         # x.shape == (batch_size, target_seq_len, d_model)
         return x
 
+    def init_cache(self, enc_output, max_length):
+        """
+        Create the decoding cache used by call_cached()
+        The encoder output is projected once per layer here, instead of on every decoding step.
+
+        :param enc_output: shape == (batch_size, input_seq_len, d_model)
+        :param max_length: Maximum number of positions to decode
+        :return: List of per layer cache
+        """
+        cache = []
+
+        for i in range(self.num_layers):
+            mha1 = self.dec_layers[i].mha1
+            enc_k, enc_v = self.dec_layers[i].mha2.project_kv(enc_output, enc_output)  # (batch_size, input_seq_len, num_heads, depth)
+            empty = tf.zeros((tf.shape(enc_output)[0], max_length, mha1.num_heads, mha1.depth), dtype=enc_k.dtype)
+
+            cache.append({'k': empty, 'v': empty, 'enc_k': enc_k, 'enc_v': enc_v})
+
+        return cache
+
+    def call_cached(self, x, cache, step, padding_mask):
+        """
+        Incremental(inference only) decoding. Only computes the position of 'step'.
+
+        :param x: shape == (batch_size, 1), newest token
+        :param cache: See init_cache()
+        :param step: Index of the newest token
+        :return: output, shape == (batch_size, 1, d_model), updated cache
+        """
+        look_ahead_mask = create_decoding_mask(step, tf.shape(cache[0]['k'])[1])
+
+        x = self.embedding(x)  # (batch_size, 1, d_model)
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))  # Scaling for normalization
+        x += tf.cast(self.pos_encoding[:, step:step + 1, :], x.dtype)
+
+        new_cache = []
+        for i in range(self.num_layers):
+            x, layer_cache = self.dec_layers[i].call_cached(x, cache[i], step, look_ahead_mask, padding_mask)
+            new_cache.append(layer_cache)
+
+        return x, new_cache
+
 
 class Transformer(tf.keras.Model):
     def __init__(self, enc_layers, dec_layers, d_model, num_heads, dff, target_vocab_size, pe_input, pe_target, dropout_rate=0.1):
@@ -107,7 +150,8 @@ class Transformer(tf.keras.Model):
         self.encoder = Encoder(enc_layers, d_model, num_heads, dff, pe_input, dropout_rate)
         self.decoder = Decoder(dec_layers, d_model, num_heads, dff, target_vocab_size, pe_target, dropout_rate)
 
-        self.final_layer = tf.keras.layers.Dense(target_vocab_size)
+        # Logits are always float32, so the loss and the softmax of decoding are computed in full precision
+        self.final_layer = tf.keras.layers.Dense(target_vocab_size, dtype='float32')
 
     def call(self, input_data, target_data, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
         # input_data.shape == (batch_size, feature_len:64, feature_dim:2048+512)
@@ -122,6 +166,27 @@ class Transformer(tf.keras.Model):
 
         return final_output
 
+    def init_decoding(self, input_data, enc_padding_mask, max_length):
+        """
+        Encode the input once and create the decoding cache for decode_step()
+        """
+        enc_output = self.encoder(input_data, False, enc_padding_mask)
+
+        return self.decoder.init_cache(enc_output, max_length)
+
+    def decode_step(self, target_token, cache, step, dec_padding_mask):
+        """
+        Predict the next token from the newest token only, using the cache of the previous steps.
+
+        :param target_token: shape == (batch_size, 1)
+        :return: predictions, shape == (batch_size, 1, target_vocab_size), updated cache
+        """
+        dec_output, cache = self.decoder.call_cached(target_token, cache, step, dec_padding_mask)
+
+        final_output = self.final_layer(dec_output)  # (batch_size, 1, target_vocab_size)
+
+        return final_output, cache
+
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, d_model, warmup_steps=8000):
@@ -131,6 +196,7 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
         self.warmup_steps = warmup_steps
 
     def __call__(self, step):
+        step = tf.cast(step, tf.float32)
         arg1 = tf.math.rsqrt(step)
         arg2 = step * (self.warmup_steps ** -1.5)
 